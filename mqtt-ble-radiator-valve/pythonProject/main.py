@@ -1,10 +1,12 @@
 import asyncio
 import logging
+import os
 from sys import argv
 
 from trv_controller import trv_controller
 
-logging.basicConfig(level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
+# DEBUG formats every BLE frame, see the `flight_recorder` section of config.yaml for a cheaper post-mortem trace
+logging.basicConfig(level=os.environ.get("TRV_LOG_LEVEL", "INFO").upper(), datefmt='%Y-%m-%d %H:%M:%S')
 
 if __name__ == '__main__':
     config_file = argv[1] if len(argv) > 1 else "./config.yaml"
@@ -0,0 +1,146 @@
+"""
+Benchmark of the BLE advertisements callback of `RadiatorValveSwitchManager`.
+
+    python scripts/adv-benchmark.py [--valves COUNT] [--devices COUNT] [--valve-ratio RATIO]
+
+The proxies forward every listened beacon, most of them from unrelated devices. The benchmark feeds a mix of
+valve and foreign advertisements to the raw advertisements ingestion (callback plus batch consumer), and
+compares it with the first implementation (name filter, MAC formatting and linear scan of the valves config,
+one parsed advertisement per callback), and with the flight recorder enabled.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trv_controller.radiator_valve import RadiatorValve  # noqa: E402
+from trv_controller.trv_controller import RadiatorValveSwitchManager  # noqa: E402
+
+PROXIES = ["proxy-1", "proxy-2", "proxy-3"]
+
+
+def legacy_on_ble_adv(manager: RadiatorValveSwitchManager, valves: list[dict], valve_last_seen: dict,
+                      hostname: str, adv):
+    if "vanne" not in adv.name.lower():
+        return
+
+    mac = RadiatorValve.int_to_mac(adv.address)
+
+    valve = next((valve for valve in valves if valve["mac_address"].lower() == mac.lower()), None)
+    if valve is None:
+        return
+
+    should_resend_valve_state = not (mac in valve_last_seen and time.time() - valve_last_seen[mac] < 60)
+    valve_last_seen[mac] = time.time()
+    if should_resend_valve_state:
+        pass
+
+    manager.log.debug(f"[Proxy {hostname}] Listened beacon for {valve['name']} - Rssi: {adv.rssi} dBm")
+
+    manager.valves_rssi_map.setdefault(valve['name'], dict())
+    manager.valves_rssi_map[valve['name']].setdefault(hostname, adv.rssi)
+    manager.valves_rssi_map[valve['name']][hostname] = 0.97 * manager.valves_rssi_map[valve['name']][
+        hostname] + 0.03 * adv.rssi
+    asyncio.get_running_loop().create_task(publish_attributes(valve))
+
+
+async def publish_attributes(valve: dict):
+    # the MQTT client is not connected in the benchmark, the publication returned immediately
+    return
+
+
+def make_config(valve_count: int) -> dict:
+    return {
+        "mqtt": {"host": "localhost"},
+        "bluetooth_proxies": [{"hostname": hostname} for hostname in PROXIES],
+        "radiator_valve_switches": [{
+            "name": f"valve_{i}",
+            "mac_address": RadiatorValve.int_to_mac(0x50_00_00_00_00_00 + i),
+            "bluetooth_proxies": PROXIES,
+        } for i in range(valve_count)],
+    }
+
+
+def make_advertisements(config: dict, device_count: int, valve_ratio: float, count: int, rng: random.Random):
+    def advertisement(name: str, address: int, rssi: int):
+        # `data` is the raw advertisement (flags and complete local name AD structures)
+        data = b"\x02\x01\x06" + bytes((len(name) + 1, 0x09)) + name.encode() if name else b"\x02\x01\x06"
+        return SimpleNamespace(name=name, address=address, rssi=rssi, data=data)
+
+    valves = [advertisement("vanne", RadiatorValve.mac_to_int(valve["mac_address"]), -70)
+              for valve in config["radiator_valve_switches"]]
+    foreign = [advertisement(rng.choice(["", "Mi Band", "LYWSD03MMC", "[TV] Samsung"]), rng.getrandbits(48), -90)
+               for _ in range(device_count)]
+    return [(rng.choice(PROXIES), rng.choice(valves) if rng.random() < valve_ratio else rng.choice(foreign))
+            for _ in range(count)]
+
+
+def make_raw_responses(advertisements, per_response: int):
+    """
+    Groups the advertisements of each proxy in raw advertisements responses of `per_response` advertisements
+    """
+    by_proxy = {hostname: [] for hostname in PROXIES}
+    for hostname, adv in advertisements:
+        by_proxy[hostname].append(adv)
+    responses = [(hostname, SimpleNamespace(advertisements=advs[i:i + per_response]))
+                 for hostname, advs in by_proxy.items() for i in range(0, len(advs), per_response)]
+    random.Random(2).shuffle(responses)
+    return responses
+
+
+async def measure(callback, messages, advertisements_count: int, batch: int = 1000, drain=None) -> float:
+    started = time.perf_counter()
+    for i in range(0, len(messages), batch):
+        for hostname, message in messages[i:i + batch]:
+            callback(hostname, message)
+        # let the publication tasks run, as the event loop would between two TCP reads
+        await asyncio.sleep(0)
+        if drain is not None:
+            drain()
+    await asyncio.sleep(0)
+    return advertisements_count / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--valves", type=int, default=20)
+    parser.add_argument("--devices", type=int, default=200, help="foreign BLE devices around")
+    parser.add_argument("--valve-ratio", type=float, default=0.1, help="share of the advertisements from valves")
+    parser.add_argument("--count", type=int, default=200_000)
+    parser.add_argument("--per-response", type=int, default=8, help="advertisements per raw response")
+    args = parser.parse_args()
+
+    config = make_config(args.valves)
+    advertisements = make_advertisements(config, args.devices, args.valve_ratio, args.count, random.Random(1))
+
+    manager = RadiatorValveSwitchManager(config)
+    valve_last_seen = dict()
+    legacy = await measure(
+        lambda hostname, adv: legacy_on_ble_adv(manager, config["radiator_valve_switches"], valve_last_seen,
+                                                hostname, adv),
+        advertisements, len(advertisements))
+
+    manager = RadiatorValveSwitchManager(config)
+    current = await measure(manager.ingestor.on_raw_advertisements,
+                            make_raw_responses(advertisements, args.per_response), len(advertisements),
+                            drain=lambda: manager._on_advertisement_batch(manager.ingestor.drain()))
+
+    manager = RadiatorValveSwitchManager({**config, "flight_recorder": None})
+    recorded = await measure(manager.ingestor.on_raw_advertisements,
+                             make_raw_responses(advertisements, args.per_response), len(advertisements),
+                             drain=lambda: manager._on_advertisement_batch(manager.ingestor.drain()))
+
+    print(f"{args.valves} valves, {args.devices} foreign devices, {args.valve_ratio:.0%} valve advertisements")
+    print(f"legacy callback:    {legacy:>12,.0f} adv/s")
+    print(f"current ingestion:  {current:>12,.0f} adv/s  (x{current / legacy:.1f}, "
+          f"{manager.ingestor.dropped} dropped)")
+    print(f"with flight recorder: {recorded:>10,.0f} adv/s  ({recorded / current - 1:+.1%})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+"""
+Microbenchmark of `trv_controller.frame_codec`.
+
+    python scripts/codec-benchmark.py [--fragment-size BYTES]
+
+The benchmark decodes a stream of typical valve responses split in BLE sized fragments, and compares it with the
+list based reassembly previously used by `RadiatorValve.on_bluetooth_gatt_notify`. The whole notification callback
+is measured as well: with the debug logs emitted (the level previously forced by `main.py`), at INFO level, and at
+INFO level with the flight recorder.
+The decoder is fuzzed with fragmented, stuffed and corrupted streams by `tests/test_frame_codec.py`.
+"""
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trv_controller.flight_recorder import FlightRecorder  # noqa: E402
+from trv_controller.frame_codec import FrameDecoder, FrameTemplate, encode_frame  # noqa: E402
+from trv_controller.radiator_valve import RadiatorValve  # noqa: E402
+
+FRAGMENT_SIZE = 20  # default ATT MTU payload
+
+
+def legacy_decode(fragments):
+    frames = []
+    current_resp = []
+    expected_length = 0
+    for value in fragments:
+        if len(current_resp) == 0:
+            if value[0] == 0xAA and value[1] == 0xAA:
+                current_resp.extend(value)
+                expected_length = value[2]
+        else:
+            current_resp.extend(value)
+        if len(current_resp) < expected_length:
+            continue
+        received_checksum = current_resp[-1]
+        expected_checksum = sum([i for i in current_resp[3:-1] if i != 0x55]) & 0xFF
+        final = current_resp[0:3]
+        final.extend([i for i in current_resp[3:] if i != 0x55])
+        if received_checksum == expected_checksum:
+            frames.append(final)
+        current_resp = []
+    return frames
+
+
+def best_of(function, number: int, repeat: int = 5) -> float:
+    # the best run is the least disturbed by the rest of the system
+    return min(timeit.repeat(function, number=number, repeat=repeat))
+
+
+def benchmark(fragment_size: int):
+    responses = [encode_frame(0x0C, n, bytes([0x5E, 0x01, 0x5E, 0x01] + [0] * 8)) for n in range(1, 255)]
+    fragments = [frame[i:i + fragment_size] for frame in responses for i in range(0, len(frame), fragment_size)]
+
+    def run_decoder():
+        decoder = FrameDecoder()
+        for value in fragments:
+            decoder.feed(value)
+
+    template = FrameTemplate(0x0C, bytes([0x5E, 0x01, 0x5E, 0x01] + [0] * 8))
+    payload = bytes([0x5E, 0x01, 0x5E, 0x01] + [0] * 8)
+
+    number = 200
+    results = {
+        "decode (FrameDecoder)": best_of(run_decoder, number=number),
+        "decode (legacy lists)": best_of(lambda: legacy_decode(fragments), number=number),
+        "encode (encode_frame)": best_of(lambda: [encode_frame(0x0C, n, payload) for n in range(1, 255)],
+                                          number=number),
+        "encode (FrameTemplate)": best_of(lambda: [template.encode(n) for n in range(1, 255)], number=number),
+    }
+    for name, seconds in results.items():
+        print(f"{name:<24} {seconds / (number * len(responses)) * 1e6:8.2f} us/frame")
+
+    # the logs are written to /dev/null, as a service would write them to its journal
+    log = logging.getLogger("radiator-valve")
+    log.propagate = False
+    log.addHandler(logging.StreamHandler(open(os.devnull, "w")))
+
+    valve = RadiatorValve("50:00:00:00:00:01", None)
+
+    def run_notify():
+        valve.decoder.reset()
+        for value in fragments:
+            valve.on_bluetooth_gatt_notify(len(value), value)
+
+    number = 50
+    results = dict()
+    log.setLevel(logging.DEBUG)
+    results["notify (DEBUG logs)"] = best_of(run_notify, number=number)
+    log.setLevel(logging.INFO)
+    results["notify (INFO logs)"] = best_of(run_notify, number=number)
+    valve.recorder = FlightRecorder().valve_ring(valve.mac_address_int)
+    results["notify (INFO, recorder)"] = best_of(run_notify, number=number)
+    for name, seconds in results.items():
+        print(f"{name:<24} {seconds / (number * len(responses)) * 1e6:8.2f} us/frame")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fragment-size", type=int, default=FRAGMENT_SIZE)
+    args = parser.parse_args()
+
+    benchmark(args.fragment_size)
@@ -0,0 +1,297 @@
+"""
+In-process emulation of the radiator valves behind ESPHome bluetooth proxies, without hardware.
+
+`EmulatedProxy` implements the subset of `aioesphomeapi.APIClient` used by `RadiatorValve` and by the manager
+(connections, notifications, writes, raw advertisements and free connection slots), and forwards the frames
+to the `EmulatedValve`s it can reach. The valves speak the real protocol (see `frame_codec`): packet number
+checking, 0x55 byte-stuffing, error frames for the rejected requests.
+
+The radio is impaired as configured by `Impairments`: latencies, fragmentation of the notifications, lost
+responses, failed connections and a limited number of connection slots per proxy.
+
+It supports the benchmarks of this directory, and is not part of the controller package.
+"""
+import asyncio
+import random
+from typing import Callable, Coroutine
+
+from aioesphomeapi import BluetoothConnectionDroppedError, BluetoothLERawAdvertisementsResponse
+from aioesphomeapi.api_pb2 import BluetoothLERawAdvertisement
+from aioesphomeapi.core import TimeoutAPIError
+
+from trv_controller.frame_codec import FrameDecoder, encode_frame
+
+SYNC_FUNCTION_CODE = 0x01
+TEMPERATURE_FUNCTION_CODE = 0x0C
+
+
+class Impairments:
+    """
+    Radio impairments of an emulated proxy, the latencies are in seconds
+    """
+    __slots__ = ("connect_latency", "write_latency", "response_latency", "jitter", "fragment_size",
+                 "response_loss", "connect_failure", "connection_slots")
+
+    def __init__(self,
+                 connect_latency: float = 0.5,
+                 write_latency: float = 0.02,
+                 response_latency: float = 0.05,
+                 jitter: float = 0.2,
+                 fragment_size: int = 20,
+                 response_loss: float = 0.0,
+                 connect_failure: float = 0.0,
+                 connection_slots: int = 3):
+        self.connect_latency = connect_latency
+        self.write_latency = write_latency
+        self.response_latency = response_latency
+        self.jitter = jitter  # relative, each latency is drawn in [latency * (1 - jitter), latency * (1 + jitter)]
+        self.fragment_size = fragment_size  # bytes per notification, 0 to never fragment
+        self.response_loss = response_loss  # probability that a response frame is lost
+        self.connect_failure = connect_failure  # probability that a connection attempt fails
+        self.connection_slots = connection_slots
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(**{key: value for key, value in config.items() if key in cls.__slots__})
+
+
+class EmulatedValve:
+    """
+    A radiator valve: it accepts the requests carrying the packet number following the last accepted one,
+    and answers the other ones with an error frame carrying the last accepted packet number.
+    """
+
+    def __init__(self, mac_address: int, comfort_temp_dec: int = 200, mode: int = 0x01,
+                 packet_number: int | None = None, rssi: dict[str, int] | None = None):
+        self.mac_address = mac_address
+        self.comfort_temp_dec = comfort_temp_dec
+        self.mode = mode
+        self.packet_number = packet_number if packet_number is not None else random.randint(1, 255)
+        self.rssi = rssi or dict()  # key is the proxy hostname
+
+        # the proxy holding the BLE connection, a valve accepts a single connection and stops advertising
+        self.connected_to: "EmulatedProxy | None" = None
+
+        # metrics
+        self.accepted = 0
+        self.rejected = 0
+        self.setpoint_writes = 0
+        self.mode_writes = 0
+
+    def handle(self, function: int, packet_number: int, payload: bytes) -> bytes:
+        """
+        Processes a request frame, returns the (stuffed) response frame
+        """
+        if packet_number != self.packet_number % 255 + 1:
+            self.rejected += 1
+            return encode_frame(0xFF, self.packet_number, b"", group=0xFF00)
+
+        self.packet_number = packet_number
+        self.accepted += 1
+
+        if function == TEMPERATURE_FUNCTION_CODE:
+            if len(payload) >= 2:
+                self.comfort_temp_dec = payload[0] | (payload[1] << 8)
+                self.setpoint_writes += 1
+            temperature = bytes((self.comfort_temp_dec & 0xFF, self.comfort_temp_dec >> 8))
+            return encode_frame(function, packet_number, temperature * 2 + bytes(8))
+
+        if function == SYNC_FUNCTION_CODE:
+            if payload:
+                self.mode = payload[0]
+                self.mode_writes += 1
+            return encode_frame(function, packet_number, bytes((self.mode,)) + bytes(10) + bytes((self.mode,)))
+
+        return encode_frame(0xFF, self.packet_number, b"", group=0xFF00)
+
+
+class _Connection:
+    __slots__ = ("valve", "on_state", "on_notify", "decoder")
+
+    def __init__(self, valve: EmulatedValve, on_state: Callable[[bool, int, int], None]):
+        self.valve = valve
+        self.on_state = on_state
+        self.on_notify: Callable[[int, bytearray], None] | None = None
+        self.decoder = FrameDecoder()
+
+
+class EmulatedProxy:
+    """
+    Drop-in replacement of `aioesphomeapi.APIClient` for the bluetooth proxy features used by this project
+    """
+
+    def __init__(self, hostname: str, valves: list[EmulatedValve], impairments: Impairments = None,
+                 rng: random.Random = None):
+        self.hostname = hostname
+        self.valves: dict[int, EmulatedValve] = {valve.mac_address: valve for valve in valves}
+        self.impairments = impairments or Impairments()
+        self.rng = rng or random.Random()
+
+        self._connections: dict[int, _Connection] = dict()
+        self._connecting = 0
+        self._advertisement_callbacks: list[Callable[[BluetoothLERawAdvertisementsResponse], None]] = []
+        self._connections_free_callbacks: list[Callable[[int, int, list[int]], None]] = []
+
+        # metrics
+        self.connects = 0
+        self.failed_connects = 0
+        self.writes = 0
+        self.notifications = 0
+        self.lost_responses = 0
+
+    def _latency(self, latency: float) -> float:
+        jitter = self.impairments.jitter
+        return latency * self.rng.uniform(1 - jitter, 1 + jitter)
+
+    @property
+    def free_slots(self) -> int:
+        return self.impairments.connection_slots - len(self._connections) - self._connecting
+
+    def _notify_connections_free(self):
+        for callback in self._connections_free_callbacks:
+            callback(self.free_slots, self.impairments.connection_slots, list(self._connections))
+
+    async def connect(self, login: bool = False):
+        pass
+
+    async def disconnect(self, force: bool = False):
+        for address in list(self._connections):
+            self._drop(address)
+
+    def subscribe_bluetooth_le_raw_advertisements(
+            self, on_advertisements: Callable[[BluetoothLERawAdvertisementsResponse], None]) -> Callable[[], None]:
+        self._advertisement_callbacks.append(on_advertisements)
+        return lambda: self._advertisement_callbacks.remove(on_advertisements)
+
+    def subscribe_bluetooth_connections_free(
+            self, on_bluetooth_connections_free_update: Callable[[int, int, list[int]], None]) -> Callable[[], None]:
+        self._connections_free_callbacks.append(on_bluetooth_connections_free_update)
+        on_bluetooth_connections_free_update(self.free_slots, self.impairments.connection_slots,
+                                             list(self._connections))
+        return lambda: self._connections_free_callbacks.remove(on_bluetooth_connections_free_update)
+
+    def advertise(self):
+        """
+        Forwards one advertisement of each reachable valve (the connected valves do not advertise)
+        """
+        advertisements = [BluetoothLERawAdvertisement(address=valve.mac_address,
+                                                      rssi=valve.rssi.get(self.hostname, -70),
+                                                      address_type=0,
+                                                      data=b"\x02\x01\x06\x06\x09vanne")
+                          for valve in self.valves.values() if valve.connected_to is None]
+        if not advertisements:
+            return
+        response = BluetoothLERawAdvertisementsResponse(advertisements=advertisements)
+        for callback in list(self._advertisement_callbacks):
+            callback(response)
+
+    async def advertisement_task(self, interval: float, exited: asyncio.Event):
+        while not exited.is_set():
+            self.advertise()
+            await asyncio.sleep(self._latency(interval))
+
+    async def bluetooth_device_connect(self, address: int,
+                                       on_bluetooth_connection_state: Callable[[bool, int, int], None],
+                                       timeout: float = 30.0, disconnect_timeout: float = 20.0,
+                                       feature_flags: int = 0, has_cache: bool = False,
+                                       address_type: int | None = None) -> Callable[[], None]:
+        if self.free_slots <= 0:
+            raise BluetoothConnectionDroppedError(f"No free connection slot on {self.hostname}")
+
+        valve = self.valves.get(address)
+        self._connecting += 1
+        try:
+            if valve is None or valve.connected_to is not None or self.rng.random() < self.impairments.connect_failure:
+                # the valve is out of range or busy: the connection times out
+                self.failed_connects += 1
+                await asyncio.sleep(timeout)
+                raise TimeoutAPIError(f"Timeout waiting for connect response while connecting to {address}")
+
+            await asyncio.sleep(self._latency(self.impairments.connect_latency))
+            if valve.connected_to is not None:
+                self.failed_connects += 1
+                raise BluetoothConnectionDroppedError(f"Peripheral {address} connected elsewhere")
+        finally:
+            self._connecting -= 1
+
+        valve.connected_to = self
+        self._connections[address] = _Connection(valve, on_bluetooth_connection_state)
+        self.connects += 1
+        self._notify_connections_free()
+        on_bluetooth_connection_state(True, 23, 0)
+        return lambda: None
+
+    def _connection(self, address: int) -> _Connection:
+        connection = self._connections.get(address)
+        if connection is None:
+            raise BluetoothConnectionDroppedError(f"Peripheral {address} is not connected")
+        return connection
+
+    async def bluetooth_gatt_start_notify(self, address: int, handle: int,
+                                          on_bluetooth_gatt_notify: Callable[[int, bytearray], None],
+                                          timeout: float = 10.0) \
+            -> tuple[Callable[[], Coroutine[None, None, None]], Callable[[], None]]:
+        connection = self._connection(address)
+        await asyncio.sleep(self._latency(self.impairments.write_latency))
+        connection.on_notify = on_bluetooth_gatt_notify
+
+        async def stop_notify():
+            connection.on_notify = None
+
+        return stop_notify, lambda: None
+
+    async def bluetooth_gatt_write(self, address: int, handle: int, data: bytes, response: bool,
+                                   timeout: float = 30.0) -> None:
+        connection = self._connection(address)
+        self.writes += 1
+        await asyncio.sleep(self._latency(self.impairments.write_latency))
+
+        # the connection may have been closed meanwhile
+        connection = self._connection(address)
+        for frame in connection.decoder.feed(data):
+            answer = connection.valve.handle(frame.function, frame.packet_number, bytes(frame.payload))
+            if self.rng.random() < self.impairments.response_loss:
+                self.lost_responses += 1
+                continue
+            self._schedule_notify(connection, answer)
+
+    def _schedule_notify(self, connection: _Connection, frame: bytes):
+        size = self.impairments.fragment_size or len(frame)
+        delay = self._latency(self.impairments.response_latency)
+        loop = asyncio.get_running_loop()
+        for offset in range(0, len(frame), size):
+            # the fragments of a frame are delivered in order, back to back
+            loop.call_later(delay, self._notify, connection, bytearray(frame[offset:offset + size]))
+            delay += 0.001
+
+    def _notify(self, connection: _Connection, fragment: bytearray):
+        if connection.on_notify is None or self._connections.get(connection.valve.mac_address) is not connection:
+            return
+        self.notifications += 1
+        connection.on_notify(len(fragment), fragment)
+
+    def _drop(self, address: int):
+        connection = self._connections.pop(address, None)
+        if connection is None:
+            return
+        connection.valve.connected_to = None
+        connection.on_notify = None
+        self._notify_connections_free()
+
+    async def bluetooth_device_disconnect(self, address: int, timeout: float = 20.0) -> None:
+        if address not in self._connections:
+            return
+        await asyncio.sleep(self._latency(self.impairments.write_latency))
+        connection = self._connections.get(address)
+        self._drop(address)
+        if connection is not None:
+            connection.on_state(False, 0, 0x13)
+
+    def as_attributes(self) -> dict:
+        return {
+            "connects": self.connects,
+            "failed_connects": self.failed_connects,
+            "writes": self.writes,
+            "notifications": self.notifications,
+            "lost_responses": self.lost_responses,
+        }
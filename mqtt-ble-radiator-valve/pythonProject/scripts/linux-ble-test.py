@@ -1,10 +1,15 @@
 import pygatt
 from binascii import hexlify
+import os
 import time
 import threading
 import logging
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trv_controller.frame_codec import FrameDecoder, encode_frame  # noqa: E402
+
 # logging.basicConfig()
 # logging.getLogger('pygatt').setLevel(logging.DEBUG)
 
@@ -13,7 +18,7 @@ adapter = pygatt.GATTToolBackend(hci_device="hci0")
 
 packet_number = 0x01
 
-current_resp = []
+frame_decoder = FrameDecoder()
 
 write_characteristic_uuid = "0000ffe9-0000-1000-8000-00805f9b34fb"
 
@@ -48,24 +53,8 @@ class RadiatorValve:
 radiator_valve = RadiatorValve()
 
 
-def calculate_checksum(msg):
-    msg_to_analyze = msg[3:]
-
-    msg_to_analyze = [i for i in msg_to_analyze if i != 0x55]
-
-    print(msg_to_analyze)
-
-    checksum = (sum(msg_to_analyze) & 0xFF)
-
-    print(checksum)
-
-    # checksum = (sum(msg[3:]) & 0xFF)
-
-    return checksum
-
-
 def handle_notification(handle, value):
-    global packet_number, event, radiator_valve, response_mutex, current_resp
+    global packet_number, event, radiator_valve, response_mutex
 
     """
     handle -- integer, characteristic read handle the data was received on
@@ -73,64 +62,31 @@ def handle_notification(handle, value):
     """
     print("Received data: %s" % hexlify(value))
 
-    response_length = len(value)
-
-    if current_resp == [] and response_length < 2:
-        print("Bad packet response")
-        return
+    for frame in frame_decoder.feed(value):
+        print(frame)
 
-    if current_resp == []:
-        if value[0] == 0xAA and value[1] == 0xAA:
-            current_resp.extend(value)
-            val_cut = value[3:]
-            if 0x55 in val_cut:
-                return
-    else:
-        current_resp.extend(value)
-
-    response_length = len(current_resp)
-
-    received_checksum = current_resp[response_length - 1]
-    expected_checksum = calculate_checksum(current_resp[0:response_length - 1])
-
-    # se non è una bad response
-    # print("DECRYPTING")
-    # print(packet_number, current_resp[6], expected_checksum, received_checksum)
-
-    final = current_resp[0:3]
-
-    cut = [i for i in current_resp[3:] if i != 0x55]
-
-    final.extend(cut)
-
-    current_resp = final
-
-    print("CURRENT_RESP")
-    print(current_resp)
-
-    if current_resp[3] != 255 and current_resp[4] != 255 and current_resp[
-        6] == packet_number and expected_checksum == received_checksum:
+        # se non è una bad response
+        if frame.is_error or frame.group != 0x0000 or frame.packet_number != packet_number:
+            continue
 
         # se è un pacchetto di risposta a un comando 0x01, 0x00, 0x00 (first group)
-        if current_resp[3] == 0x01 and current_resp[4] == 0x00 and current_resp[5] == 0x00:
+        if frame.function == 0x01 and len(frame.payload) > 0:
             print("Packet num response")
             with response_mutex:
-                radiator_valve.set_mode(current_resp[response_length - 2])
-                radiator_valve.set_current_packet_number(current_resp[6])
+                radiator_valve.set_mode(frame.payload[-1])
+                radiator_valve.set_current_packet_number(frame.packet_number)
 
             received_response_event.set()
 
-        if current_resp[3] == 0x0C and current_resp[4] == 0x00 and current_resp[5] == 0x00:
+        if frame.function == 0x0C and len(frame.payload) >= 2:
             print("Comfort temp message reponse")
             with response_mutex:
-                current_comfort_temp = current_resp[8] * 256 + current_resp[7]
+                current_comfort_temp = frame.payload[1] * 256 + frame.payload[0]
                 radiator_valve.set_current_comfort_temperature(current_comfort_temp)
-                radiator_valve.set_current_packet_number(current_resp[6])
+                radiator_valve.set_current_packet_number(frame.packet_number)
 
             received_response_event.set()
 
-    current_resp = []
-
 
 try:
     print("Started")
@@ -150,9 +106,7 @@ try:
     # loop per ottenere packet number e mode corrente
     got_packet_number = False
     while got_packet_number == False:
-        msg = bytearray([0xAA, 0xAA, 0x07, 0x01, 0x00, 0x00, packet_number])
-        checksum = calculate_checksum(msg)
-        msg.append(checksum)
+        msg = encode_frame(0x01, packet_number)
         device.char_write(write_characteristic_uuid, msg, wait_for_response=False)
         print("Char write")
         ret = received_response_event.wait(timeout=1)
@@ -171,9 +125,7 @@ try:
     # loop per ottenere la current comfort temp
     got_response_for_current_temp = False
     while got_response_for_current_temp == False:
-        msg = bytearray([0xAA, 0xAA, 0x07, 0x0C, 0x00, 0x00, packet_number])
-        checksum = calculate_checksum(msg)
-        msg.append(checksum)
+        msg = encode_frame(0x0C, packet_number)
         device.char_write(write_characteristic_uuid, msg, wait_for_response=False)
         ret = received_response_event.wait(timeout=1)
         if ret == True:
@@ -186,10 +138,9 @@ try:
               " current_packet_number = " + str(radiator_valve.current_packet_number) +
               " current comfort temp = " + str(radiator_valve.current_comfort_temp * 0.1) + "°")
 
-        msg = bytearray([0xAA, 0xAA, 0x13, 0x01, 0x00, 0x00, radiator_valve.get_packet_number(), comfort_mode, 0x00,
-                         0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, radiator_valve.current_mode])
-        checksum = calculate_checksum(msg)
-        msg.append(checksum)
+        msg = encode_frame(0x01, radiator_valve.get_packet_number(),
+                           bytes([comfort_mode, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+                                  radiator_valve.current_mode]))
 
         print("Set current mode to comfort mode")
         device.char_write(write_characteristic_uuid, msg, wait_for_response=True)
@@ -211,10 +162,8 @@ try:
             print("Set temp to 7")
 
         # set comfort temperature
-        msg = bytearray([0xAA, 0xAA, 0x13, 0x0C, 0x00, 0x00, radiator_valve.get_packet_number(), low, high,
-                         low, high, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-        checksum = calculate_checksum(msg)
-        msg.append(checksum)
+        msg = encode_frame(0x0C, radiator_valve.get_packet_number(),
+                           bytes([low, high, low, high, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]))
         device.char_write(write_characteristic_uuid, msg, wait_for_response=True)
 
 
@@ -0,0 +1,207 @@
+"""
+A minimal in-process MQTT 3.1.1 broker, stand-in for the real broker in the benchmarks of this directory.
+
+It supports what the controller and Home Assistant use: QoS 0/1/2 publications (delivered with QoS 0),
+retained messages, `+`/`#` wildcard subscriptions, keep-alive pings and last wills (see `drop`). There is
+no authentication, no persistence, and no session is kept across connections. Every publication is counted by
+topic in `published`.
+The acknowledgements can be delayed by `ack_latency` seconds, like behind a network round-trip.
+"""
+import asyncio
+import collections
+import logging
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, \
+    PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes((packet_type << 4 | flags,)) + _encode_length(len(body)) + body
+
+
+def _string(value: bytes) -> bytes:
+    return len(value).to_bytes(2, "big") + value
+
+
+class _Session:
+    __slots__ = ("client_id", "writer", "subscriptions", "will")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.client_id = ""
+        self.writer = writer
+        self.subscriptions: set[str] = set()
+
+        # topic, payload and retain flag, published if the client is disconnected without DISCONNECT
+        self.will: tuple[str, bytes, bool] | None = None
+
+
+class LocalBroker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, ack_latency: float = 0.0):
+        self.log = logging.getLogger("local-broker")
+        self.host = host
+        self.port = port
+        self.ack_latency = ack_latency
+        self._server: asyncio.Server | None = None
+        self._sessions: set[_Session] = set()
+        self.retained: dict[str, bytes] = dict()
+
+        # metrics
+        self.published: collections.Counter[str] = collections.Counter()
+        self.delivered = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for session in list(self._sessions):
+                session.writer.close()
+            await self._server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False):
+        """
+        Publishes a message as if it was received from a client
+        """
+        self.published[topic] += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+        packet = _packet(PUBLISH, 0, _string(topic.encode()) + payload)
+        for session in self._sessions:
+            if any(topic_matches(topic_filter, topic) for topic_filter in session.subscriptions):
+                session.writer.write(packet)
+                self.delivered += 1
+
+    def drop(self, client_id: str):
+        """
+        Closes the connection of a client as if it had crashed: its last will is published
+        """
+        for session in self._sessions:
+            if session.client_id == client_id:
+                session.writer.close()
+
+    def _acknowledge(self, writer: asyncio.StreamWriter, packet: bytes):
+        if self.ack_latency:
+            asyncio.get_running_loop().call_later(self.ack_latency,
+                                                  lambda: writer.is_closing() or writer.write(packet))
+        else:
+            writer.write(packet)
+
+    async def _read_packet(self, reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = _Session(writer)
+        self._sessions.add(session)
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+
+                if packet_type == CONNECT:
+                    protocol_length = int.from_bytes(body[0:2], "big")
+                    offset = 2 + protocol_length + 4  # protocol name, level, flags, keep alive
+                    connect_flags = body[2 + protocol_length + 1]
+                    client_id_length = int.from_bytes(body[offset:offset + 2], "big")
+                    session.client_id = body[offset + 2:offset + 2 + client_id_length].decode()
+                    offset += 2 + client_id_length
+                    if connect_flags & 0x04:
+                        topic_length = int.from_bytes(body[offset:offset + 2], "big")
+                        will_topic = body[offset + 2:offset + 2 + topic_length].decode()
+                        offset += 2 + topic_length
+                        payload_length = int.from_bytes(body[offset:offset + 2], "big")
+                        session.will = (will_topic, body[offset + 2:offset + 2 + payload_length],
+                                        bool(connect_flags & 0x20))
+                    writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = int.from_bytes(body[0:2], "big")
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        self._acknowledge(writer, _packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+                    self.publish(topic, body[offset:], retain=bool(flags & 0x01))
+
+                elif packet_type == PUBREL:
+                    self._acknowledge(writer, _packet(PUBCOMP, 0, body[0:2]))
+
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted, topic_filters = body[0:2], 2, bytearray(), []
+                    while offset < len(body):
+                        filter_length = int.from_bytes(body[offset:offset + 2], "big")
+                        topic_filters.append(body[offset + 2:offset + 2 + filter_length].decode())
+                        granted.append(min(body[offset + 2 + filter_length], 1))
+                        offset += 3 + filter_length
+                    session.subscriptions.update(topic_filters)
+                    writer.write(_packet(SUBACK, 0, packet_id + bytes(granted)))
+
+                    for topic, payload in self.retained.items():
+                        if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                            writer.write(_packet(PUBLISH, 0x01, _string(topic.encode()) + payload))
+                            self.delivered += 1
+
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        filter_length = int.from_bytes(body[offset:offset + 2], "big")
+                        session.subscriptions.discard(body[offset + 2:offset + 2 + filter_length].decode())
+                        offset += 2 + filter_length
+                    writer.write(_packet(UNSUBACK, 0, body[0:2]))
+
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b""))
+
+                elif packet_type == DISCONNECT:
+                    session.will = None
+                    break
+
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._sessions.discard(session)
+            writer.close()
+            if session.will is not None:
+                self.publish(*session.will)
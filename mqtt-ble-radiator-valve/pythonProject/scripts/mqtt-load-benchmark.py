@@ -0,0 +1,321 @@
+"""
+End-to-end load benchmark of `RadiatorValveSwitchManager.run`, against a local MQTT broker and emulated proxies.
+
+    python scripts/mqtt-load-benchmark.py [--valves COUNT] [--proxies COUNT] [--rate COMMANDS/S --duration S]
+                                          [--birth-interval S] [--discovery-qos QOS] [--broker-latency S]
+                                          [--flood COUNT] [--instances COUNT [--kill-after S]]
+                                          [--state-polling S]
+    python scripts/mqtt-load-benchmark.py --scene [--group] [--valves COUNT]
+
+The manager runs unmodified, except that its proxies are `emulator.EmulatedProxy` instances.
+A load client publishes the commands on `ble_radiator_valve/<name>/set` (randomly at `--rate` commands/s, or a
+whole-house "heating on" scene with `--scene`, as a single group command with `--group`) and waits for the
+matching `ble_radiator_valve/<name>/state`, or for the command to be shed (`ble_radiator_valve/<name>/command_status`).
+With `--flood` a misbehaving automation publishes COUNT random commands at once before the load.
+With `--birth-interval` a Home Assistant birth message is published periodically during the load, each one
+triggering a discovery burst. With `--instances` the valves are sharded between several managers (see
+`trv_controller.sharding`) sharing the broker and the proxies, and `--kill-after` crashes the first one during the
+load: the failover time and the valves owned by two instances at once are reported. With `--state-polling` the
+valves state is also read in the background every S seconds (see `trv_controller.state_poller`), to measure how
+much the reads delay the commands.
+It reports the command-to-state latency, the shed commands, the MQTT publication volume by topic kind and the event
+loop lag.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+from aiomqtt import Client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from emulator import EmulatedProxy, EmulatedValve, Impairments  # noqa: E402
+from local_broker import LocalBroker  # noqa: E402
+from trv_controller.radiator_valve import RadiatorValve  # noqa: E402
+from trv_controller.trv_controller import RadiatorValveSwitchManager  # noqa: E402
+
+TOPIC_PREFIX = RadiatorValveSwitchManager.DEVICE_TOPIC_PREFIX
+
+
+class EmulatedProxiesManager(RadiatorValveSwitchManager):
+    """
+    The manager, connected to emulated proxies instead of the ESPHome API
+    """
+
+    def __init__(self, config: dict, proxies: dict[str, EmulatedProxy], advertisement_interval: float):
+        super().__init__(config)
+        self.emulated_proxies = proxies
+        self.advertisement_interval = advertisement_interval
+
+    async def _proxy_connection_manager_task(self, proxy: dict):
+        hostname = proxy["hostname"]
+        cli = self.emulated_proxies[hostname]
+        self._on_proxy_connected(hostname, cli)
+        try:
+            await cli.advertisement_task(self.advertisement_interval, self.exited)
+        finally:
+            # as the ESPHome proxy does when the API connection is lost
+            await cli.disconnect()
+            self._on_proxy_disconnected(hostname)
+
+
+def make_setup(args) -> tuple[dict, list[dict[str, EmulatedProxy]]]:
+    """
+    Returns the config and the emulated proxies of each instance (one API client per instance and proxy,
+    all reaching the same valves)
+    """
+    rng = random.Random(args.seed)
+    hostnames = [f"proxy-{i}" for i in range(args.proxies)]
+    config = {
+        "mqtt": {"host": "127.0.0.1", "attributes_flush_interval": 1, "discovery_qos": args.discovery_qos},
+        "bluetooth_proxies": [{"hostname": hostname} for hostname in hostnames],
+        "radiator_valve_switches": [{
+            "name": f"valve_{i}",
+            "mac_address": RadiatorValve.int_to_mac(0x50_00_00_00_00_00 + i),
+            "bluetooth_proxies": hostnames,
+        } for i in range(args.valves)],
+        "radiator_valve_groups": [{"name": "house", "valves": [f"valve_{i}" for i in range(args.valves)]}],
+    }
+    impairments = Impairments(connect_latency=args.connect_latency, response_loss=args.response_loss,
+                              connection_slots=args.slots)
+    valves = [EmulatedValve(RadiatorValve.mac_to_int(valve["mac_address"]), packet_number=rng.randint(1, 255),
+                            rssi={hostname: rng.randint(-95, -55) for hostname in hostnames})
+              for valve in config["radiator_valve_switches"]]
+    proxies = [{hostname: EmulatedProxy(hostname, valves, impairments, random.Random(rng.random()))
+                for hostname in hostnames}
+               for _ in range(args.instances)]
+    return config, proxies
+
+
+class LoopLagMonitor:
+    """
+    Measures how late a periodic timer fires, i.e. how long the event loop is kept busy
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags: list[float] = []
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - started - self.interval)
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "n/a"
+    quantiles = statistics.quantiles(values, n=100, method="inclusive") if len(values) > 1 else values * 99
+    return (f"p50 {quantiles[49]:.3f}s  p90 {quantiles[89]:.3f}s  p99 {quantiles[98]:.3f}s  "
+            f"max {max(values):.3f}s")
+
+
+def topic_kind(topic: str) -> str:
+    levels = topic.split("/")
+    if levels[0] != TOPIC_PREFIX:
+        return levels[0]
+    if levels[1] == "instances":
+        return "instances"
+    return f"{levels[1]}/{levels[-1]}" if levels[1] == "proxies" else levels[-1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--valves", type=int, default=50)
+    parser.add_argument("--proxies", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=2.0, help="commands per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--scene", action="store_true", help="turn on all the valves at once instead")
+    parser.add_argument("--group", action="store_true", help="send the scene as a single group command")
+    parser.add_argument("--flood", type=int, default=0, help="random commands published at once before the load")
+    parser.add_argument("--birth-interval", type=float, default=0.0, help="seconds between HA birth messages")
+    parser.add_argument("--discovery-qos", type=int, default=0)
+    parser.add_argument("--broker-latency", type=float, default=0.0, help="seconds before the broker acknowledges")
+    parser.add_argument("--instances", type=int, default=1, help="controller instances sharing the valves")
+    parser.add_argument("--kill-after", type=float, help="seconds of load before the first instance crashes")
+    parser.add_argument("--lease-ttl", type=float, default=10.0)
+    parser.add_argument("--state-polling", type=float, help="seconds between the background reads of a valve")
+    parser.add_argument("--slots", type=int, default=3, help="connection slots per proxy")
+    parser.add_argument("--connect-latency", type=float, default=0.5)
+    parser.add_argument("--response-loss", type=float, default=0.0)
+    parser.add_argument("--advertisement-interval", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for the pending states")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    rng = random.Random(args.seed)
+
+    async with LocalBroker(ack_latency=args.broker_latency) as broker:
+        config, proxies = make_setup(args)
+        config["mqtt"]["port"] = broker.port
+        if args.state_polling:
+            config["state_polling"] = {"interval": args.state_polling, "daily_reads": 24 * 3600}
+        if args.instances > 1:
+            config["sharding"] = {"lease_ttl": args.lease_ttl, "heartbeat_interval": args.lease_ttl / 4,
+                                  "settle_delay": 1}
+        managers = [EmulatedProxiesManager({**config, "sharding": {**config["sharding"], "instance_id": f"trv-{i}"}}
+                                           if args.instances > 1 else config, proxies[i], args.advertisement_interval)
+                    for i in range(args.instances)]
+        valve_names = [valve["name"] for valve in config["radiator_valve_switches"]]
+
+        monitor = LoopLagMonitor()
+        monitor_task = asyncio.create_task(monitor.run())
+        manager_tasks = [asyncio.create_task(manager.run()) for manager in managers]
+
+        def owners() -> collections.Counter[str]:
+            """
+            Number of live instances owning each valve
+            """
+            live = managers[1:] if killed_at is not None else managers
+            return collections.Counter(name for manager in live for name in manager.valves.by_name)
+
+        # sampled every 0.1s: valves owned by two instances at once, and when the crashed instance's valves moved
+        double_owned_samples = 0
+        killed_at = failed_over_at = None
+
+        async def watch_ownership():
+            nonlocal double_owned_samples, failed_over_at
+            while True:
+                counts = owners()
+                double_owned_samples += sum(count > 1 for count in counts.values())
+                if killed_at is not None and failed_over_at is None and len(counts) == len(valve_names):
+                    failed_over_at = time.perf_counter()
+                await asyncio.sleep(0.1)
+
+        # commands waiting for their state, key is the valve name
+        pending: dict[str, list[tuple[float, str]]] = collections.defaultdict(list)
+        latencies: list[float] = []
+        shed: collections.Counter[str] = collections.Counter()
+        sent = 0
+
+        async with Client("127.0.0.1", broker.port) as client:
+            await client.subscribe(f"{TOPIC_PREFIX}/+/state")
+            await client.subscribe(f"{TOPIC_PREFIX}/+/command_status")
+
+            async def receive_states():
+                async for message in client.messages:
+                    if str(message.topic).endswith("/command_status"):
+                        # the shed command may stand for several merged ones of the same state
+                        name, status = str(message.topic).split("/")[1], json.loads(message.payload)
+                        shed[status["reason"]] += 1
+                        pending[name] = [(sent_at, expected) for sent_at, expected in pending[name]
+                                         if expected != status["state"]]
+                        continue
+
+                    name, state = str(message.topic).split("/")[1], message.payload.decode()
+                    now = time.perf_counter()
+                    still_pending = []
+                    for sent_at, expected in pending[name]:
+                        if expected == state:
+                            latencies.append(now - sent_at)
+                        else:
+                            still_pending.append((sent_at, expected))
+                    pending[name] = still_pending
+
+            receiver = asyncio.create_task(receive_states())
+
+            # wait for the valves to be owned and heard by the proxies
+            online_deadline = time.monotonic() + 10 + 2 * args.lease_ttl
+            while time.monotonic() < online_deadline and \
+                    (len(owners()) < len(valve_names) or
+                     sum(broker.retained.get(f"{TOPIC_PREFIX}/{name}/online") == b"online"
+                         for name in valve_names) < len(valve_names)):
+                await asyncio.sleep(0.1)
+            ownership_watcher = asyncio.create_task(watch_ownership())
+            published_before = broker.published.copy()
+            monitor.lags.clear()
+
+            started = time.perf_counter()
+            for _ in range(args.flood):
+                name = rng.choice(valve_names)
+                state = rng.choice(["open", "closed"])
+                pending[name].append((time.perf_counter(), state))
+                await client.publish(f"{TOPIC_PREFIX}/{name}/set", state)
+                sent += 1
+
+            if args.scene and args.group:
+                for name in valve_names:
+                    pending[name].append((time.perf_counter(), "open"))
+                await client.publish(f"{TOPIC_PREFIX}/group/house/set", "open")
+                sent += len(valve_names)
+            elif args.scene:
+                for name in valve_names:
+                    pending[name].append((time.perf_counter(), "open"))
+                    await client.publish(f"{TOPIC_PREFIX}/{name}/set", "open")
+                    sent += 1
+            else:
+                last_birth = started
+                while time.perf_counter() - started < args.duration:
+                    if args.kill_after is not None and killed_at is None and \
+                            time.perf_counter() - started >= args.kill_after:
+                        # the connection is lost without DISCONNECT, the broker publishes the last will
+                        killed_at = time.perf_counter()
+                        broker.drop(managers[0].mqtt_client.identifier)
+                        manager_tasks[0].cancel()
+                    if args.birth_interval and time.perf_counter() - last_birth >= args.birth_interval:
+                        last_birth = time.perf_counter()
+                        await client.publish("homeassistant/status", "online")
+                    name = rng.choice(valve_names)
+                    state = rng.choice(["open", "closed"])
+                    pending[name].append((time.perf_counter(), state))
+                    await client.publish(f"{TOPIC_PREFIX}/{name}/set", state)
+                    sent += 1
+                    await asyncio.sleep(rng.expovariate(args.rate))
+            load_elapsed = time.perf_counter() - started
+
+            deadline = time.monotonic() + args.timeout
+            while any(pending.values()) and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            elapsed = time.perf_counter() - started
+
+            receiver.cancel()
+            ownership_watcher.cancel()
+            await asyncio.gather(receiver, ownership_watcher, return_exceptions=True)
+
+        for manager, task in zip(managers, manager_tasks):
+            manager.exited.set()
+            task.cancel()
+        monitor_task.cancel()
+        await asyncio.gather(*manager_tasks, monitor_task, return_exceptions=True)
+
+        published = broker.published - published_before
+        volume = collections.Counter()
+        for topic, count in published.items():
+            volume[topic_kind(topic)] += count
+
+        unresolved = sum(len(commands) for commands in pending.values())
+        print(f"{args.valves} valves, {args.proxies} proxies, {args.slots} slots/proxy, "
+              + ("scene" if args.scene else f"{args.rate} commands/s for {args.duration:.0f}s"))
+        print(f"commands:       {sent} sent, {len(latencies)} confirmed, {sum(shed.values())} shed, "
+              f"{unresolved} superseded or unconfirmed in {elapsed:.1f}s (load {load_elapsed:.1f}s)")
+        print(f"shed:           {dict(shed) or 'none'}")
+        print(f"throughput:     {len(latencies) / elapsed * 60:.1f} confirmed commands/min")
+        print(f"command->state: {percentiles(latencies)}")
+        print(f"loop lag:       {percentiles(monitor.lags)}")
+        print(f"MQTT published: {sum(published.values())} messages "
+              f"({', '.join(f'{kind}: {count}' for kind, count in volume.most_common())})")
+        if args.instances > 1:
+            owned = [len(manager.valves) if killed_at is None or i else "killed" for i, manager in enumerate(managers)]
+            print(f"instances:      {args.instances}, valves owned: {owned}, "
+                  f"double-owned samples: {double_owned_samples}")
+            if killed_at is not None:
+                print(f"failover:       " + (f"{failed_over_at - killed_at:.3f}s" if failed_over_at else "incomplete")
+                      + f" (lease TTL {args.lease_ttl:.0f}s)")
+        if args.state_polling:
+            print(f"state polls:    {sum(manager.poller.polls for manager in managers)} done, "
+                  f"{sum(manager.poller.failed_polls for manager in managers)} failed, "
+                  f"{sum(manager.poller.drifts for manager in managers)} drifts")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+"""
+Benchmark of the valve commands against emulated valves and proxies (see `scripts/emulator.py`).
+
+    python scripts/valve-benchmark.py [--scenario NAME ...] [--valves COUNT] [--proxies COUNT] [--rounds COUNT]
+                                      [--same-state] [--state-cache-ttl SECONDS] [--group] [--restart cold|warm]
+
+Each round sends a command to every valve at the same time through `RadiatorValveSwitchManager` (proxy ranking,
+connection slots, session pool and `RadiatorValve.set_state`), alternating the desired state (or always asking
+for the same one with `--same-state`, like HA reasserting it). The command latency percentiles, the throughput
+(valves/minute) and the GATT writes per command are reported for each scenario of radio impairments.
+With `--group` each round is a single group command of all the valves, planned as a batch.
+With `--restart` the valves are first turned off by another manager, which is then replaced by a new one (cold), or
+by a new one restored from its state snapshot (warm, see `trv_controller.snapshot`), as after a deploy.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from emulator import EmulatedProxy, EmulatedValve, Impairments  # noqa: E402
+from trv_controller.radiator_valve import RadiatorValve  # noqa: E402
+from trv_controller.trv_controller import RadiatorValveSwitchManager  # noqa: E402
+
+SCENARIOS = {
+    "ideal": Impairments(),
+    "slow-radio": Impairments(connect_latency=2.0, write_latency=0.1, response_latency=0.3),
+    "fragmented": Impairments(fragment_size=6),
+    "lossy": Impairments(response_loss=0.05),
+    "flaky-connect": Impairments(connect_failure=0.1),
+    "one-slot": Impairments(connection_slots=1),
+}
+
+
+def make_config(valve_count: int, proxy_count: int, state_cache_ttl: float) -> dict:
+    proxies = [f"proxy-{i}" for i in range(proxy_count)]
+    return {
+        "mqtt": {"host": "localhost"},
+        "commands": {"state_cache_ttl": state_cache_ttl},
+        "bluetooth_proxies": [{"hostname": hostname} for hostname in proxies],
+        "radiator_valve_switches": [{
+            "name": f"valve_{i}",
+            "mac_address": RadiatorValve.int_to_mac(0x50_00_00_00_00_00 + i),
+            "bluetooth_proxies": proxies,
+        } for i in range(valve_count)],
+        "radiator_valve_groups": [{"name": "all", "valves": [f"valve_{i}" for i in range(valve_count)]}],
+    }
+
+
+def make_valves(config: dict, rng: random.Random) -> list[EmulatedValve]:
+    hostnames = [proxy["hostname"] for proxy in config["bluetooth_proxies"]]
+    return [EmulatedValve(RadiatorValve.mac_to_int(valve["mac_address"]), packet_number=rng.randint(1, 255),
+                          rssi={hostname: rng.randint(-95, -55) for hostname in hostnames})
+            for valve in config["radiator_valve_switches"]]
+
+
+def make_manager(config: dict, impairments: Impairments, rng: random.Random,
+                 valves: list[EmulatedValve]) -> RadiatorValveSwitchManager:
+    """
+    Returns a manager whose proxies are emulated and already connected, the valves RSSI being known
+    """
+    manager = RadiatorValveSwitchManager(config)
+    hostnames = [proxy["hostname"] for proxy in config["bluetooth_proxies"]]
+
+    for hostname in hostnames:
+        proxy = EmulatedProxy(hostname, valves, impairments, random.Random(rng.random()))
+        proxy.subscribe_bluetooth_le_raw_advertisements(
+            lambda response, hostname=hostname: manager.ingestor.on_raw_advertisements(hostname, response))
+        proxy.subscribe_bluetooth_connections_free(
+            lambda free, limit, *_, hostname=hostname: manager.slot_scheduler.set_reported_limit(hostname, limit))
+        manager.proxy_api_clients[hostname] = proxy
+        manager.proxy_health[hostname].api_connected = True
+        proxy.advertise()
+
+    manager._on_advertisement_batch(manager.ingestor.drain())
+    return manager
+
+
+async def run_scenario(name: str, impairments: Impairments, args) -> dict:
+    rng = random.Random(args.seed)
+    config = make_config(args.valves, args.proxies, args.state_cache_ttl)
+    valves = make_valves(config, rng)
+
+    if args.restart:
+        with tempfile.TemporaryDirectory() as directory:
+            if args.restart == "warm":
+                config["snapshot"] = {"path": os.path.join(directory, "trv_state.json")}
+            manager = make_manager(config, impairments, rng, valves)
+            async with manager.pending_commands_task_group:
+                await asyncio.gather(*(manager._execute_valve_command(valve, False) for valve in manager.valves))
+            await manager.session_pool.close_all()
+            if manager.snapshot is not None:
+                manager.snapshot.save()
+
+            manager = make_manager(config, impairments, rng, valves)
+            manager.restore_snapshot()
+    else:
+        manager = make_manager(config, impairments, rng, valves)
+
+    latencies = []
+    failures = 0
+
+    async def command(valve, turn_on: bool):
+        nonlocal failures
+        started = time.perf_counter()
+        done = await manager._execute_valve_command(valve, turn_on)
+        latencies.append(time.perf_counter() - started)
+        failures += not done
+
+    async def group_command(turn_on: bool):
+        nonlocal failures
+        started = time.perf_counter()
+        result = await manager._execute_group_command(manager.valves.groups["all"], turn_on)
+        # the valves of a batch complete at different times, the batch duration is reported for each of them
+        latencies.extend([time.perf_counter() - started] * len(manager.valves))
+        failures += len(result["failed"])
+
+    started = time.perf_counter()
+    # the group commands are run by the valve command queues, in the task group
+    async with manager.pending_commands_task_group:
+        for round_number in range(args.rounds):
+            turn_on = args.same_state or round_number % 2 == 0
+            if args.group:
+                await group_command(turn_on)
+            else:
+                await asyncio.gather(*(command(valve, turn_on) for valve in manager.valves))
+    elapsed = time.perf_counter() - started
+    await manager.session_pool.close_all()
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 \
+        else latencies * 99
+    return {
+        "scenario": name,
+        "commands": len(latencies),
+        "failures": failures,
+        "p50": quantiles[49],
+        "p90": quantiles[89],
+        "p99": quantiles[98],
+        "max": max(latencies),
+        "valves_per_minute": len(latencies) / elapsed * 60,
+        "writes_per_command": sum(proxy.writes for proxy in manager.proxy_api_clients.values()) / len(latencies),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable), all of them by default")
+    parser.add_argument("--valves", type=int, default=10)
+    parser.add_argument("--proxies", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--same-state", action="store_true", help="turn on the valves at every round")
+    parser.add_argument("--state-cache-ttl", type=float, default=300.0, help="0 disables the confirmed state cache")
+    parser.add_argument("--group", action="store_true", help="send a single group command at each round")
+    parser.add_argument("--restart", choices=["cold", "warm"], help="restart the manager before the rounds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    print(f"{args.valves} valves, {args.proxies} proxies, {args.rounds} rounds")
+    print(f"{'scenario':<14} {'commands':>8} {'failed':>6} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'max s':>7} "
+          f"{'valves/min':>10} {'writes':>6}")
+    for name in args.scenario or SCENARIOS:
+        result = await run_scenario(name, SCENARIOS[name], args)
+        print(f"{result['scenario']:<14} {result['commands']:>8} {result['failures']:>6} {result['p50']:>7.2f} "
+              f"{result['p90']:>7.2f} {result['p99']:>7.2f} {result['max']:>7.2f} "
+              f"{result['valves_per_minute']:>10.1f} {result['writes_per_command']:>6.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
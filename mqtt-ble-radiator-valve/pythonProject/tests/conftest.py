@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.insert(0, ROOT)
+# the valve emulator of the benchmarks (scripts/emulator.py) stands in for the proxies and the valves
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
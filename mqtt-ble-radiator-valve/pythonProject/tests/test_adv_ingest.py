@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+from trv_controller import adv_ingest
+from trv_controller.adv_ingest import AdvertisementIngestor
+
+VALVE = 0x500000000001
+PHONE = 0x500000000002
+
+
+def raw_advertisements(*advertisements: tuple[int, bytes]):
+    return SimpleNamespace(advertisements=[SimpleNamespace(address=address, rssi=-70, data=data)
+                                           for address, data in advertisements])
+
+
+def test_unknown_valve_named_in_its_scan_response():
+    ingestor = AdvertisementIngestor({}, lambda sightings: None)
+    ingestor.on_raw_advertisements("proxy", raw_advertisements((VALVE, b"\x02\x01\x06"), (VALVE, b"\x06\x09Vanne")))
+    assert ingestor._new_devices == {VALVE}
+
+    # reported again on its next advertisements, without searching the name
+    ingestor._new_devices.clear()
+    ingestor.on_raw_advertisements("proxy", raw_advertisements((VALVE, b"\x02\x01\x06")))
+    assert ingestor._new_devices == {VALVE}
+
+
+def test_foreign_device_searched_a_few_times_only(monkeypatch):
+    ingestor = AdvertisementIngestor({}, lambda sightings: None)
+    searches = []
+    monkeypatch.setattr(ingestor, "_search_valve_name",
+                        lambda address, data: (searches.append(address),
+                                               AdvertisementIngestor._search_valve_name(ingestor, address, data)))
+
+    for _ in range(10):
+        ingestor.on_raw_advertisements("proxy", raw_advertisements((PHONE, b"\x05\x09Pixel")))
+    assert len(searches) == adv_ingest._MAX_NAME_SEARCHES
+    assert not ingestor._new_devices
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from trv_controller.availability import AvailabilityTracker
+from trv_controller.valve_registry import ValveRegistry
+
+
+def registry_of(*timeouts: float) -> ValveRegistry:
+    return ValveRegistry([{"name": f"valve{index}", "mac_address": f"50:00:00:00:00:{index:02x}",
+                           "availability_timeout": timeout}
+                          for index, timeout in enumerate(timeouts)], "radiator_valve", "homeassistant")
+
+
+def tracker_of() -> tuple[AvailabilityTracker, list[tuple[str, bool]]]:
+    changes = []
+    return AvailabilityTracker(lambda valve, online: changes.append((valve.name, online))), changes
+
+
+def test_offline_once_the_deadline_passed():
+    async def scenario():
+        valve, = registry_of(60)
+        tracker, changes = tracker_of()
+
+        tracker.seen(valve, 1000.0)
+        tracker.seen(valve, 1030.0)
+        assert changes == [("valve0", True)]
+
+        # the deadline moved forward with the last advertisement
+        tracker.expire(1060.0)
+        assert changes == [("valve0", True)]
+        tracker.expire(1089.9)
+        assert changes == [("valve0", True)]
+        tracker.expire(1090.0)
+        assert changes == [("valve0", True), ("valve0", False)]
+
+        # an old advertisement, received late, does not move the deadline back
+        tracker.seen(valve, 2000.0)
+        tracker.seen(valve, 1950.0)
+        tracker.expire(2059.0)
+        assert changes[-1] == ("valve0", True) and tracker.transitions == 3
+
+    asyncio.run(scenario())
+
+
+def test_forgotten_valve_never_expires():
+    async def scenario():
+        valve, = registry_of(60)
+        tracker, changes = tracker_of()
+
+        tracker.seen(valve, 1000.0)
+        tracker.forget(valve)
+        tracker.expire(2000.0)
+        assert changes == [("valve0", True)] and not tracker._heap
+
+    asyncio.run(scenario())
+
+
+def test_expiry_task_woken_by_an_earlier_deadline():
+    async def scenario():
+        slow, fast = registry_of(30, 0.1)
+        tracker, changes = tracker_of()
+        exited = asyncio.Event()
+        task = asyncio.create_task(tracker.expiry_task(exited))
+
+        tracker.seen(slow, time.monotonic())
+        await asyncio.sleep(0.01)
+        # the task sleeps until the 30s deadline, a shorter one must wake it up
+        tracker.seen(fast, time.monotonic())
+        await asyncio.sleep(0.3)
+        assert changes == [("valve0", True), ("valve1", True), ("valve1", False)]
+        assert tracker.is_online(slow) and not tracker.is_online(fast)
+
+        exited.set()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(scenario())
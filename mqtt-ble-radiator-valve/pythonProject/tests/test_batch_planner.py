@@ -0,0 +1,31 @@
+from trv_controller.batch_planner import plan_batch
+
+
+def rounds(plan: dict[str, str], slots: dict[str, int]) -> int:
+    load: dict[str, int] = dict()
+    for proxy_hostname in plan.values():
+        load[proxy_hostname] = load.get(proxy_hostname, 0) + 1
+    return max(-(-count // slots[hostname]) for hostname, count in load.items())
+
+
+def test_valves_spread_according_to_the_slots():
+    slots = {"kitchen": 3, "hall": 1}
+    # every valve prefers the kitchen proxy
+    candidates = {f"valve{index}": ["kitchen", "hall"] for index in range(8)}
+
+    plan = plan_batch(candidates, slots)
+    assert len(plan) == 8 and rounds(plan, slots) == 2
+    assert list(plan.values()).count("kitchen") == 6
+
+
+def test_best_ranked_proxy_among_equal_rounds():
+    plan = plan_batch({"studio": ["near", "far"], "bedroom": ["far", "near"]}, {"near": 3, "far": 3})
+    assert plan == {"studio": "near", "bedroom": "far"}
+
+
+def test_valves_without_alternative_assigned_first():
+    slots = {"kitchen": 1, "hall": 1}
+    # the flexible valve is listed first, but the kitchen proxy is the only one reaching the other valve
+    plan = plan_batch({"flexible": ["kitchen", "hall"], "constrained": ["kitchen"], "unreachable": []}, slots)
+    assert plan == {"constrained": "kitchen", "flexible": "hall"}
+    assert rounds(plan, slots) == 1
@@ -0,0 +1,127 @@
+import asyncio
+import functools
+
+from trv_controller.command_intake import CommandIntake
+from trv_controller.valve_registry import ValveConfig
+
+
+def valve_config(name: str = "studio", index: int = 1) -> ValveConfig:
+    return ValveConfig({"name": name, "mac_address": f"50:00:00:00:{index // 256:02X}:{index % 256:02X}",
+                        "bluetooth_proxies": ["proxy"]},
+                       "ble_radiator_valve", "homeassistant")
+
+
+class SlowValve:
+    """
+    Transactions of a valve, completed by the test
+    """
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.release = asyncio.Event()
+
+    async def execute(self, desired_state: bool, proxy_hostname: str | None) -> bool:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+            return True
+        finally:
+            self.running -= 1
+
+
+def intake_of(slow_valve: SlowValve) -> CommandIntake:
+    loop = asyncio.get_running_loop()
+    return CommandIntake(lambda valve: slow_valve.execute, loop.create_task, lambda valve, state, reason: None)
+
+
+def test_valve_added_back_while_its_worker_runs():
+    async def scenario():
+        slow_valve = SlowValve()
+        intake = intake_of(slow_valve)
+
+        first = intake.submit(valve_config(), True)
+        await asyncio.sleep(0)
+        assert slow_valve.running == 1
+
+        # removed then added back before the running command completed
+        intake.remove_valve("studio")
+        second = intake.submit(valve_config(), False)
+        await asyncio.sleep(0)
+        assert intake.running == 1
+
+        slow_valve.release.set()
+        assert await first is True
+        assert await second is True
+        assert slow_valve.max_running == 1
+        await asyncio.sleep(0)
+        assert intake.running == 0
+        assert "studio" in intake.queues and not intake.queues["studio"].closing
+
+    asyncio.run(scenario())
+
+
+def test_removed_valve_queue_forgotten_when_its_worker_ends():
+    async def scenario():
+        slow_valve = SlowValve()
+        intake = intake_of(slow_valve)
+
+        command = intake.submit(valve_config(), True)
+        await asyncio.sleep(0)
+        intake.remove_valve("studio")
+        assert intake.queues["studio"].closing
+
+        slow_valve.release.set()
+        assert await command is True
+        await asyncio.sleep(0)
+        assert "studio" not in intake.queues
+
+    asyncio.run(scenario())
+
+
+def test_scene_of_all_the_valves_loses_no_command():
+    async def scenario():
+        valves = [valve_config(f"valve_{i}", i) for i in range(200)]
+        executed = []
+        shed = []
+
+        async def execute(valve: ValveConfig, desired_state: bool, proxy_hostname: str | None) -> bool:
+            await asyncio.sleep(0.001)
+            executed.append(valve.name)
+            return True
+
+        intake = CommandIntake(lambda valve: functools.partial(execute, valve), asyncio.get_running_loop().create_task,
+                               lambda valve, state, reason: shed.append(reason), lambda: len(valves))
+        results = await asyncio.gather(*(intake.submit(valve, True) for valve in valves))
+
+        assert results == [True] * len(valves)
+        assert not shed
+        assert sorted(executed) == sorted(valve.name for valve in valves)
+
+    asyncio.run(scenario())
+
+
+def test_only_stale_or_superseded_commands_are_shed():
+    async def scenario():
+        shed = []
+        intake = CommandIntake(lambda valve: SlowValve().execute, asyncio.get_running_loop().create_task,
+                               lambda valve, state, reason: shed.append((valve.name, reason)),
+                               capacity=2, max_running=0, max_age=0.05)
+
+        first = intake.submit(valve_config("a", 1), True)
+        intake.submit(valve_config("b", 2), True)
+        intake.submit(valve_config("c", 3), True)
+        assert not shed and intake.waiting == 3
+
+        # a newer command supersedes the waiting one of the same valve
+        intake.submit(valve_config("a", 1), False)
+        assert shed == [("a", "superseded")] and await first is None
+
+        # beyond the capacity the stale commands are shed right away
+        await asyncio.sleep(0.06)
+        intake.submit(valve_config("d", 4), True)
+        assert sorted(shed[1:]) == [("a", "stale"), ("b", "stale"), ("c", "stale")]
+        assert intake.waiting == 1
+
+    asyncio.run(scenario())
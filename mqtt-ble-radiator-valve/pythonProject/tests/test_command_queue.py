@@ -0,0 +1,110 @@
+import asyncio
+
+from trv_controller.command_queue import ValveCommandQueue
+
+
+class RecordingValve:
+    """
+    Transactions of a valve, recorded and completed by the test
+    """
+
+    def __init__(self):
+        self.transactions: list[tuple[bool, str | None]] = []
+        self.release = asyncio.Event()
+        self.outcome = True
+
+    async def execute(self, desired_state: bool, proxy_hostname: str | None) -> bool:
+        self.transactions.append((desired_state, proxy_hostname))
+        await self.release.wait()
+        self.release.clear()
+        return self.outcome
+
+
+def queue_of(valve: RecordingValve) -> ValveCommandQueue:
+    return ValveCommandQueue("studio", valve.execute, asyncio.get_running_loop().create_task)
+
+
+def test_burst_of_toggles_costs_two_transactions():
+    async def scenario():
+        valve = RecordingValve()
+        queue = queue_of(valve)
+
+        first = queue.submit(True)
+        await asyncio.sleep(0)
+        toggles = [queue.submit(state) for state in (False, True, False, True, False)]
+        assert queue.depth == 2
+
+        valve.release.set()
+        assert await first is True
+        await asyncio.sleep(0)
+        valve.release.set()
+        results = await asyncio.gather(*toggles)
+
+        # last writer wins: the "off" commands are superseded until the last one, applied after the running
+        # transaction, which the "on" commands join
+        assert valve.transactions == [(True, None), (False, None)]
+        assert results == [None, True, None, True, True]
+        assert queue.coalesced == 2 and queue.satisfied == 2 and queue.executed == 2
+        await asyncio.sleep(0)
+        assert not queue.running and queue.depth == 0
+
+    asyncio.run(scenario())
+
+
+def test_command_already_applied_by_the_running_transaction():
+    async def scenario():
+        valve = RecordingValve()
+        queue = queue_of(valve)
+
+        first = queue.submit(True, "proxy")
+        await asyncio.sleep(0)
+        second = queue.submit(True)
+        assert queue.satisfied == 1 and queue.depth == 1
+
+        valve.outcome = False
+        valve.release.set()
+        assert await first is False and await second is False
+        assert valve.transactions == [(True, "proxy")]
+        assert queue.failed == 1
+
+    asyncio.run(scenario())
+
+
+def test_same_state_commands_share_the_pending_transaction():
+    async def scenario():
+        valve = RecordingValve()
+        queue = queue_of(valve)
+
+        running = queue.submit(False)
+        await asyncio.sleep(0)
+        pending = [queue.submit(True, "proxy"), queue.submit(True)]
+
+        valve.release.set()
+        await running
+        await asyncio.sleep(0)
+        valve.release.set()
+        assert await asyncio.gather(*pending) == [True, True]
+        # the proxy of the latest command is used
+        assert valve.transactions == [(False, None), (True, None)]
+
+    asyncio.run(scenario())
+
+
+def test_rebind_applies_from_the_next_command():
+    async def scenario():
+        valve, other = RecordingValve(), RecordingValve()
+        queue = queue_of(valve)
+
+        first = queue.submit(True)
+        await asyncio.sleep(0)
+        queue.rebind(other.execute)
+        second = queue.submit(False)
+
+        valve.release.set()
+        await first
+        await asyncio.sleep(0)
+        other.release.set()
+        await second
+        assert valve.transactions == [(True, None)] and other.transactions == [(False, None)]
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import asyncio
+import os
+
+import yaml
+
+from trv_controller.config_watcher import ConfigWatcher
+
+CONFIG = {"bluetooth_proxies": [{"hostname": "proxy"}]}
+
+
+def write_config(path, config, mtime: int):
+    with open(path, "w") as file:
+        file.write(config if isinstance(config, str) else yaml.safe_dump(config))
+    # a quick rewrite may keep the modification time on a coarse file system clock
+    os.utime(path, (mtime, mtime))
+
+
+def watcher_of(path, on_change=None) -> tuple[ConfigWatcher, list[dict]]:
+    applied = []
+
+    async def record(config):
+        applied.append(config)
+
+    write_config(path, CONFIG, 1000)
+    return ConfigWatcher(str(path), CONFIG, on_change or record), applied
+
+
+def test_modified_config_applied_once(tmp_path):
+    async def scenario():
+        path = tmp_path / "config.yaml"
+        watcher, applied = watcher_of(path)
+        await watcher.check()
+
+        # same content rewritten: nothing to apply
+        write_config(path, CONFIG, 2000)
+        await watcher.check()
+        assert applied == []
+
+        config = {"bluetooth_proxies": [{"hostname": "proxy"}, {"hostname": "other"}]}
+        write_config(path, config, 3000)
+        await watcher.check()
+        await watcher.check()
+        assert applied == [config] and watcher.config == config and watcher.reloads == 1
+
+    asyncio.run(scenario())
+
+
+def test_invalid_config_keeps_the_running_one(tmp_path):
+    async def scenario():
+        path = tmp_path / "config.yaml"
+        watcher, applied = watcher_of(path)
+
+        for mtime, content in enumerate(("bluetooth_proxies: [", "- not a mapping\n"), start=2000):
+            write_config(path, content, mtime)
+            await watcher.check()
+        os.remove(path)
+        await watcher.check()
+        assert applied == [] and watcher.config == CONFIG and watcher.errors == 2
+
+        # fixed
+        config = {"bluetooth_proxies": []}
+        write_config(path, config, 3000)
+        await watcher.check()
+        assert applied == [config]
+
+    asyncio.run(scenario())
+
+
+def test_rejected_config_not_recorded(tmp_path):
+    async def scenario():
+        path = tmp_path / "config.yaml"
+
+        async def reject(config):
+            raise ValueError("Duplicated valve name or MAC address in `radiator_valve_switches`")
+
+        watcher, _ = watcher_of(path, reject)
+        write_config(path, {"bluetooth_proxies": []}, 2000)
+        await watcher.check()
+        assert watcher.config == CONFIG and watcher.errors == 1 and watcher.reloads == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+from trv_controller.flight_recorder import DATA_SIZE, RECORD_SIZE, FlightRecorder, FrameRing
+
+STUDIO = 0x500000000001
+KITCHEN = 0x50000000000A
+
+
+def test_ring_keeps_the_last_records():
+    ring = FrameRing(4)
+    assert len(ring) == 0 and ring.records() == []
+
+    for packet_number in range(1, 11):
+        ring.record(FrameRing.SENT, STUDIO, value=packet_number, code=0x41)
+    # preallocated, never grown
+    assert len(ring) == 4 and len(ring._buffer) == 4 * RECORD_SIZE
+
+    records = ring.records()
+    assert [record["value"] for record in records] == [7, 8, 9, 10]
+    assert records[0]["kind"] == "sent" and records[0]["address"] == "50:00:00:00:00:01"
+    assert records[0]["code"] == 0x41
+
+
+def test_long_data_truncated():
+    ring = FrameRing(2)
+    ring.record(FrameRing.RECEIVED, STUDIO, data=bytearray(range(DATA_SIZE + 10)))
+    ring.record(FrameRing.RECEIVED, STUDIO, data=b"\xaa\x55")
+
+    long, short = ring.records()
+    assert long["data"] == bytes(range(DATA_SIZE)).hex() and long["truncated"]
+    assert short["data"] == "aa55" and not short["truncated"]
+
+
+def test_valve_dump_with_its_advertisements_only():
+    recorder = FlightRecorder(valve_records=8, proxy_records=8)
+    recorder.valve_ring(STUDIO).record(FrameRing.TIMEOUT, STUDIO, value=12)
+    recorder.valve_ring(KITCHEN).record(FrameRing.TIMEOUT, KITCHEN, value=3)
+    for address in (STUDIO, KITCHEN, STUDIO):
+        recorder.proxy_ring("proxy").record(FrameRing.ADVERTISEMENT, address, value=-70)
+
+    names = {STUDIO: "studio", KITCHEN: "kitchen"}
+    dump = recorder.dump(names, "studio")
+    assert list(dump["valves"]) == ["studio"] and dump["valves"]["studio"][0]["kind"] == "timeout"
+    assert [record["address"] for record in dump["proxies"]["proxy"]] == ["50:00:00:00:00:01"] * 2
+
+    dump = recorder.dump(names, "proxy")
+    assert dump["valves"] == {} and len(dump["proxies"]["proxy"]) == 3
+    dump = recorder.dump(names)
+    assert sorted(dump["valves"]) == ["kitchen", "studio"] and len(dump["proxies"]["proxy"]) == 3
+
+
+def test_failure_dump_replaces_the_previous_one(tmp_path):
+    async def scenario():
+        recorder = FlightRecorder(valve_records=8, dump_dir=str(tmp_path / "dumps"))
+        ring = recorder.valve_ring(STUDIO)
+
+        for packet_number in (1, 2):
+            ring.record(FrameRing.TIMEOUT, STUDIO, value=packet_number)
+            path, records = await recorder.dump_to_file({STUDIO: "studio"}, "studio", failure=True)
+            assert records == packet_number
+
+        assert [file.name for file in (tmp_path / "dumps").iterdir()] == ["flight-recorder-studio-failure.json"]
+        with open(path) as file:
+            assert len(json.load(file)["valves"]["studio"]) == 2
+
+    asyncio.run(scenario())
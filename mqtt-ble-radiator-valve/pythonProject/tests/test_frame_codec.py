@@ -0,0 +1,130 @@
+import random
+
+from trv_controller.frame_codec import STUFFED_AA, FrameDecoder, FrameTemplate, encode_frame
+
+FRAGMENT_SIZE = 20  # default ATT MTU payload
+FUZZ_ITERATIONS = 1000
+
+SETPOINT_7 = bytes([0x46, 0x00, 0x46, 0x00] + [0] * 8)
+
+# frames encoded by the original `calculate_checksum`, which leaves the 0x55 bytes out of the sum
+KNOWN_FRAMES = [
+    (0x0C, 0x55, b"", "aaaa070c0000550c"),
+    (0x01, 0x55, b"", "aaaa070100005501"),
+    (0x0C, 0x21, bytes([0x5E, 0x01, 0x5E, 0x01] + [0] * 8), "aaaa130c0000215e015e010000000000000000eb"),
+    (0x0C, 0x55, SETPOINT_7, "aaaa130c00005546004600000000000000000098"),
+]
+
+
+def stuffed_checksum_frame() -> bytes:
+    # a frame whose checksum is 0xAA, i.e. ending with the stuffed `AA 55`
+    frames = (encode_frame(0x0C, packet_number, b"\x5e\x01") for packet_number in range(1, 256))
+    return next(frame for frame in frames if frame.endswith(STUFFED_AA))
+
+
+def test_escape_byte_with_the_next_frame():
+    first = stuffed_checksum_frame()
+    second = encode_frame(0x0C, 3, b"\x5e\x01")
+    decoder = FrameDecoder()
+
+    # the escape byte of the checksum arrives with the next frame, a whole frame without stuffing (fast path)
+    decoded = decoder.feed(first[:-1]) + decoder.feed(STUFFED_AA[1:] + second)
+
+    assert [(frame.packet_number, bytes(frame.payload)) for frame in decoded] == \
+        [(first[6], b"\x5e\x01"), (3, b"\x5e\x01")]
+    assert decoder.checksum_errors == 0
+
+
+def test_checksum_leaves_out_0x55():
+    for function, packet_number, payload, expected in KNOWN_FRAMES:
+        assert encode_frame(function, packet_number, payload).hex() == expected
+        assert FrameTemplate(function, payload).encode(packet_number).hex() == expected
+
+        frames = FrameDecoder().feed(bytes.fromhex(expected))
+        assert [(frame.function, frame.packet_number, bytes(frame.payload)) for frame in frames] == \
+            [(function, packet_number, payload)]
+
+
+def random_frame(rnd: random.Random) -> tuple[int, int, bytes]:
+    payload = bytes(rnd.choice([0xAA, 0x55, 0x00, 0xFF, rnd.randrange(256)]) for _ in range(rnd.randint(0, 16)))
+    return rnd.choice([0x01, 0x0C, 0xAA, 0xFF]), rnd.randrange(1, 256), payload
+
+
+def random_stream(rnd: random.Random) -> tuple[list[tuple[int, int, bytes]], list[bytes]]:
+    frames = [random_frame(rnd) for _ in range(rnd.randint(1, 8))]
+    encoded = [FrameTemplate(function, payload).encode(packet_number) if rnd.random() < 0.5
+               else encode_frame(function, packet_number, payload)
+               for function, packet_number, payload in frames]
+    return frames, encoded
+
+
+def fragment(stream: bytes, rnd: random.Random) -> list[bytes]:
+    fragments = []
+    while stream:
+        size = rnd.randint(1, FRAGMENT_SIZE)
+        fragments.append(stream[:size])
+        stream = stream[size:]
+    return fragments
+
+
+def decode(fragments: list[bytes]) -> tuple[list[tuple[int, int, bytes]], FrameDecoder]:
+    decoder = FrameDecoder()
+    decoded = [(frame.function, frame.packet_number, bytes(frame.payload))
+               for value in fragments for frame in decoder.feed(value)]
+    return decoded, decoder
+
+
+def test_fuzz_fragmented_streams():
+    rnd = random.Random(0)
+    for _ in range(FUZZ_ITERATIONS):
+        frames, encoded = random_stream(rnd)
+        stream = b"".join(encoded)
+
+        decoded, decoder = decode(fragment(stream, rnd))
+        assert decoded == frames, f"Decoding mismatch for stream {stream.hex()}"
+        assert decoder.checksum_errors == 0
+
+
+def test_fuzz_escape_byte_with_the_next_frame():
+    rnd = random.Random(1)
+    for _ in range(FUZZ_ITERATIONS):
+        frames, encoded = random_stream(rnd)
+
+        # a notification per frame, the escape byte of a stuffed 0xAA checksum coming with the next frame
+        notifications = []
+        carry = b""
+        for frame in encoded:
+            frame, carry = carry + frame, b""
+            if frame.endswith(STUFFED_AA) and rnd.random() < 0.5:
+                frame, carry = frame[:-1], frame[-1:]
+            notifications.append(frame)
+        if carry:
+            notifications.append(carry)
+
+        decoded, decoder = decode(notifications)
+        assert decoded == frames, f"Decoding mismatch for notifications {[value.hex() for value in notifications]}"
+        assert decoder.checksum_errors == 0
+
+
+def test_fuzz_corrupted_streams():
+    rnd = random.Random(2)
+    spurious = 0
+    for _ in range(FUZZ_ITERATIONS):
+        frames, encoded = random_stream(rnd)
+
+        # garbage between the frames and a corrupted byte
+        corrupted = bytearray()
+        for frame in encoded:
+            if rnd.random() < 0.3:
+                corrupted += bytes(rnd.randrange(256) for _ in range(rnd.randint(1, 4)))
+            corrupted += frame
+        corrupted[rnd.randrange(len(corrupted))] = rnd.randrange(256)
+
+        # at most the corrupted frame and its neighbour are lost
+        decoded, _ = decode(fragment(bytes(corrupted), rnd))
+        assert len(frames) - len([frame for frame in decoded if frame in frames]) <= 2, \
+            f"Frames lost in stream {corrupted.hex()}"
+        spurious += sum(1 for frame in decoded if frame not in frames)
+
+    # a corrupted frame passes the 8 bits checksum once in a while
+    assert spurious < FUZZ_ITERATIONS / 100
@@ -0,0 +1,77 @@
+import asyncio
+
+from trv_controller.metrics import MetricFamily, MetricsRegistry, MetricsServer
+
+
+def test_prometheus_text_output():
+    registry = MetricsRegistry()
+    commands = MetricFamily("trv_commands_total", "counter", "Commands by outcome", ("valve", "outcome"))
+    latency = MetricFamily("trv_phase_seconds", "histogram", "Phase latency", ("phase",))
+    registry.register(commands, latency)
+    registry.add_callback("trv_online_valves", "gauge", "Online valves", lambda: [((), 3)])
+
+    commands.labels('studio "north"', "confirmed").inc()
+    commands.labels('studio "north"', "confirmed").inc()
+    histogram = latency.labels("connect")
+    for value in (0.005, 0.01, 0.3, 60.0):
+        histogram.observe(value)
+
+    lines = registry.render().splitlines()
+    assert lines[:3] == [
+        "# HELP trv_commands_total Commands by outcome",
+        "# TYPE trv_commands_total counter",
+        'trv_commands_total{valve="studio \\"north\\"",outcome="confirmed"} 2',
+    ]
+    # cumulative buckets, the upper bound included
+    assert 'trv_phase_seconds_bucket{phase="connect",le="0.01"} 2' in lines
+    assert 'trv_phase_seconds_bucket{phase="connect",le="0.25"} 2' in lines
+    assert 'trv_phase_seconds_bucket{phase="connect",le="0.5"} 3' in lines
+    assert 'trv_phase_seconds_bucket{phase="connect",le="30.0"} 3' in lines
+    assert 'trv_phase_seconds_bucket{phase="connect",le="+Inf"} 4' in lines
+    assert 'trv_phase_seconds_count{phase="connect"} 4' in lines
+    assert lines[-1] == "trv_online_valves 3.0"
+
+
+def test_failing_callback_skipped():
+    registry = MetricsRegistry()
+    registry.add_callback("trv_broken", "gauge", "Broken", lambda: [((), 1 / 0)])
+    registry.add_callback("trv_valves", "gauge", "Valves", lambda: [(("studio",), 1)], ("valve",))
+
+    output = registry.render()
+    assert 'trv_valves{valve="studio"} 1.0' in output
+
+
+def test_timer_observes_the_successful_blocks_only():
+    histogram = MetricFamily("trv_phase_seconds", "histogram", "Phase latency").labels()
+    with histogram.time():
+        pass
+    try:
+        with histogram.time():
+            raise TimeoutError()
+    except TimeoutError:
+        pass
+    assert histogram.count == 1
+
+
+def test_metrics_served_over_http():
+    async def scenario():
+        registry = MetricsRegistry()
+        registry.add_callback("trv_online_valves", "gauge", "Online valves", lambda: [((), 3)])
+        metrics_server = MetricsServer(registry)
+        server = await asyncio.start_server(metrics_server._handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async def get(path: str) -> bytes:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        async with server:
+            response = await get("/metrics")
+            assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+            assert response.endswith(b"\r\n\r\n" + registry.render().encode())
+            assert (await get("/")).startswith(b"HTTP/1.1 404 Not Found\r\n")
+
+    asyncio.run(scenario())
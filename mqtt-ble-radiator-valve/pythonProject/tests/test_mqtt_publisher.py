@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+from trv_controller.mqtt_publisher import CoalescingPublisher
+from trv_controller.valve_registry import ValveRegistry
+
+
+class RecordingClient:
+    def __init__(self):
+        self.messages: list[tuple[str, str, bool]] = []
+
+    async def publish(self, topic, payload=None, retain=False, **kwargs):
+        self.messages.append((topic, payload, retain))
+
+
+def publisher_of(attributes: dict) -> tuple[CoalescingPublisher, ValveRegistry]:
+    registry = ValveRegistry([{"name": "studio", "mac_address": "50:00:00:00:00:01"}],
+                             "radiator_valve", "homeassistant")
+    return CoalescingPublisher(lambda valve: attributes[valve.name], rssi_threshold=2.0), registry
+
+
+def test_small_rssi_moves_coalesced():
+    async def scenario():
+        attributes = {"studio": ({"proxy": -70.0}, {"state": "on"})}
+        publisher, registry = publisher_of(attributes)
+        studio = registry.by_name["studio"]
+        client = RecordingClient()
+
+        # many advertisements between two flushes cost a single message
+        for _ in range(10):
+            publisher.mark_attributes_dirty(studio)
+        await publisher.flush(client)
+        assert client.messages == [(studio.attributes_topic, json.dumps({"proxy RSSI": "-70 dBm", "state": "on"}),
+                                    False)]
+
+        attributes["studio"] = ({"proxy": -71.5}, {"state": "on"})
+        publisher.mark_attributes_dirty(studio)
+        await publisher.flush(client)
+        assert len(client.messages) == 1 and publisher.suppressed == 1
+
+        # moved by the threshold, or a new proxy, or another attribute changed
+        for rssi_map, other in [({"proxy": -72.0}, {"state": "on"}),
+                                ({"proxy": -72.0, "other": -80.0}, {"state": "on"}),
+                                ({"proxy": -72.0, "other": -80.0}, {"state": "off"})]:
+            attributes["studio"] = (rssi_map, other)
+            publisher.mark_attributes_dirty(studio)
+            await publisher.flush(client)
+        assert len(client.messages) == 4 and publisher.published == 4
+
+        # nothing dirty, nothing published
+        await publisher.flush(client)
+        assert len(client.messages) == 4
+
+    asyncio.run(scenario())
+
+
+def test_availability_published_on_change_only():
+    async def scenario():
+        publisher, registry = publisher_of({})
+        studio = registry.by_name["studio"]
+        client = RecordingClient()
+
+        publisher.set_availability(studio, False)
+        publisher.set_availability(studio, True)
+        await publisher.flush(client)
+        assert client.messages == [(studio.availability_topic, "online", True)]
+
+        publisher.set_availability(studio, True)
+        await publisher.flush(client)
+        assert len(client.messages) == 1
+
+        # back and forth between two flushes: nothing to publish
+        publisher.set_availability(studio, False)
+        publisher.set_availability(studio, True)
+        await publisher.flush(client)
+        assert len(client.messages) == 1
+
+    asyncio.run(scenario())
+
+
+def test_everything_published_again_after_reset():
+    async def scenario():
+        attributes = {"studio": ({"proxy": -70.0}, {})}
+        publisher, registry = publisher_of(attributes)
+        studio = registry.by_name["studio"]
+        client = RecordingClient()
+
+        publisher.set_availability(studio, True)
+        publisher.mark_attributes_dirty(studio)
+        await publisher.flush(client)
+
+        publisher.reset()
+        publisher.set_availability(studio, True)
+        publisher.mark_attributes_dirty(studio)
+        await publisher.flush(client)
+        assert [topic for topic, _, _ in client.messages] == [studio.availability_topic, studio.attributes_topic] * 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import asyncio
+
+from emulator import EmulatedProxy, EmulatedValve, Impairments
+from trv_controller.radiator_valve import RadiatorValve
+from trv_controller.session_pool import ValveSessionPool
+
+MAC = "50:00:00:00:00:01"
+INSTANT = Impairments(connect_latency=0, write_latency=0, response_latency=0, jitter=0)
+
+
+def emulated(packet_number: int) -> tuple[EmulatedValve, EmulatedProxy]:
+    valve = EmulatedValve(RadiatorValve.mac_to_int(MAC), packet_number=packet_number)
+    return valve, EmulatedProxy("proxy", [valve], INSTANT)
+
+
+def test_sync_from_the_last_known_packet_number():
+    async def scenario():
+        emulated_valve, proxy = emulated(packet_number=100)
+        valve = RadiatorValve(MAC, proxy)
+        valve.last_valve_packet_number = 100
+
+        await valve.connect()
+        assert valve.got_packet_number and valve.current_packet_number == 101
+        assert valve.sync_round_trips == 1
+        assert emulated_valve.rejected == 0
+
+    asyncio.run(scenario())
+
+
+def test_sync_jumps_to_the_reported_packet_number():
+    async def scenario():
+        emulated_valve, proxy = emulated(packet_number=200)
+        valve = RadiatorValve(MAC, proxy)
+
+        # a wrong guess: the rejection carries the packet number of the valve, the next guess follows it
+        valve.last_valve_packet_number = 17
+        await valve.connect()
+        assert valve.current_packet_number == 201
+        assert valve.sync_round_trips == 2
+        assert emulated_valve.rejected == 1
+
+    asyncio.run(scenario())
+
+
+def test_packet_number_kept_across_sessions():
+    async def scenario():
+        emulated_valve, proxy = emulated(packet_number=50)
+        pool = ValveSessionPool()
+
+        valve = await pool.get("proxy", proxy, MAC)
+        async with valve.lock:
+            await valve.connect()
+        assert valve.sync_round_trips == 2
+        await pool.close_all()
+
+        # the next session, through another proxy, starts from the last packet number accepted by the valve
+        other_proxy = EmulatedProxy("other-proxy", [emulated_valve], INSTANT)
+        valve = await pool.get("other-proxy", other_proxy, MAC)
+        async with valve.lock:
+            await valve.connect()
+        assert valve.sync_round_trips == 1
+        assert valve.current_packet_number == emulated_valve.packet_number
+
+    asyncio.run(scenario())
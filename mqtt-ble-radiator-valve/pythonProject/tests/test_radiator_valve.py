@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+from aioesphomeapi import APIConnectionError, BluetoothConnectionDroppedError
+from aioesphomeapi.core import SocketClosedAPIError, TimeoutAPIError
+
+from trv_controller.frame_codec import encode_frame
+from trv_controller.radiator_valve import RadiatorValve
+
+TEMPERATURE = RadiatorValve.TEMPERATURE_FUNCTION_CODE
+
+
+class NullClient:
+    """
+    Proxy API client accepting the connections and the GATT writes, the responses being fed by the test
+    """
+
+    def __init__(self, connect_error: Exception | None = None):
+        self.connect_error = connect_error
+
+    async def bluetooth_device_connect(self, address, on_state, **kwargs):
+        if self.connect_error is not None:
+            raise self.connect_error
+        return lambda: None
+
+    async def bluetooth_gatt_start_notify(self, address, handle, on_bluetooth_gatt_notify, **kwargs):
+        async def remove():
+            pass
+        return remove, None
+
+    async def bluetooth_gatt_write(self, **kwargs):
+        pass
+
+    async def bluetooth_device_disconnect(self, address):
+        pass
+
+
+def silent_valve(cli: NullClient) -> RadiatorValve:
+    valve = RadiatorValve("50:00:00:00:00:01", cli)
+    valve.max_tries = 1
+    valve.sync_max_guided_attempts = 1
+    valve.sync_max_probes = 1
+    valve.sync_probe_timeout = 0.01
+    return valve
+
+
+def test_late_response_is_dropped():
+    async def scenario():
+        valve = RadiatorValve("50:00:00:00:00:01", NullClient())
+        valve.current_packet_number = 10
+
+        first = await valve._send_request(TEMPERATURE, response_timeout=0.01)
+        with pytest.raises(TimeoutError):
+            await first
+        second = await valve._send_request(TEMPERATURE, response_timeout=1)
+
+        # the response to the first request (packet 11) arrives after its timeout
+        valve.on_bluetooth_gatt_notify(None, encode_frame(TEMPERATURE, 11, b"\xc8\x00"))
+        assert not second.done()
+
+        valve.on_bluetooth_gatt_notify(None, encode_frame(TEMPERATURE, 12, b"\x5e\x01"))
+        response = await second
+        assert response.packet_number == 12
+        assert bytes(response.payload) == b"\x5e\x01"
+
+    asyncio.run(scenario())
+
+
+def test_rejection_answers_the_oldest_pending_request():
+    async def scenario():
+        valve = RadiatorValve("50:00:00:00:00:01", NullClient())
+        valve.current_packet_number = 10
+
+        first = await valve._send_request(TEMPERATURE, response_timeout=1)
+        second = await valve._send_request(TEMPERATURE, response_timeout=1)
+
+        # the error frame carries the packet number of the valve
+        valve.on_bluetooth_gatt_notify(None, encode_frame(0xFF, 42))
+        assert (await first).is_error
+        assert not second.done()
+        assert valve.reported_packet_number == 42
+        second.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_proxy_error_only_for_the_proxy_failures():
+    async def scenario():
+        # the valve does not answer (e.g. out of range): the proxy is not responsible
+        valve = silent_valve(NullClient())
+        assert not await valve.set_state(True)
+        assert valve.proxy_error is None
+
+        # the BLE connection cannot be opened through the proxy
+        valve = silent_valve(NullClient(APIConnectionError("no free connection slot")))
+        assert not await valve.set_state(True)
+        assert isinstance(valve.proxy_error, APIConnectionError)
+
+        # the proxy API connection is lost
+        valve = silent_valve(NullClient(SocketClosedAPIError("connection closed")))
+        assert not await valve.set_state(True)
+        assert isinstance(valve.proxy_error, SocketClosedAPIError)
+
+    asyncio.run(scenario())
+
+
+def test_valve_connect_errors_are_not_proxy_errors():
+    async def scenario():
+        # out of range or busy valve, and a GATT connection dropped by the valve
+        for error in (TimeoutAPIError("connect timeout"), BluetoothConnectionDroppedError("disconnected")):
+            valve = silent_valve(NullClient(error))
+            assert not await valve.set_state(True)
+            assert valve.proxy_error is None
+
+    asyncio.run(scenario())
+
+
+def test_budget_exhaustion_is_not_a_proxy_error():
+    async def scenario():
+        valve = silent_valve(NullClient())
+        with pytest.raises(TimeoutError):
+            await valve.connect(deadline=asyncio.get_running_loop().time() - 1)
+        assert valve.proxy_error is None
+        assert not valve.connected
+
+    asyncio.run(scenario())
+
+
+def test_response_timeout_follows_the_response_time():
+    valve = RadiatorValve("50:00:00:00:00:01", NullClient())
+    assert valve.response_timeout() == valve.default_response_timeout
+
+    # 4 times the smoothed response time, clamped
+    valve._record_response_time(0.5)
+    assert valve.response_timeout() == 2.0
+    valve._record_response_time(1.5)
+    assert valve.response_time == 0.8 * 0.5 + 0.2 * 1.5
+    assert valve.response_timeout() == 4 * valve.response_time
+
+    valve.response_time = 0.01
+    assert valve.response_timeout() == valve.min_response_timeout
+    valve.response_time = 30.0
+    assert valve.response_timeout() == valve.default_response_timeout
+
+
+def test_retry_delay_backs_off_exponentially():
+    valve = RadiatorValve("50:00:00:00:00:01", NullClient())
+    valve.response_time = 0.5
+    for failed_attempts, delay in ((1, 1.0), (2, 2.0), (3, 4.0), (4, valve.retry_max_delay)):
+        for _ in range(20):
+            assert delay / 2 <= valve.retry_delay(failed_attempts) <= delay
+
+
+def test_waits_capped_by_the_command_budget():
+    async def scenario():
+        valve = RadiatorValve("50:00:00:00:00:01", NullClient())
+        valve.current_packet_number = 10
+        valve._deadline = asyncio.get_running_loop().time() + 0.05
+
+        assert valve._timeout(10) <= 0.05
+        response = await valve._send_request(TEMPERATURE)
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(response, 1)
+
+        # the retry pause ends with the budget
+        started = asyncio.get_running_loop().time()
+        await valve._retry_pause(10)
+        assert asyncio.get_running_loop().time() - started < 0.5
+        assert valve._budget_exhausted()
+        with pytest.raises(TimeoutError):
+            valve._timeout(10)
+
+    asyncio.run(scenario())
@@ -0,0 +1,119 @@
+import asyncio
+
+from trv_controller.radiator_valve import RadiatorValve
+from trv_controller.session_pool import ValveSessionPool
+
+
+class DisconnectingClient:
+    """
+    Proxy API client recording the BLE disconnections
+    """
+
+    def __init__(self):
+        self.disconnected: list[int] = []
+
+    async def bluetooth_device_disconnect(self, address):
+        self.disconnected.append(address)
+
+
+def mac(index: int) -> str:
+    return f"50:00:00:00:00:{index:02X}"
+
+
+async def connected_session(pool: ValveSessionPool, cli, index: int, proxy_hostname: str = "proxy") -> RadiatorValve:
+    valve = await pool.get(proxy_hostname, cli, mac(index))
+    valve.connected = True
+    return valve
+
+
+def test_session_reused_between_commands():
+    async def scenario():
+        pool = ValveSessionPool()
+        cli = DisconnectingClient()
+        closed = []
+        pool.on_session_closed = closed.append
+
+        valve = await connected_session(pool, cli, 1)
+        assert valve.keep_connected
+        assert await pool.get("proxy", cli, mac(1)) is valve
+        assert pool.is_connected("proxy", mac(1))
+        assert pool.connected_count("proxy") == 1
+        assert not cli.disconnected and not closed
+
+        # another proxy is another session
+        assert await pool.get("other-proxy", cli, mac(1)) is not valve
+        assert len(pool) == 2
+
+        # a new API client of the proxy (reconnection) cannot reuse the GATT session
+        new_cli = DisconnectingClient()
+        assert await pool.get("proxy", new_cli, mac(1)) is not valve
+        assert cli.disconnected == [valve.mac_address_int] and closed == ["proxy"]
+
+    asyncio.run(scenario())
+
+
+def test_least_recently_used_session_evicted_over_capacity():
+    async def scenario():
+        pool = ValveSessionPool(max_sessions=2)
+        cli = DisconnectingClient()
+
+        first = await connected_session(pool, cli, 1)
+        await connected_session(pool, cli, 2)
+        pool.touch("proxy", first)
+        await connected_session(pool, cli, 3)
+
+        assert len(pool) == 2
+        assert cli.disconnected == [RadiatorValve.mac_to_int(mac(2))]
+        assert pool.is_connected("proxy", mac(1)) and pool.is_connected("proxy", mac(3))
+
+    asyncio.run(scenario())
+
+
+def test_busy_session_not_evicted():
+    async def scenario():
+        pool = ValveSessionPool(idle_timeout=0.0, max_sessions=1)
+        cli = DisconnectingClient()
+
+        busy = await connected_session(pool, cli, 1)
+        async with busy.lock:
+            # a command is running on the first valve: the session of the second one is not kept in the pool
+            other = await pool.get("proxy", cli, mac(2))
+            assert not other.keep_connected
+            await pool.evict_idle()
+            assert len(pool) == 1 and pool.is_connected("proxy", mac(1))
+
+        await pool.evict_idle()
+        assert len(pool) == 0 and cli.disconnected == [RadiatorValve.mac_to_int(mac(1))]
+
+    asyncio.run(scenario())
+
+
+def test_idle_session_closed_after_the_idle_timeout():
+    async def scenario():
+        pool = ValveSessionPool(idle_timeout=0.05)
+        cli = DisconnectingClient()
+
+        await connected_session(pool, cli, 1)
+        await pool.evict_idle()
+        assert len(pool) == 1
+
+        await asyncio.sleep(0.06)
+        await pool.evict_idle()
+        assert len(pool) == 0 and cli.disconnected == [RadiatorValve.mac_to_int(mac(1))]
+
+    asyncio.run(scenario())
+
+
+def test_sessions_of_a_lost_proxy_forgotten():
+    async def scenario():
+        pool = ValveSessionPool()
+        cli = DisconnectingClient()
+        valve = await connected_session(pool, cli, 1)
+        await connected_session(pool, cli, 2, "other-proxy")
+
+        pool.drop_proxy("proxy")
+        assert not valve.connected and not valve.keep_connected
+        assert pool.connected_count("proxy") == 0 and pool.connected_count("other-proxy") == 1
+        assert not cli.disconnected
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+import json
+import time
+
+from trv_controller.sharding import ShardCoordinator
+
+VALVES = [f"valve{index}" for index in range(60)]
+
+
+def coordinator_of(instance_id: str) -> ShardCoordinator:
+    """
+    A coordinator whose lease is renewed and whose claims can start
+    """
+    coordinator = ShardCoordinator(instance_id, "radiator_valve", lambda: None)
+    coordinator._renewed_at = time.monotonic()
+    coordinator._claims_from = time.monotonic()
+    return coordinator
+
+
+def lease_of(coordinator: ShardCoordinator) -> bytes:
+    return json.dumps({"expires": time.time() + coordinator.lease_ttl, "valves": sorted(coordinator.owned)}).encode()
+
+
+def settle(coordinators: list[ShardCoordinator]) -> dict[str, str]:
+    """
+    Exchanges the lease records until no ownership changes, returns the owner by valve name
+    """
+    for _ in range(len(coordinators) + 1):
+        for coordinator in coordinators:
+            coordinator.set_valves(VALVES)
+            for other in coordinators:
+                coordinator.on_lease(other.instance_id, lease_of(other))
+    owners = {valve_name: coordinator.instance_id for coordinator in coordinators for valve_name in coordinator.owned}
+    assert sum(len(coordinator.owned) for coordinator in coordinators) == len(owners)
+    return owners
+
+
+def test_every_valve_owned_by_a_single_instance():
+    coordinators = [coordinator_of(f"instance{index}") for index in range(3)]
+    owners = settle(coordinators)
+
+    assert sorted(owners) == sorted(VALVES)
+    assert all(len(coordinator.owned) > 5 for coordinator in coordinators)
+
+
+def test_only_the_valves_of_the_new_or_dead_instance_move():
+    coordinators = [coordinator_of(f"instance{index}") for index in range(3)]
+    owners = settle(coordinators)
+
+    joined = coordinators + [coordinator_of("instance3")]
+    owners_after_join = settle(joined)
+    moved = {valve_name for valve_name in VALVES if owners_after_join[valve_name] != owners[valve_name]}
+    assert moved and all(owners_after_join[valve_name] == "instance3" for valve_name in moved)
+
+    # instance1 dies: its lease record is deleted by the broker
+    survivors = [coordinator for coordinator in joined if coordinator.instance_id != "instance1"]
+    for coordinator in survivors:
+        coordinator.on_lease("instance1", b"")
+    owners_after_death = settle(survivors)
+    moved = {valve_name for valve_name in VALVES if owners_after_death[valve_name] != owners_after_join[valve_name]}
+    assert sorted(moved) == sorted(valve_name for valve_name, owner in owners_after_join.items()
+                                   if owner == "instance1")
+
+
+def test_valve_claimed_once_released_by_its_owner():
+    first = coordinator_of("instance0")
+    first.set_valves(VALVES)
+    assert first.owned == frozenset(VALVES)
+
+    second = coordinator_of("instance1")
+    second.on_lease("instance0", lease_of(first))
+    second.set_valves(VALVES)
+    # its valves are still listed in the record of the first instance
+    assert second.owned == frozenset()
+
+    first.on_lease("instance1", lease_of(second))
+    second.on_lease("instance0", lease_of(first))
+    assert second.owned and not second.owned & first.owned
+    assert first.owned | second.owned == frozenset(VALVES)
+
+
+def test_no_claim_before_the_settle_delay():
+    coordinator = coordinator_of("instance0")
+    coordinator.on_connected()
+    coordinator.set_valves(VALVES)
+    assert coordinator.owned == frozenset()
+
+
+def test_valves_dropped_when_the_lease_is_not_renewed():
+    coordinator = coordinator_of("instance0")
+    coordinator.set_valves(VALVES)
+    assert coordinator.owned
+
+    # one heartbeat before the other instances consider the lease expired
+    coordinator._renewed_at = time.monotonic() - (coordinator.lease_ttl - coordinator.heartbeat_interval)
+    coordinator.evaluate()
+    assert coordinator.owned == frozenset() and coordinator.handovers == 2 * len(VALVES)
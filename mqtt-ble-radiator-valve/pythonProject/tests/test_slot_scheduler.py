@@ -0,0 +1,61 @@
+import asyncio
+
+from trv_controller.slot_scheduler import ConnectionSlotScheduler
+
+
+class FakeSessionPool:
+    """
+    The open BLE connections seen by the scheduler, set by the test
+    """
+
+    def __init__(self):
+        self.connected: set[tuple[str, str]] = set()
+        self.on_session_closed = None
+
+    def is_connected(self, proxy_hostname: str, mac_address: str) -> bool:
+        return (proxy_hostname, mac_address) in self.connected
+
+    def connected_count(self, proxy_hostname: str) -> int:
+        return sum(1 for hostname, _ in self.connected if hostname == proxy_hostname)
+
+    def has_idle_connection(self, proxy_hostname: str) -> bool:
+        return False
+
+
+def test_all_slots_used_by_concurrent_transactions():
+    async def scenario():
+        pool = FakeSessionPool()
+        scheduler = ConnectionSlotScheduler(pool, default_slots=3)
+        valves = [f"50:00:00:00:00:0{i}" for i in range(4)]
+
+        # staggered arrivals: each transaction connects its valve before the next one arrives
+        for mac_address in valves[:3]:
+            assert scheduler.try_acquire(mac_address, ["proxy"]) == "proxy"
+            pool.connected.add(("proxy", mac_address))
+        assert scheduler.reserved("proxy") == 3
+        assert scheduler.free_slots("proxy") == 0
+
+        # the fourth one waits until a transaction ends and its connection is closed
+        waiter = asyncio.ensure_future(scheduler.acquire(valves[3], ["proxy"]))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        scheduler.release("proxy", valves[0])
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        pool.connected.discard(("proxy", valves[0]))
+        pool.on_session_closed("proxy")
+        assert await waiter == "proxy"
+
+    asyncio.run(scenario())
+
+
+def test_connected_valve_needs_no_new_slot():
+    pool = FakeSessionPool()
+    scheduler = ConnectionSlotScheduler(pool, default_slots=1)
+    pool.connected.add(("proxy", "50:00:00:00:00:01"))
+
+    # the pooled session of the valve is reused
+    assert scheduler.try_acquire("50:00:00:00:00:01", ["proxy"]) == "proxy"
+    assert scheduler.try_acquire("50:00:00:00:00:02", ["proxy"]) is None
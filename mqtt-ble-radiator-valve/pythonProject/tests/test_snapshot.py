@@ -0,0 +1,53 @@
+import asyncio
+import json
+import time
+
+from trv_controller.snapshot import StateSnapshot
+
+
+def test_saved_state_loaded_back(tmp_path):
+    path = tmp_path / "trv_state.json"
+    state = {"valves": {"studio": {"mac_address": "50:00:00:00:00:01", "packet_number": 42}}}
+    snapshot = StateSnapshot(str(path), lambda: state)
+
+    assert snapshot.load() is None
+    snapshot.save()
+    assert snapshot.load() == state and snapshot.saved == 1
+    # written aside, then renamed
+    assert [file.name for file in tmp_path.iterdir()] == ["trv_state.json"]
+
+
+def test_unusable_snapshot_means_cold_start(tmp_path):
+    path = tmp_path / "trv_state.json"
+    snapshot = StateSnapshot(str(path), dict)
+
+    path.write_text('{"version": 1, "saved_at"')
+    assert snapshot.load() is None
+    path.write_text(json.dumps({"version": StateSnapshot.VERSION + 1, "saved_at": time.time(), "state": {}}))
+    assert snapshot.load() is None
+
+
+def test_monotonic_timestamps_survive_the_round_trip():
+    monotonic = time.monotonic() - 120.0
+    assert abs(StateSnapshot.to_monotonic(StateSnapshot.to_wall_clock(monotonic)) - monotonic) < 0.01
+
+
+def test_saved_periodically_and_on_exit(tmp_path):
+    async def scenario():
+        collected = []
+
+        def collect():
+            collected.append(len(collected))
+            return {"count": len(collected)}
+
+        snapshot = StateSnapshot(str(tmp_path / "trv_state.json"), collect, interval=0.05)
+        exited = asyncio.Event()
+        task = asyncio.create_task(snapshot.snapshot_task(exited))
+        await asyncio.sleep(0.12)
+        exited.set()
+        await asyncio.wait_for(task, 1)
+
+        assert snapshot.saved == len(collected) >= 3
+        assert snapshot.load() == {"count": len(collected)}
+
+    asyncio.run(scenario())
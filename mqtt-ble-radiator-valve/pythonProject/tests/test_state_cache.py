@@ -0,0 +1,32 @@
+import time
+
+from trv_controller.state_cache import ValveStateCache
+
+
+def test_confirmed_state_trusted_for_the_ttl():
+    cache = ValveStateCache(ttl=300.0)
+    now = time.monotonic()
+
+    assert not cache.is_satisfied("studio", True)
+    cache.confirm("studio", True, 215, 1, confirmed_at=now - 299.0)
+    assert cache.is_satisfied("studio", True)
+    assert not cache.is_satisfied("studio", False)
+    assert cache.as_attributes("studio") == {"confirmed_state": "open", "comfort_temperature": 21.5, "mode": 1}
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # expired: forgotten
+    cache.confirm("studio", True, 215, 1, confirmed_at=now - 300.0)
+    assert not cache.is_satisfied("studio", True)
+    assert cache.get("studio") is None and cache.as_attributes("studio") == {}
+
+
+def test_invalidated_state_forgotten():
+    cache = ValveStateCache()
+    cache.confirm("studio", False, 190, 0)
+    cache.confirm("kitchen", False, 190, 0)
+
+    cache.invalidate("studio")
+    cache.invalidate("bedroom")
+    assert cache.get("studio") is None
+    assert cache.is_satisfied("kitchen", False)
+
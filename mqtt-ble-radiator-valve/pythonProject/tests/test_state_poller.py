@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from trv_controller.state_poller import StatePoller
+from trv_controller.valve_registry import ValveRegistry
+
+
+def poller_of(valve_count: int, proxies: list[str], idle: bool = True, outcome: bool = True, **kwargs) \
+        -> tuple[StatePoller, ValveRegistry, list[tuple[str, str]]]:
+    registry = ValveRegistry([{"name": f"valve{index}", "mac_address": f"50:00:00:00:00:{index:02x}"}
+                              for index in range(valve_count)], "radiator_valve", "homeassistant")
+    reads = []
+
+    async def poll(valve, proxy_hostname):
+        reads.append((valve.name, proxy_hostname))
+        await asyncio.sleep(0.01)
+        return outcome
+
+    poller = StatePoller(lambda: registry, lambda valve: proxies, poll, lambda: idle, **kwargs)
+    return poller, registry, reads
+
+
+def make_due(poller: StatePoller, registry: ValveRegistry):
+    for valve in registry:
+        poller._due[valve.name] = time.monotonic() - 1
+
+
+async def drain(poller: StatePoller):
+    await asyncio.gather(*poller._tasks)
+
+
+def test_first_reads_spread_over_the_interval():
+    async def scenario():
+        poller, registry, reads = poller_of(50, ["proxy"], interval=100.0)
+        poller.check()
+        now = time.monotonic()
+        assert all(now < due_at <= now + 100.0 for due_at in poller._due.values())
+        assert max(poller._due.values()) - min(poller._due.values()) > 50.0
+
+    asyncio.run(scenario())
+
+
+def test_one_read_per_proxy_when_idle():
+    async def scenario():
+        poller, registry, reads = poller_of(3, ["near", "far"], idle=False)
+        make_due(poller, registry)
+        poller.check()
+        assert reads == [] and not poller._tasks
+
+        poller.is_idle = lambda: True
+        poller.check()
+        await drain(poller)
+        assert sorted(proxy_hostname for _, proxy_hostname in reads) == ["far", "near"]
+
+        # the third valve is read on the next check
+        poller.check()
+        await drain(poller)
+        assert len(reads) == 3 and poller.polls == 3
+
+    asyncio.run(scenario())
+
+
+def test_next_read_scheduled_after_the_outcome():
+    async def scenario():
+        poller, registry, reads = poller_of(1, ["proxy"], outcome=False, interval=3600.0, retry_delay=600.0)
+        make_due(poller, registry)
+        poller.check()
+        await drain(poller)
+        assert poller.failed_polls == 1
+        assert 599.0 < poller._due["valve0"] - time.monotonic() <= 600.0
+
+        # confirmed by a command: postponed by an interval
+        poller.on_confirmed("valve0")
+        assert poller._due["valve0"] - time.monotonic() > 3600.0 * 0.8 - 1
+
+    asyncio.run(scenario())
+
+
+def test_daily_read_budget():
+    async def scenario():
+        poller, registry, reads = poller_of(1, ["proxy"], daily_reads=2)
+        for _ in range(3):
+            make_due(poller, registry)
+            poller.check()
+            await drain(poller)
+        assert len(reads) == 2
+        # the next read is possible 24 hours after the first one
+        assert poller._due["valve0"] - time.monotonic() > StatePoller.DAY - 1
+
+    asyncio.run(scenario())
+
+
+def test_removed_valve_forgotten():
+    async def scenario():
+        poller, registry, reads = poller_of(2, ["proxy"])
+        poller.check()
+        registry.update([{"name": "valve0", "mac_address": "50:00:00:00:00:00"}])
+        poller.check()
+        assert list(poller._due) == ["valve0"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,337 @@
+import asyncio
+import json
+import time
+
+from emulator import EmulatedProxy, EmulatedValve, Impairments
+from trv_controller.radiator_valve import RadiatorValve
+from trv_controller.slot_scheduler import ConnectionSlotScheduler
+from trv_controller.trv_controller import RadiatorValveSwitchManager
+
+MAC = "50:00:00:00:00:01"
+INSTANT = Impairments(connect_latency=0, write_latency=0, response_latency=0, jitter=0)
+
+
+def manager_of(config: dict | None = None, proxies: tuple[str, ...] = ("proxy",)) -> RadiatorValveSwitchManager:
+    return RadiatorValveSwitchManager({
+        "mqtt": {"host": "localhost"},
+        "bluetooth_proxies": [{"hostname": hostname} for hostname in proxies],
+        "radiator_valve_switches": [{"name": "studio", "mac_address": MAC, "bluetooth_proxies": list(proxies)}],
+        **(config or {}),
+    })
+
+
+def connect_emulated_proxies(manager: RadiatorValveSwitchManager, reachable: tuple[str, ...],
+                             impairments: Impairments = INSTANT) -> EmulatedValve:
+    """
+    Connects an emulated proxy for each configured proxy, the valve being in range of the `reachable` ones only
+    """
+    valve = EmulatedValve(RadiatorValve.mac_to_int(MAC), packet_number=1)
+    for hostname in manager.proxy_health:
+        manager._on_proxy_connected(hostname, EmulatedProxy(hostname, [valve] if hostname in reachable else [],
+                                                            impairments))
+    return valve
+
+
+def test_slot_wait_bounded_by_the_command_budget():
+    async def scenario():
+        manager = manager_of({"commands": {"budget": 0.05}})
+        valve = manager.valves.by_name["studio"]
+        health = manager.proxy_health["proxy"]
+
+        # the connection slots of the proxy are used by the transactions of other valves
+        for i in range(manager.slot_scheduler.limit("proxy")):
+            assert manager.slot_scheduler.try_acquire(f"50:00:00:00:01:0{i}", ["proxy"]) == "proxy"
+
+        deadline = asyncio.get_running_loop().time() + 0.05
+        connection = manager._connect_valve(valve, ["proxy"], ConnectionSlotScheduler.INTERACTIVE, deadline)
+        assert await asyncio.wait_for(connection, 1) == (None, None, None)
+        assert manager.slot_scheduler.waiting == 0
+
+        assert not await asyncio.wait_for(manager._execute_valve_command(valve, True), 1)
+        assert manager.slot_scheduler.waiting == 0
+        assert health.failures == 0 and health.state == health.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_empty_config_sections():
+    async def scenario():
+        manager = manager_of({"commands": None, "proxy_health": None, "ble_sessions": None,
+                              "advertisements": None, "command_intake": None})
+        assert manager.command_budget == 60
+        assert manager.proxy_health["proxy"].failure_threshold == 3
+
+    asyncio.run(scenario())
+
+
+def test_proxies_ranked_by_connection_rssi_and_success():
+    async def scenario():
+        manager = manager_of(proxies=("far", "near", "deaf", "down"))
+        connect_emulated_proxies(manager, reachable=())
+        valve = manager.valves.by_name["studio"]
+        manager._on_proxy_disconnected("down")
+
+        # the proxies that never heard the valve come last, in configuration order
+        manager.valves_rssi_map["studio"] = {"far": -65, "near": -60}
+        assert manager._rank_proxies(valve) == ["near", "far", "deaf"]
+
+        # a few failures through the nearest proxy make the other one preferred
+        for _ in range(4):
+            manager._record_proxy_outcome(valve, "near", False, proxy_fault=False)
+        assert manager._rank_proxies(valve) == ["far", "near", "deaf"]
+
+    asyncio.run(scenario())
+
+
+def test_unavailable_proxies_tried_as_a_last_resort():
+    async def scenario():
+        manager = manager_of(proxies=("first", "second"))
+        connect_emulated_proxies(manager, reachable=())
+        valve = manager.valves.by_name["studio"]
+
+        for _ in range(manager.proxy_health["first"].failure_threshold):
+            manager._record_proxy_outcome(valve, "first", False)
+        assert manager._rank_proxies(valve) == ["second"]
+
+        for _ in range(manager.proxy_health["second"].failure_threshold):
+            manager._record_proxy_outcome(valve, "second", False)
+        assert sorted(manager._rank_proxies(valve)) == ["first", "second"]
+
+    asyncio.run(scenario())
+
+
+def test_hedged_connection_through_the_next_proxy():
+    async def scenario():
+        manager = manager_of({"commands": {"hedge_delay": 0.05, "budget": 5}}, proxies=("best", "next"))
+        connect_emulated_proxies(manager, reachable=("next",))
+        valve = manager.valves.by_name["studio"]
+
+        # the best ranked proxy does not reach the valve: its connection attempt is cancelled
+        deadline = asyncio.get_running_loop().time() + 5
+        proxy_hostname, ble_valve, _ = await asyncio.wait_for(
+            manager._connect_valve(valve, ["best", "next"], ConnectionSlotScheduler.INTERACTIVE, deadline), 1)
+        assert proxy_hostname == "next" and ble_valve.connected
+        assert manager.slot_scheduler.reserved("best") == 0 and manager.slot_scheduler.reserved("next") == 1
+        assert not manager.proxy_health["best"].probe_in_flight
+        manager.slot_scheduler.release(proxy_hostname, MAC)
+
+    asyncio.run(scenario())
+
+
+def test_without_hedging_the_next_proxy_waits_for_the_first_one():
+    async def scenario():
+        manager = manager_of({"commands": {"budget": 0.2}}, proxies=("best", "next"))
+        connect_emulated_proxies(manager, reachable=("next",))
+
+        # the connection to the best ranked proxy times out with the budget, the next one is not tried
+        assert not await asyncio.wait_for(
+            manager._execute_valve_command(manager.valves.by_name["studio"], True, planned_proxy="best"), 1)
+        assert manager.proxy_api_clients["next"].connects == 0
+        assert manager.proxy_health["best"].failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_confirmed_state_answered_without_transaction():
+    async def scenario():
+        manager = manager_of({"commands": {"budget": 5, "state_cache_ttl": 300}})
+        emulated_valve = connect_emulated_proxies(manager, reachable=("proxy",))
+        valve = manager.valves.by_name["studio"]
+
+        assert await asyncio.wait_for(manager._execute_valve_command(valve, True), 1)
+        accepted = emulated_valve.accepted
+        assert accepted > 0
+
+        assert await asyncio.wait_for(manager._execute_valve_command(valve, True), 1)
+        assert emulated_valve.accepted == accepted and manager.state_cache.hits == 1
+
+        # the opposite state needs a transaction
+        assert await asyncio.wait_for(manager._execute_valve_command(valve, False), 1)
+        assert emulated_valve.accepted > accepted
+
+    asyncio.run(scenario())
+
+
+def test_batch_candidates_within_the_rssi_margin():
+    async def scenario():
+        manager = manager_of({"commands": {"batch_rssi_margin": 10}}, proxies=("near", "fair", "far", "deaf"))
+        connect_emulated_proxies(manager, reachable=())
+        valve = manager.valves.by_name["studio"]
+
+        # a valve heard by no proxy can go through any of them
+        assert manager._batch_candidates(valve) == ["near", "fair", "far", "deaf"]
+
+        manager.valves_rssi_map["studio"] = {"near": -60, "fair": -70, "far": -75}
+        assert manager._batch_candidates(valve) == ["near", "fair"]
+
+    asyncio.run(scenario())
+
+
+class SlowBroker:
+    """
+    A MQTT client whose publications are acknowledged after `latency` seconds
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.topics: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            self.topics.append(topic)
+        finally:
+            self.in_flight -= 1
+
+
+def many_valves(count: int) -> dict:
+    return {"radiator_valve_switches": [{"name": f"valve{index}", "mac_address": f"50:00:00:00:01:{index:02x}"}
+                                        for index in range(count)]}
+
+
+def test_discovery_published_concurrently_within_the_window():
+    async def scenario():
+        manager = manager_of(many_valves(40))
+        broker = SlowBroker(0.02)
+
+        manager._start_discovery_burst(broker)
+        # the burst runs in the background
+        assert broker.topics == []
+        await asyncio.wait_for(manager._discovery_task, 1)
+
+        assert sorted(broker.topics) == sorted(valve.discovery_topic for valve in manager.valves)
+        assert 1 < broker.max_in_flight <= manager.discovery_window
+
+    asyncio.run(scenario())
+
+
+def test_discovery_burst_replaced_by_the_next_one():
+    async def scenario():
+        manager = manager_of(many_valves(40))
+        first, second = SlowBroker(0.02), SlowBroker(0.02)
+
+        manager._start_discovery_burst(first)
+        await asyncio.sleep(0.03)
+        manager._start_discovery_burst(second)
+        await asyncio.wait_for(manager._discovery_task, 1)
+
+        assert len(first.topics) < len(manager.valves) and first.in_flight == 0
+        assert len(second.topics) == len(manager.valves)
+
+    asyncio.run(scenario())
+
+
+def test_config_reload_restarts_the_changed_proxies_only():
+    async def scenario():
+        manager = manager_of(proxies=("kept", "modified", "removed"))
+
+        async def connection_manager_task(proxy: dict):
+            await asyncio.Event().wait()
+
+        manager._proxy_connection_manager_task = connection_manager_task
+        async with manager.connections_manager_task_group:
+            manager._start_proxies_connection_manager()
+            tasks = dict(manager.proxy_tasks)
+            manager.state_cache.confirm("studio", True, 200, 1)
+
+            config = dict(manager.full_config)
+            config["bluetooth_proxies"] = [{"hostname": "kept"}, {"hostname": "modified", "connection_slots": 1},
+                                           {"hostname": "added"}]
+            config["radiator_valve_switches"] = [{"name": "studio", "mac_address": MAC,
+                                                  "bluetooth_proxies": ["kept", "added"]}]
+            await manager.apply_config(config)
+
+            assert sorted(manager.proxy_tasks) == ["added", "kept", "modified"]
+            assert manager.proxy_tasks["kept"] is tasks["kept"]
+            assert manager.proxy_tasks["modified"] is not tasks["modified"] and tasks["modified"].cancelled()
+            assert tasks["removed"].cancelled() and "removed" not in manager.proxy_health
+            assert manager.slot_scheduler.limit("modified") == 1
+
+            # the updated valve keeps its state
+            assert manager.valves.by_name["studio"].bluetooth_proxies == ("kept", "added")
+            assert manager.state_cache.get("studio") is not None
+
+            for hostname in list(manager.proxy_tasks):
+                await manager._stop_proxy_connection_manager(hostname)
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_round_trip(tmp_path):
+    async def scenario():
+        config = {"snapshot": {"path": str(tmp_path / "trv_state.json")}}
+        manager = manager_of(config)
+        valve = manager.valves.by_name["studio"]
+        manager.valve_last_seen["studio"] = time.monotonic() - 10
+        manager.availability.seen(valve, manager.valve_last_seen["studio"])
+        manager.valves_rssi_map["studio"] = {"proxy": -67.24}
+        manager.valve_last_state["studio"] = True
+        manager.state_cache.confirm("studio", True, 215, 1)
+        manager.session_pool.seed_packet_numbers({valve.mac_int: 42})
+        manager.snapshot.save()
+
+        restarted = manager_of(config)
+        restarted.restore_snapshot()
+        valve = restarted.valves.by_name["studio"]
+        assert restarted.availability.is_online(valve)
+        assert restarted.valves_rssi_map["studio"] == {"proxy": -67.2}
+        assert restarted.valve_last_state["studio"] is True
+        state = restarted.state_cache.get("studio")
+        assert (state.is_on, state.comfort_temp_dec, state.mode) == (True, 215, 1)
+        assert restarted.session_pool.packet_numbers() == {valve.mac_int: 42}
+
+        # another device under the same name
+        replaced = manager_of({**config, "radiator_valve_switches": [{"name": "studio",
+                                                                      "mac_address": "50:00:00:00:00:02"}]})
+        replaced.restore_snapshot()
+        assert "studio" not in replaced.valve_last_state and replaced.session_pool.packet_numbers() == {}
+
+    asyncio.run(scenario())
+
+
+def test_failed_command_dumps_the_flight_recorder(tmp_path):
+    async def scenario():
+        manager = manager_of({"commands": {"budget": 0.3},
+                              "flight_recorder": {"valve_records": 16, "dump_dir": str(tmp_path)}})
+        connect_emulated_proxies(manager, reachable=("proxy",),
+                                 impairments=Impairments(connect_latency=0, write_latency=0, response_latency=0,
+                                                         jitter=0, response_loss=1.0))
+        valve = manager.valves.by_name["studio"]
+
+        assert not await asyncio.wait_for(manager._execute_valve_command(valve, True), 1)
+        await asyncio.sleep(0.05)
+        with open(tmp_path / "flight-recorder-studio-failure.json") as file:
+            records = json.load(file)["valves"]["studio"]
+        assert 0 < len(records) <= 16
+        assert {"sent", "timeout"} <= {record["kind"] for record in records}
+
+    asyncio.run(scenario())
+
+
+def test_poller_reverts_a_drifted_valve():
+    async def scenario():
+        manager = manager_of({"commands": {"budget": 5}, "state_polling": {}})
+        emulated_valve = connect_emulated_proxies(manager, reachable=("proxy",))
+        valve = manager.valves.by_name["studio"]
+
+        async with manager.pending_commands_task_group:
+            # turned on from HA, then the knob was turned on the valve
+            manager.valve_last_state["studio"] = True
+            emulated_valve.comfort_temp_dec = 215
+
+            assert await asyncio.wait_for(manager._poll_valve(valve, "proxy"), 1)
+            assert manager.poller.drifts == 1 and manager.state_cache.get("studio") is None
+            async with asyncio.timeout(1):
+                while manager.intake.waiting or manager.intake.running:
+                    await asyncio.sleep(0.01)
+            assert emulated_valve.comfort_temp_dec == 350
+
+            # back to the desired state: nothing to revert
+            assert await asyncio.wait_for(manager._poll_valve(valve, "proxy"), 1)
+            assert manager.poller.drifts == 1 and manager.state_cache.get("studio").is_on
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from trv_controller.valve_registry import ValveRegistry
+
+
+VALVES = [
+    {"name": "studio", "mac_address": "50:00:00:00:00:01", "bluetooth_proxies": ["proxy"]},
+    {"name": "kitchen", "mac_address": "50:00:00:00:00:0A", "availability_timeout": 120},
+]
+
+
+def test_lookup_by_mac_and_name():
+    registry = ValveRegistry(VALVES, "radiator_valve", "homeassistant")
+
+    assert len(registry) == 2 and [valve.name for valve in registry] == ["studio", "kitchen"]
+    studio = registry.by_name["studio"]
+    # the integer MAC address, as reported in the advertisements, whatever the case of the config
+    assert registry.by_mac[0x50000000000A] is registry.by_name["kitchen"]
+    assert registry.by_mac[0x500000000001] is studio
+    assert 0x500000000002 not in registry.by_mac and "bedroom" not in registry.by_name
+
+    assert studio.bluetooth_proxies == ("proxy",)
+    assert studio.availability_timeout == 60.0 and registry.by_name["kitchen"].availability_timeout == 120
+    assert studio.command_topic == "radiator_valve/studio/set"
+    assert studio.discovery_topic == "homeassistant/valve/radiator_valve_studio/config"
+    assert json.loads(studio.discovery_payload)["state_topic"] == "radiator_valve/studio/state"
+
+
+@pytest.mark.parametrize("valves", [
+    VALVES + [{"name": "studio", "mac_address": "50:00:00:00:00:02"}],
+    VALVES + [{"name": "bedroom", "mac_address": "50:00:00:00:00:01"}],
+    [{"name": "studio", "mac_address": "50:00:00:00:01"}],
+])
+def test_invalid_valves_rejected(valves):
+    with pytest.raises(ValueError):
+        ValveRegistry(valves, "radiator_valve", "homeassistant")
+
+
+def test_groups_resolved_by_valve_name():
+    registry = ValveRegistry(VALVES, "radiator_valve", "homeassistant",
+                             groups_config=[{"name": "downstairs", "valves": ["kitchen", "studio"]}])
+
+    group = registry.groups["downstairs"]
+    assert group.valves == (registry.by_name["kitchen"], registry.by_name["studio"])
+    assert group.command_topic == "radiator_valve/group/downstairs/set"
+
+    with pytest.raises(ValueError):
+        ValveRegistry(VALVES, "radiator_valve", "homeassistant",
+                      groups_config=[{"name": "downstairs", "valves": ["kitchen", "bedroom"]}])
+
+
+def test_update_diff():
+    registry = ValveRegistry(VALVES + [{"name": "bedroom", "mac_address": "50:00:00:00:00:0B"}],
+                             "radiator_valve", "homeassistant")
+    studio, kitchen, bedroom = registry.valves
+    by_mac = registry.by_mac
+
+    added, removed, updated = registry.update([
+        {"name": "studio", "mac_address": "50:00:00:00:00:01", "bluetooth_proxies": ["proxy"]},
+        # new MAC address: another device
+        {"name": "kitchen", "mac_address": "50:00:00:00:00:0C", "availability_timeout": 120},
+        {"name": "bedroom", "mac_address": "50:00:00:00:00:0B", "bluetooth_proxies": ["proxy"]},
+        {"name": "attic", "mac_address": "50:00:00:00:00:0D"},
+    ])
+
+    assert [valve.name for valve in added] == ["kitchen", "attic"]
+    assert removed == [kitchen]
+    assert [valve.name for valve in updated] == ["bedroom"]
+    assert registry.by_name["studio"] is studio and registry.by_name["bedroom"] is not bedroom
+    # the dict shared with the advertisements ingestor is updated in place
+    assert registry.by_mac is by_mac and sorted(by_mac) == [0x500000000001, 0x50000000000B, 0x50000000000C,
+                                                            0x50000000000D]
+
+
+def test_invalid_update_changes_nothing():
+    registry = ValveRegistry(VALVES, "radiator_valve", "homeassistant")
+    valves = registry.valves
+
+    with pytest.raises(ValueError):
+        registry.update(VALVES + [{"name": "attic", "mac_address": "50:00:00:00:00:01"}])
+    with pytest.raises(ValueError):
+        registry.update(VALVES, [{"name": "downstairs", "valves": ["attic"]}])
+    assert registry.valves == valves and len(registry.by_mac) == 2
@@ -0,0 +1,219 @@
+import asyncio
+import contextlib
+import logging
+import re
+import time
+from typing import Callable
+
+from aioesphomeapi import BluetoothLERawAdvertisementsResponse
+
+from trv_controller.flight_recorder import FlightRecorder, FrameRing
+from trv_controller.radiator_valve import RadiatorValve
+from trv_controller.valve_registry import ValveConfig
+
+# the valves advertise themselves as "vanne", anywhere in the raw advertisement data
+_VALVE_NAME = re.compile(rb"[vV][aA][nN][nN][eE]")
+
+# the advertisements of an unknown device searched for the valve name (its name can be in the scan response only),
+# and the number of unknown devices remembered (the phones rotate their random addresses)
+_MAX_NAME_SEARCHES = 3
+_MAX_FOREIGN_DEVICES = 65536
+
+
+class ValveSighting:
+    """
+    The advertisements of a valve received during a batch window, merged across the proxies
+    """
+    __slots__ = ("valve", "last_seen", "rssi_sums", "rssi_counts")
+
+    def __init__(self, valve: ValveConfig):
+        self.valve = valve
+        self.last_seen = 0.0
+        # key is the proxy hostname
+        self.rssi_sums: dict[str, int] = dict()
+        self.rssi_counts: dict[str, int] = dict()
+
+
+class AdvertisementIngestor:
+    """
+    Ingestion stage of the BLE advertisements forwarded by the proxies.
+
+    The raw advertisements callback only keeps the beacons of the configured valves, as compact
+    (proxy, MAC, RSSI, monotonic timestamp) records in a preallocated ring buffer of `buffer_size` records;
+    when the buffer is full the oldest record is dropped (and counted in `dropped`).
+    A single consumer drains the buffer every `batch_interval` seconds: the records of the same valve are merged
+    into one `ValveSighting` (the same beacon is heard by several proxies) and handed to `on_batch`.
+    """
+
+    def __init__(self,
+                 valves_by_mac: dict[int, ValveConfig],
+                 on_batch: Callable[[list[ValveSighting]], None],
+                 buffer_size: int = 4096,
+                 batch_interval: float = 1.0):
+        self.log = logging.getLogger("adv-ingest")
+        self.valves_by_mac = valves_by_mac
+        self.on_batch = on_batch
+        self.buffer_size = buffer_size
+        self.batch_interval = batch_interval
+
+        # ring buffer, `_size` records starting at `_head`
+        self._proxies: list[str | None] = [None] * buffer_size
+        self._macs: list[int] = [0] * buffer_size
+        self._rssi: list[int] = [0] * buffer_size
+        self._timestamps: list[float] = [0.0] * buffer_size
+        self._head = 0
+        self._size = 0
+
+        # unknown devices advertising a valve name, reported by the consumer
+        self._new_devices: set[int] = set()
+
+        # the unknown devices advertising a valve name, and the number of advertisements of the other unknown devices
+        # searched for it: the name is only searched in the first advertisements of a device
+        self._unknown_valves: set[int] = set()
+        self._name_searches: dict[int, int] = dict()
+
+        # the configured valves handled by other controller instances (see `ShardCoordinator`), not reported as new
+        self.other_valves: set[int] = set()
+
+        # records the valve advertisements of each proxy when set
+        self.recorder: FlightRecorder | None = None
+
+        # metrics
+        self.received = 0  # advertisements received from the proxies, foreign devices included
+        self.accepted = 0  # valve advertisements stored in the buffer
+        self.dropped = 0  # valve advertisements dropped because the buffer was full
+        self.batches = 0
+
+    @classmethod
+    def from_config(cls, valves_by_mac: dict[int, ValveConfig], on_batch: Callable[[list[ValveSighting]], None],
+                    config: dict):
+        return cls(valves_by_mac, on_batch,
+                   buffer_size=config.get("buffer_size", 4096),
+                   batch_interval=config.get("batch_interval", 1.0))
+
+    def __len__(self):
+        return self._size
+
+    def on_raw_advertisements(self, hostname: str, response: BluetoothLERawAdvertisementsResponse):
+        """
+        This is the raw advertisements callback of a proxy (`hostname`), it runs on the event loop for every
+        message of the proxy, so it does nothing more than filtering and storing the valve records.
+        """
+        now = time.monotonic()
+        valves_by_mac = self.valves_by_mac
+        advertisements = response.advertisements
+        self.received += len(advertisements)
+        ring = self.recorder.proxy_ring(hostname) if self.recorder is not None else None
+
+        for adv in advertisements:
+            address = adv.address
+            if address not in valves_by_mac:
+                if address in self._unknown_valves:
+                    self._new_devices.add(address)
+                elif self._name_searches.get(address, 0) < _MAX_NAME_SEARCHES:
+                    self._search_valve_name(address, adv.data)
+                continue
+
+            self.accepted += 1
+            size = self._size
+            if size == self.buffer_size:
+                # overload: the oldest record is overwritten
+                index = self._head
+                self._head = (index + 1) % self.buffer_size
+                self.dropped += 1
+            else:
+                index = (self._head + size) % self.buffer_size
+                self._size = size + 1
+
+            self._proxies[index] = hostname
+            self._macs[index] = address
+            self._rssi[index] = adv.rssi
+            self._timestamps[index] = now
+
+            if ring is not None:
+                ring.record(FrameRing.ADVERTISEMENT, address, adv.rssi, data=adv.data)
+
+    def _search_valve_name(self, address: int, data: bytes):
+        if _VALVE_NAME.search(data) is not None:
+            self._unknown_valves.add(address)
+            self._new_devices.add(address)
+            self._name_searches.pop(address, None)
+            return
+
+        if len(self._name_searches) >= _MAX_FOREIGN_DEVICES:
+            self._name_searches.clear()
+        self._name_searches[address] = self._name_searches.get(address, 0) + 1
+
+    def drain(self) -> list[ValveSighting]:
+        """
+        Empties the buffer, and returns the records merged by valve
+        """
+        sightings: dict[int, ValveSighting] = dict()
+        proxies, macs, rssi_values, timestamps = self._proxies, self._macs, self._rssi, self._timestamps
+
+        index = self._head
+        for _ in range(self._size):
+            mac = macs[index]
+            sighting = sightings.get(mac)
+            if sighting is None:
+                valve = self.valves_by_mac.get(mac)
+                if valve is None:
+                    # removed from the config since it was buffered
+                    proxies[index] = None
+                    index = (index + 1) % self.buffer_size
+                    continue
+                sighting = sightings[mac] = ValveSighting(valve)
+
+            hostname = proxies[index]
+            sighting.rssi_sums[hostname] = sighting.rssi_sums.get(hostname, 0) + rssi_values[index]
+            sighting.rssi_counts[hostname] = sighting.rssi_counts.get(hostname, 0) + 1
+            if timestamps[index] > sighting.last_seen:
+                sighting.last_seen = timestamps[index]
+
+            proxies[index] = None
+            index = (index + 1) % self.buffer_size
+
+        self._head = 0
+        self._size = 0
+        return list(sightings.values())
+
+    def _report_new_devices(self):
+        new_devices, self._new_devices = self._new_devices, set()
+        for address in new_devices:
+            if address not in self.valves_by_mac and address not in self.other_valves:
+                self.log.warning(f"[MAC Address: {RadiatorValve.int_to_mac(address)}] Received a callback "
+                                 f"from a brand-new valve, please add on `config.yaml`")
+
+    async def ingest_task(self, exited: asyncio.Event):
+        """
+        This task drains the buffer every `batch_interval` seconds
+        """
+        dropped = 0
+        while not exited.is_set():
+            try:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(exited.wait(), self.batch_interval)
+
+                if self._new_devices:
+                    self._report_new_devices()
+
+                if not self._size:
+                    continue
+
+                self.batches += 1
+                self.on_batch(self.drain())
+
+                if self.dropped != dropped:
+                    self.log.warning(f"Advertisements buffer full, {self.dropped - dropped} records dropped "
+                                     f"({self.dropped} in total)")
+                    dropped = self.dropped
+            except Exception as ex:
+                self.log.exception("Error in ingest_task: ")
+
+    def as_attributes(self) -> dict:
+        return {
+            "received_advertisements": self.received,
+            "accepted_advertisements": self.accepted,
+            "dropped_advertisements": self.dropped,
+            "ingested_batches": self.batches,
+        }
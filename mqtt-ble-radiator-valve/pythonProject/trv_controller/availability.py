@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable
+
+from trv_controller.valve_registry import ValveConfig
+
+
+class AvailabilityTracker:
+    """
+    Tracks the online/offline state of the valves from their advertisements, on the monotonic clock.
+
+    A valve is online until `availability_timeout` seconds (see `ValveConfig`) have elapsed since its last
+    advertisement. The expiry deadlines are kept in a heap: an advertisement only moves the deadline of an
+    online valve forward, the heap entry is rescheduled lazily when it comes due. `on_change` is called on the
+    online <-> offline transitions only, when they happen.
+    """
+
+    def __init__(self, on_change: Callable[[ValveConfig, bool], None]):
+        self.log = logging.getLogger("availability")
+        self.on_change = on_change
+
+        # expiry deadline of the online valves, key is the valve name
+        self._deadlines: dict[str, float] = dict()
+        self._heap: list[tuple[float, int, ValveConfig]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+
+        # metrics
+        self.transitions = 0
+
+    def is_online(self, valve: ValveConfig) -> bool:
+        return self._deadlines.get(valve.name, 0.0) > time.monotonic()
+
+    def seen(self, valve: ValveConfig, timestamp: float):
+        """
+        Records an advertisement of the valve, received at `timestamp` (monotonic clock)
+        """
+        deadline = timestamp + valve.availability_timeout
+        previous_deadline = self._deadlines.get(valve.name)
+        if previous_deadline is not None:
+            if deadline > previous_deadline:
+                self._deadlines[valve.name] = deadline
+            return
+
+        self._deadlines[valve.name] = deadline
+        self._schedule(deadline, valve)
+        self._transition(valve, True)
+
+    def forget(self, valve: ValveConfig):
+        """
+        Stops tracking a valve, its heap entry is discarded when it comes due
+        """
+        self._deadlines.pop(valve.name, None)
+
+    def _schedule(self, deadline: float, valve: ValveConfig):
+        if not self._heap or deadline < self._heap[0][0]:
+            # the expiry task sleeps until a later deadline
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, next(self._sequence), valve))
+
+    def _transition(self, valve: ValveConfig, online: bool):
+        self.transitions += 1
+        self.log.info(f"[Valve {valve.name}] {'Online' if online else 'Offline'}")
+        self.on_change(valve, online)
+
+    def expire(self, now: float):
+        """
+        Turns offline the valves whose deadline has passed
+        """
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, valve = heapq.heappop(heap)
+            deadline = self._deadlines.get(valve.name)
+            if deadline is None:
+                # forgotten valve
+                continue
+
+            if deadline > now:
+                # advertised since the entry was scheduled
+                heapq.heappush(heap, (deadline, next(self._sequence), valve))
+                continue
+
+            del self._deadlines[valve.name]
+            self._transition(valve, False)
+
+    async def expiry_task(self, exited: asyncio.Event):
+        """
+        This task sleeps until the next deadline, and turns offline the expired valves
+        """
+        exited_wait = asyncio.ensure_future(exited.wait())
+        try:
+            while not exited.is_set():
+                try:
+                    self._wakeup.clear()
+                    timeout = max(self._heap[0][0] - time.monotonic(), 0.0) if self._heap else None
+                    wakeup_wait = asyncio.ensure_future(self._wakeup.wait())
+                    try:
+                        await asyncio.wait((exited_wait, wakeup_wait), timeout=timeout,
+                                           return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        wakeup_wait.cancel()
+
+                    self.expire(time.monotonic())
+                except Exception as ex:
+                    self.log.exception("Error in expiry_task: ")
+        finally:
+            exited_wait.cancel()
+
+    def as_attributes(self) -> dict:
+        return {
+            "online_valves": len(self._deadlines),
+            "availability_transitions": self.transitions,
+        }
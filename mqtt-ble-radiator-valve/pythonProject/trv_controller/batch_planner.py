@@ -0,0 +1,24 @@
+def plan_batch(candidates: dict[str, list[str]], slots: dict[str, int]) -> dict[str, str]:
+    """
+    Assigns each valve of a batch (key is the valve name) to one of its candidate proxies, the best ranked first,
+    returns the proxy hostname by valve name (the valves without candidate are left out).
+
+    A proxy with N connection slots runs N transactions at a time, so the batch completes in as few transaction
+    rounds as possible when the valves are spread according to the slots: each valve goes to the candidate on
+    which it would run in the earliest round, the best ranked one among equals. The valves with the fewest
+    candidates are assigned first, since they have no alternative.
+    """
+    load: dict[str, int] = dict()
+    plan: dict[str, str] = dict()
+
+    for valve_name in sorted(candidates, key=lambda name: len(candidates[name])):
+        proxies = candidates[valve_name]
+        if not proxies:
+            continue
+
+        # `min` returns the first of the equal rounds, i.e. the best ranked proxy
+        proxy_hostname = min(proxies, key=lambda hostname: load.get(hostname, 0) // max(slots.get(hostname, 1), 1))
+        load[proxy_hostname] = load.get(proxy_hostname, 0) + 1
+        plan[valve_name] = proxy_hostname
+
+    return plan
@@ -0,0 +1,277 @@
+import asyncio
+import collections
+import functools
+import logging
+import time
+from typing import Awaitable, Callable
+
+from trv_controller.command_queue import ValveCommandQueue
+from trv_controller.valve_registry import ValveConfig
+
+
+class _IntakeEntry:
+    __slots__ = ("valve", "desired_state", "proxy_hostname", "future", "received_at")
+
+    def __init__(self, valve: ValveConfig, desired_state: bool, proxy_hostname: str | None,
+                 future: asyncio.Future, received_at: float):
+        self.valve = valve
+        self.desired_state = desired_state
+        self.proxy_hostname = proxy_hostname
+        self.future = future
+        self.received_at = received_at  # monotonic clock
+
+
+class CommandIntake:
+    """
+    Bounded admission stage between the MQTT loop and the valve command queues (see `ValveCommandQueue`).
+
+    At most `max_running` valves run commands at a time, and each valve is given at most `valve_rate` commands
+    per minute (in bursts of `valve_rate`). The other commands wait in the intake, one per valve: a newer command
+    supersedes the waiting one, so at most one command per configured valve (`valve_count`) waits. A command still
+    waiting after `max_age` seconds is shed, the desired state being likely outdated; beyond `capacity` waiting
+    commands (raised to the number of valves) the stale ones are shed right away. A command that is neither stale
+    nor superseded is never shed: a scene of all the valves waits for its turn.
+
+    Every shed command is reported to `on_shed` with the reason ("superseded", "stale", or "removed" and "handover"
+    when the valve is removed from the config or moved to another instance), and its future is resolved with None.
+    """
+
+    def __init__(self,
+                 execute_of: Callable[[ValveConfig], Callable[[bool, str | None], Awaitable[bool]]],
+                 create_task: Callable[[Awaitable], asyncio.Task],
+                 on_shed: Callable[[ValveConfig, bool, str], None],
+                 valve_count: Callable[[], int] = lambda: 0,
+                 capacity: int = 64,
+                 max_running: int = 16,
+                 max_age: float = 120.0,
+                 valve_rate: float = 6.0):
+        self.log = logging.getLogger("command-intake")
+        self._execute_of = execute_of
+        self._create_task = create_task
+        self.on_shed = on_shed
+        self.valve_count = valve_count
+        self.capacity = capacity
+        self.max_running = max_running
+        self.max_age = max_age
+        self.valve_rate = valve_rate
+
+        # per-valve command queues, key is valve name
+        self.queues: dict[str, ValveCommandQueue] = dict()
+
+        # waiting commands in arrival order, key is valve name
+        self._waiting: collections.OrderedDict[str, _IntakeEntry] = collections.OrderedDict()
+
+        # per-valve token buckets: tokens left and time of the last refill (monotonic clock), key is valve name
+        self._tokens: dict[str, tuple[float, float]] = dict()
+
+        # worker tasks of the valve queues
+        self.running = 0
+
+        self._wakeup = asyncio.Event()
+
+        # metrics
+        self.shed: collections.Counter[str] = collections.Counter()
+
+    @classmethod
+    def from_config(cls,
+                    execute_of: Callable[[ValveConfig], Callable[[bool, str | None], Awaitable[bool]]],
+                    create_task: Callable[[Awaitable], asyncio.Task],
+                    on_shed: Callable[[ValveConfig, bool, str], None],
+                    valve_count: Callable[[], int],
+                    config: dict):
+        return cls(execute_of, create_task, on_shed, valve_count,
+                   capacity=config.get("capacity", 64),
+                   max_running=config.get("max_running", 16),
+                   max_age=config.get("max_age", 120.0),
+                   valve_rate=config.get("valve_rate", 6.0))
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def is_pending(self, valve_name: str) -> bool:
+        """
+        True if a command of the valve is waiting in the intake or in its queue, or running
+        """
+        queue = self.queues.get(valve_name)
+        return valve_name in self._waiting or (queue is not None and queue.depth > 0)
+
+    def submit(self, valve: ValveConfig, desired_state: bool, proxy_hostname: str | None = None) -> asyncio.Future:
+        """
+        Queues a command, `proxy_hostname` being the proxy to try first (None to rank them at execution time).
+        The returned future is resolved with the outcome of the command (see `ValveCommandQueue.submit`),
+        or None if it is shed. It does not need to be awaited.
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        previous = self._waiting.pop(valve.name, None)
+        if previous is not None:
+            if previous.desired_state == desired_state:
+                # same desired state: the waiting command is answered along with the new one
+                future.add_done_callback(functools.partial(self._chain, previous.future))
+            else:
+                self._shed(previous, "superseded")
+
+        self._waiting[valve.name] = _IntakeEntry(valve, desired_state, proxy_hostname, future, time.monotonic())
+        if len(self._waiting) > max(self.capacity, self.valve_count()):
+            self._shed_stale()
+
+        self.dispatch()
+        return future
+
+    def update_valve(self, valve: ValveConfig):
+        """
+        Uses the reloaded config of a valve for its waiting command and for the next commands of its queue
+        """
+        entry = self._waiting.get(valve.name)
+        if entry is not None:
+            entry.valve = valve
+        queue = self.queues.get(valve.name)
+        if queue is not None:
+            queue.rebind(self._execute_of(valve))
+
+    def remove_valve(self, valve_name: str, reason: str = "removed"):
+        """
+        Sheds the waiting command of a valve removed from the config (or handed over to another controller instance),
+        and forgets its queue and command tokens. The commands already forwarded to the queue are completed: a queue
+        with a running worker is only marked as closing, and forgotten when the worker ends, such that a valve added
+        back meanwhile reuses it (one worker per valve).
+        """
+        entry = self._waiting.pop(valve_name, None)
+        if entry is not None:
+            self._shed(entry, reason)
+        queue = self.queues.get(valve_name)
+        if queue is not None:
+            if queue.running:
+                queue.closing = True
+            else:
+                del self.queues[valve_name]
+        self._tokens.pop(valve_name, None)
+
+    def _shed_stale(self):
+        now = time.monotonic()
+        for entry in list(self._waiting.values()):
+            if now - entry.received_at >= self.max_age:
+                self._shed(self._waiting.pop(entry.valve.name), "stale")
+
+    def _shed(self, entry: _IntakeEntry, reason: str):
+        self.shed[reason] += 1
+        self.log.warning(f"[Valve {entry.valve.name}] Command {'on' if entry.desired_state else 'off'} shed: {reason}")
+        self._resolve(entry.future, None)
+        self.on_shed(entry.valve, entry.desired_state, reason)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: bool | None):
+        if not future.done():
+            future.set_result(result)
+
+    @classmethod
+    def _chain(cls, future: asyncio.Future, done: asyncio.Future):
+        if done.cancelled():
+            future.cancel()
+        else:
+            cls._resolve(future, done.result())
+
+    def _take_token(self, valve_name: str, now: float) -> float:
+        """
+        Takes a command token of the valve, returns 0 on success, else the seconds until the next token
+        """
+        tokens, refilled_at = self._tokens.get(valve_name, (self.valve_rate, now))
+        tokens = min(self.valve_rate, tokens + (now - refilled_at) * self.valve_rate / 60)
+        if tokens < 1:
+            self._tokens[valve_name] = (tokens, now)
+            return (1 - tokens) * 60 / self.valve_rate
+        self._tokens[valve_name] = (tokens - 1, now)
+        return 0.0
+
+    def dispatch(self) -> float | None:
+        """
+        Forwards the waiting commands that can run to the valve queues,
+        returns the seconds until a command waiting for its valve rate can run (None if there is none)
+        """
+        now = time.monotonic()
+        next_token = None
+
+        for entry in list(self._waiting.values()):
+            if now - entry.received_at >= self.max_age:
+                self._shed(self._waiting.pop(entry.valve.name), "stale")
+                continue
+
+            queue = self.queues.get(entry.valve.name)
+            busy = queue is not None and queue.running
+            if not busy and self.running >= self.max_running:
+                # a new worker is needed, but the commands of the running valves can still be forwarded
+                continue
+
+            wait = self._take_token(entry.valve.name, now)
+            if wait:
+                next_token = wait if next_token is None else min(next_token, wait)
+                continue
+
+            del self._waiting[entry.valve.name]
+            self._forward(entry)
+
+        return next_token
+
+    def _forward(self, entry: _IntakeEntry):
+        queue = self.queues.get(entry.valve.name)
+        if queue is None:
+            queue = ValveCommandQueue(entry.valve.name, self._execute_of(entry.valve),
+                                      functools.partial(self._create_worker, entry.valve.name))
+            self.queues[entry.valve.name] = queue
+        elif queue.closing:
+            # the valve was added back while the worker of its removed queue was running
+            queue.closing = False
+            queue.rebind(self._execute_of(entry.valve))
+
+        def on_done(done: asyncio.Future):
+            if done.cancelled():
+                entry.future.cancel()
+                return
+            if done.result() is None:
+                # collapsed by the valve queue with a command asking for the opposite state
+                self._shed(entry, "superseded")
+            self._resolve(entry.future, done.result())
+
+        queue.submit(entry.desired_state, entry.proxy_hostname).add_done_callback(on_done)
+
+    def _create_worker(self, valve_name: str, coroutine: Awaitable) -> asyncio.Task:
+        task = self._create_task(coroutine)
+        self.running += 1
+        task.add_done_callback(functools.partial(self._on_worker_done, valve_name))
+        return task
+
+    def _on_worker_done(self, valve_name: str, _: asyncio.Task):
+        self.running -= 1
+        queue = self.queues.get(valve_name)
+        if queue is not None and queue.closing and not queue.running:
+            del self.queues[valve_name]
+        self.dispatch()
+        # the time until the next command token may have changed
+        self._wakeup.set()
+
+    async def dispatch_task(self, exited: asyncio.Event):
+        """
+        This task forwards the waiting commands when a valve gets a new command token, and sheds the stale ones
+        """
+        while not exited.is_set():
+            try:
+                self._wakeup.clear()
+                next_token = self.dispatch()
+
+                wakeup = asyncio.ensure_future(self._wakeup.wait())
+                exit_wait = asyncio.ensure_future(exited.wait())
+                timeout = min(next_token, self.max_age) if next_token is not None else \
+                    (self.max_age if self._waiting else None)
+                try:
+                    await asyncio.wait((wakeup, exit_wait), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    wakeup.cancel()
+                    exit_wait.cancel()
+            except Exception as ex:
+                self.log.exception("Error in dispatch_task: ")
+
+        # the waiting commands will never run
+        for entry in list(self._waiting.values()):
+            self._resolve(entry.future, None)
+        self._waiting.clear()
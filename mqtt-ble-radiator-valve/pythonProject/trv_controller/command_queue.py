@@ -0,0 +1,117 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class ValveCommandQueue:
+    """
+    Serialises the commands of a single valve: at most one BLE transaction per valve runs at a time.
+
+    Only the latest desired state is kept while a transaction is running (last writer wins), so a burst of
+    toggles costs at most two transactions. A command asking for the state that the running transaction is
+    already applying is dropped.
+
+    Each command gets a future, resolved with the outcome of the transaction applying its state (True or False),
+    or with None when a command asking for the opposite state supersedes it.
+    """
+
+    def __init__(self,
+                 valve_name: str,
+                 execute: Callable[[bool, str | None], Awaitable[bool]],
+                 create_task: Callable[[Awaitable], asyncio.Task]):
+        self.valve_name = valve_name
+        self._execute = execute
+        self._create_task = create_task
+
+        # the desired state, the proxy to try first (if planned, see `plan_batch`) and the waiting futures
+        self._pending: bool | None = None
+        self._pending_proxy: str | None = None
+        self._pending_futures: list[asyncio.Future] = []
+        self._in_flight: bool | None = None
+        self._in_flight_futures: list[asyncio.Future] = []
+        self._worker: asyncio.Task | None = None
+
+        # set when the valve is removed while the worker is running: the queue is forgotten when the worker ends
+        self.closing = False
+
+        # metrics
+        self.coalesced = 0  # pending commands replaced by a newer one
+        self.satisfied = 0  # commands dropped because the running transaction already applies that state
+        self.executed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None
+
+    @property
+    def depth(self) -> int:
+        return int(self._pending is not None) + int(self._in_flight is not None)
+
+    def submit(self, desired_state: bool, proxy_hostname: str | None = None) -> asyncio.Future:
+        """
+        Queues a command, `proxy_hostname` being the proxy to try first (None to rank them at execution time).
+        The returned future does not need to be awaited.
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        if self._pending is not None:
+            self.coalesced += 1
+            if self._pending == desired_state:
+                future_list = self._pending_futures
+            else:
+                self._resolve(self._pending_futures, None)
+                future_list = []
+            self._pending, self._pending_proxy, self._pending_futures = None, None, future_list
+
+        if self._in_flight is not None and self._in_flight == desired_state:
+            self.satisfied += 1
+            self._in_flight_futures.append(future)
+            return future
+
+        self._pending, self._pending_proxy = desired_state, proxy_hostname
+        self._pending_futures.append(future)
+        if self._worker is None:
+            self._worker = self._create_task(self._run())
+        return future
+
+    def rebind(self, execute: Callable[[bool, str | None], Awaitable[bool]]):
+        """
+        Replaces the transaction function from the next command on (e.g. the valve config has been reloaded)
+        """
+        self._execute = execute
+
+    @staticmethod
+    def _resolve(futures: list[asyncio.Future], result: bool | None):
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        try:
+            while self._pending is not None:
+                self._in_flight, self._in_flight_futures = self._pending, self._pending_futures
+                proxy_hostname = self._pending_proxy
+                self._pending, self._pending_proxy, self._pending_futures = None, None, []
+                done = False
+                try:
+                    done = await self._execute(self._in_flight, proxy_hostname)
+                    if not done:
+                        self.failed += 1
+                finally:
+                    self.executed += 1
+                    self._resolve(self._in_flight_futures, done)
+                    self._in_flight, self._in_flight_futures = None, []
+        finally:
+            self._worker = None
+            # the worker is cancelled only on shutdown
+            for future in self._pending_futures:
+                future.cancel()
+
+    def as_attributes(self) -> dict:
+        return {
+            "queue_depth": self.depth,
+            "coalesced_commands": self.coalesced,
+            "satisfied_commands": self.satisfied,
+            "executed_commands": self.executed,
+            "failed_commands": self.failed,
+        }
@@ -0,0 +1,90 @@
+import asyncio
+import contextlib
+import logging
+import os
+from typing import Awaitable, Callable
+
+import yaml
+
+
+class ConfigWatcher:
+    """
+    Watches the YAML config file, and calls `on_change` with the new config when its content changes.
+
+    The file is polled every `interval` seconds (its modification time and size only, it is parsed when they
+    change). A config that cannot be read or parsed is logged and ignored, as well as a config rejected by
+    `on_change` (i.e. raising an exception): the running config is kept until the file is fixed.
+    """
+
+    def __init__(self, path: str, config: dict, on_change: Callable[[dict], Awaitable[None]], interval: float = 5.0):
+        self.log = logging.getLogger("config-watcher")
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+
+        # the last applied config, and the modification time and size of the file it was read from
+        self.config = config
+        self._stat = self._file_stat()
+
+        # metrics
+        self.reloads = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, path: str, config: dict, on_change: Callable[[dict], Awaitable[None]]):
+        return cls(path, config, on_change,
+                   interval=(config.get("config_reload") or {}).get("interval", 5.0))
+
+    def _file_stat(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def check(self):
+        """
+        Reads the config file if it was modified, and applies it if its content changed
+        """
+        stat = self._file_stat()
+        if stat is None or stat == self._stat:
+            return
+        self._stat = stat
+
+        try:
+            with open(self.path, "r") as file:
+                config = yaml.safe_load(file)
+            if not isinstance(config, dict):
+                raise ValueError("The config file is not a YAML mapping")
+        except Exception as ex:
+            self.errors += 1
+            self.log.error(f"Cannot read the modified config file {self.path}, keeping the running config: {ex!r}")
+            return
+
+        if config == self.config:
+            return
+
+        self.log.info(f"Applying the modified config file {self.path}")
+        try:
+            await self.on_change(config)
+        except Exception as ex:
+            self.errors += 1
+            self.log.exception("Cannot apply the modified config, keeping the running config: ")
+            return
+
+        self.config = config
+        self.reloads += 1
+
+    async def watch_task(self, exited: asyncio.Event):
+        """
+        This task periodically checks the config file
+        """
+        while not exited.is_set():
+            try:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(exited.wait(), self.interval)
+
+                if not exited.is_set():
+                    await self.check()
+            except Exception as ex:
+                self.log.exception("Error in watch_task: ")
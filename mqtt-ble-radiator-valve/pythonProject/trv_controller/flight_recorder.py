@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+
+# timestamp (wall clock), address (valve MAC), kind, data length, value, code, data (truncated or zero-padded)
+_RECORD = struct.Struct("<dQBBiH40s")
+RECORD_SIZE = _RECORD.size
+DATA_SIZE = 40
+
+
+def _mac_str(address: int) -> str:
+    return ":".join(f"{byte:02x}" for byte in address.to_bytes(6, "big"))
+
+
+class FrameRing:
+    """
+    Ring of fixed-size binary records in a preallocated buffer, the oldest record being overwritten when full.
+    Recording packs the raw values only, the records are decoded by `records` when dumped.
+    """
+    SENT = 1  # request frame written to the valve (value: packet number, code: function)
+    RECEIVED = 2  # raw notification fragment received from the valve
+    FRAME = 3  # decoded frame (value: packet number, code: function, data: payload)
+    ERROR_FRAME = 4  # decoded error frame, i.e. "Bad Data Received" (value: packet number, code: function)
+    CHECKSUM_ERROR = 5  # frames dropped by the decoder (value: count)
+    TIMEOUT = 6  # no response to a request in time (value: packet number)
+    CONNECTION_LOST = 7  # GATT connection lost (value: error)
+    ADVERTISEMENT = 8  # valve advertisement heard by a proxy (value: RSSI, data: raw advertisement)
+
+    KIND_NAMES = {SENT: "sent", RECEIVED: "received", FRAME: "frame", ERROR_FRAME: "error_frame",
+                  CHECKSUM_ERROR: "checksum_error", TIMEOUT: "timeout", CONNECTION_LOST: "connection_lost",
+                  ADVERTISEMENT: "advertisement"}
+
+    __slots__ = ("capacity", "_buffer", "_written")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity * RECORD_SIZE)
+        # records written since the creation, the next one is written at `_written % capacity`
+        self._written = 0
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def record(self, kind: int, address: int, value: int = 0, code: int = 0, data: bytes = b""):
+        # a single pack, the data being truncated or padded by the struct
+        written = self._written
+        _RECORD.pack_into(self._buffer, written % self.capacity * RECORD_SIZE, time.time(), address, kind,
+                          len(data) if len(data) < 256 else 255, value, code,
+                          data if data.__class__ is bytes else bytes(data))
+        self._written = written + 1
+
+    def records(self) -> list[dict]:
+        """
+        Returns the records, the oldest first
+        """
+        records = []
+        for i in range(self._written - len(self), self._written):
+            timestamp, address, kind, length, value, code, data = \
+                _RECORD.unpack_from(self._buffer, i % self.capacity * RECORD_SIZE)
+            records.append({
+                "time": round(timestamp, 6),
+                "kind": self.KIND_NAMES.get(kind, kind),
+                "address": _mac_str(address),
+                "value": value,
+                "code": code,
+                "data": data[:length].hex(),
+                "truncated": length > DATA_SIZE,
+            })
+        return records
+
+
+class FlightRecorder:
+    """
+    Keeps the last BLE traffic of each valve (request frames, notification fragments, decoded frames, timeouts
+    and lost connections) and the last valve advertisements heard by each proxy, for the post-mortem analysis
+    of the failed transactions.
+
+    The traffic is recorded in preallocated binary rings (see `FrameRing`) of `valve_records` records per valve
+    and `proxy_records` records per proxy: nothing is formatted until a dump is requested. A dump is a JSON file
+    written in `dump_dir`; with `dump_on_failure` the records of a valve are dumped when one of its commands fails
+    (the file of the last failure of each valve is kept).
+    """
+
+    def __init__(self, valve_records: int = 256, proxy_records: int = 1024, dump_dir: str = ".",
+                 dump_on_failure: bool = True):
+        self.log = logging.getLogger("flight-recorder")
+        self.valve_records = valve_records
+        self.proxy_records = proxy_records
+        self.dump_dir = dump_dir
+        self.dump_on_failure = dump_on_failure
+
+        # key is the valve MAC (as int)
+        self.valves: dict[int, FrameRing] = dict()
+
+        # key is the proxy hostname
+        self.proxies: dict[str, FrameRing] = dict()
+
+        # metrics
+        self.dumps = 0
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(valve_records=config.get("valve_records", 256),
+                   proxy_records=config.get("proxy_records", 1024),
+                   dump_dir=config.get("dump_dir", "."),
+                   dump_on_failure=config.get("dump_on_failure", True))
+
+    def valve_ring(self, mac_address: int) -> FrameRing:
+        ring = self.valves.get(mac_address)
+        if ring is None:
+            ring = self.valves[mac_address] = FrameRing(self.valve_records)
+        return ring
+
+    def proxy_ring(self, hostname: str) -> FrameRing:
+        ring = self.proxies.get(hostname)
+        if ring is None:
+            ring = self.proxies[hostname] = FrameRing(self.proxy_records)
+        return ring
+
+    def forget_valve(self, mac_address: int):
+        self.valves.pop(mac_address, None)
+
+    def forget_proxy(self, hostname: str):
+        self.proxies.pop(hostname, None)
+
+    def dump(self, valve_names: dict[int, str], target: str | None = None) -> dict:
+        """
+        Returns the records of a valve (with its advertisements heard by each proxy) or of a proxy, by name,
+        or all of them when `target` is None. `valve_names` gives the name of the valves by MAC.
+        """
+        valves = {mac_address: ring for mac_address, ring in self.valves.items()
+                  if target is None or valve_names.get(mac_address) == target}
+        proxies = {hostname: ring.records() for hostname, ring in self.proxies.items()
+                   if target is None or target == hostname or valves}
+        if target is not None and valves:
+            addresses = {_mac_str(mac_address) for mac_address in valves}
+            proxies = {hostname: [record for record in records if record["address"] in addresses]
+                       for hostname, records in proxies.items()}
+
+        return {
+            "dumped_at": time.time(),
+            "valves": {valve_names.get(mac_address, _mac_str(mac_address)): ring.records()
+                       for mac_address, ring in valves.items()},
+            "proxies": proxies,
+        }
+
+    def _write(self, path: str, payload: bytes):
+        os.makedirs(self.dump_dir, exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(payload)
+
+    async def dump_to_file(self, valve_names: dict[int, str], target: str | None = None,
+                           failure: bool = False) -> tuple[str, int]:
+        """
+        Dumps the records (see `dump`) to a JSON file, written by a worker thread.
+        Returns the path of the file and the number of records.
+        """
+        if failure:
+            path = os.path.join(self.dump_dir, f"flight-recorder-{target}-failure.json")
+        else:
+            path = os.path.join(self.dump_dir, f"flight-recorder-{time.strftime('%Y%m%d-%H%M%S')}-{self.dumps}.json")
+
+        # decoded on the event loop, the rings are not modified meanwhile
+        dump = self.dump(valve_names, target)
+        records = sum(len(records) for records in dump["valves"].values()) + \
+            sum(len(records) for records in dump["proxies"].values())
+        await asyncio.to_thread(self._write, path, json.dumps(dump, separators=(",", ":")).encode())
+        self.dumps += 1
+        self.log.info(f"Dumped {records} records to {path}")
+        return path, records
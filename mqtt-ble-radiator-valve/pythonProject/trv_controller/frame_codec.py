@@ -0,0 +1,198 @@
+"""
+Encoder/decoder of the frames exchanged with the radiator valves.
+
+    AA AA <len> <function> <group hi> <group lo> <packet number> <payload...> <checksum>
+
+`len` counts the (unstuffed) bytes of the frame, checksum excluded, and the checksum is the sum of the bytes
+following `len` (checksum excluded) modulo 256, the 0x55 bytes being left out of the sum as the valves do.
+Everything after `len` is byte-stuffed: a 0x55 is inserted after each 0xAA, such that an `AA AA` sequence
+can only be found at the start of a frame.
+"""
+
+FRAME_START = b"\xaa\xaa"
+STUFFED_AA = b"\xaa\x55"
+HEADER_LENGTH = 3  # AA AA <len>
+MIN_FRAME_LENGTH = 7  # header + function + group (2 bytes) + packet number
+
+
+def checksum(data: bytes) -> int:
+    # the 0x55 bytes are not summed, whether they are escape bytes or not
+    return (sum(data) - 0x55 * data.count(0x55)) & 0xFF
+
+
+def stuff(data: bytes) -> bytes:
+    return data.replace(b"\xaa", STUFFED_AA)
+
+
+def unstuff(data: bytes) -> bytes:
+    return data.replace(STUFFED_AA, b"\xaa")
+
+
+def encode_frame(function: int, packet_number: int, payload: bytes = b"", group: int = 0x0000) -> bytes:
+    body = bytes((function, group >> 8, group & 0xFF, packet_number)) + payload
+    return (FRAME_START +
+            bytes((HEADER_LENGTH + len(body),)) +
+            stuff(body + bytes((checksum(body),))))
+
+
+class Frame:
+    """
+    A decoded (unstuffed and checksum verified) frame
+    """
+    __slots__ = ("function", "group", "packet_number", "payload", "raw")
+
+    def __init__(self, function: int, group: int, packet_number: int, payload: bytes, raw: bytes):
+        self.function = function
+        self.group = group
+        self.packet_number = packet_number
+        self.payload = payload
+        self.raw = raw  # the frame as received (stuffed)
+
+    @property
+    def is_error(self) -> bool:
+        # the valve answers with 0xFF in the function/group bytes to a request it does not accept
+        return self.function == 0xFF or (self.group >> 8) == 0xFF
+
+    def __repr__(self):
+        return (f"Frame(function={self.function:#04x}, group={self.group:#06x}, "
+                f"packet_number={self.packet_number}, payload={bytes(self.payload).hex()})")
+
+
+class FrameTemplate:
+    """
+    A precomputed frame whose content is fixed except for the packet number.
+    Only the packet number byte and the checksum are filled in when encoding.
+    """
+    __slots__ = ("function", "payload", "group", "_prefix", "_suffix", "_partial_checksum")
+
+    def __init__(self, function: int, payload: bytes = b"", group: int = 0x0000):
+        self.function = function
+        self.payload = bytes(payload)
+        self.group = group
+
+        head = bytes((function, group >> 8, group & 0xFF))
+        self._prefix = FRAME_START + bytes((HEADER_LENGTH + len(head) + 1 + len(self.payload),)) + stuff(head)
+        self._suffix = stuff(self.payload)
+        self._partial_checksum = checksum(head) + checksum(self.payload)
+
+    def encode(self, packet_number: int) -> bytes:
+        frame_checksum = (self._partial_checksum + (packet_number if packet_number != 0x55 else 0)) & 0xFF
+        if packet_number == 0xAA or frame_checksum == 0xAA:
+            return encode_frame(self.function, packet_number, self.payload, self.group)
+        return self._prefix + bytes((packet_number,)) + self._suffix + bytes((frame_checksum,))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder: it is fed with the received BLE fragments and returns the complete frames.
+
+    Bytes that cannot belong to a frame are skipped, a frame interrupted by the start of another one is discarded,
+    and frames with a wrong checksum are dropped (and counted in `checksum_errors`).
+    """
+    __slots__ = ("_buffer", "_skip_escape", "checksum_errors", "discarded_bytes")
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._skip_escape = False
+        self.checksum_errors = 0
+        self.discarded_bytes = 0
+
+    def reset(self):
+        self._buffer.clear()
+        self._skip_escape = False
+
+    def _discard(self, count: int):
+        del self._buffer[:count]
+        self.discarded_bytes += count
+
+    def feed(self, data) -> list[Frame]:
+        buffer = self._buffer
+
+        if self._skip_escape and data:
+            # the previous frame ended with a stuffed 0xAA checksum, whose 0x55 arrives in this fragment
+            self._skip_escape = False
+            if data[0] == 0x55:
+                # a copy (bytes or bytearray), the fast path below needs `find`
+                data = data[1:]
+
+        size = len(data)
+        if not buffer and size > MIN_FRAME_LENGTH and data[2] + 1 == size and data.startswith(FRAME_START) \
+                and data.find(0xAA, HEADER_LENGTH) < 0:
+            # fast path: a whole frame without stuffing in a single fragment
+            raw = bytes(data)
+            frame = self._decode(raw, raw[HEADER_LENGTH:])
+            return [frame] if frame is not None else []
+
+        buffer += data
+        frames = []
+
+        while buffer:
+            start = buffer.find(FRAME_START)
+            if start < 0:
+                # keep a trailing 0xAA, it can be the first half of the next frame start
+                self._discard(len(buffer) - 1 if buffer.endswith(b"\xaa") else len(buffer))
+                return frames
+
+            if start:
+                self._discard(start)
+
+            if len(buffer) < HEADER_LENGTH:
+                return frames
+
+            length = buffer[2]
+            if length == 0xAA:
+                # AA AA AA: the frame starts at the next byte
+                self._discard(1)
+                continue
+
+            if length < MIN_FRAME_LENGTH:
+                self._discard(2)
+                continue
+
+            # the frame ends after `length` unstuffed bytes plus the checksum
+            unstuffed_length = length - HEADER_LENGTH + 1
+            end = HEADER_LENGTH + unstuffed_length
+
+            stuffed = buffer.find(b"\xaa", HEADER_LENGTH, end) >= 0
+            if stuffed:
+                while True:
+                    stuffed_end = (HEADER_LENGTH + unstuffed_length +
+                                   buffer.count(STUFFED_AA, HEADER_LENGTH, end + 1))
+                    if stuffed_end == end:
+                        break
+                    end = stuffed_end
+
+                restart = buffer.find(FRAME_START, HEADER_LENGTH, end)
+                if restart >= 0:
+                    # a new frame starts before the end of this one: this frame is truncated
+                    self._discard(restart)
+                    continue
+
+            if len(buffer) < end:
+                return frames
+
+            raw = bytes(buffer[:end])
+            del buffer[:end]
+
+            if stuffed:
+                body = unstuff(raw[HEADER_LENGTH:])
+                if raw[-1] == 0xAA and not buffer:
+                    self._skip_escape = True
+            else:
+                body = raw[HEADER_LENGTH:]
+
+            frame = self._decode(raw, body)
+            if frame is not None:
+                frames.append(frame)
+
+        return frames
+
+    def _decode(self, raw: bytes, body: bytes) -> Frame | None:
+        # `checksum` inlined: this runs for every received frame
+        frame_checksum = body[-1]
+        if (sum(body) - frame_checksum - 0x55 * body.count(0x55, 0, -1)) & 0xFF != frame_checksum:
+            self.checksum_errors += 1
+            return None
+
+        # function, group, packet number, payload (a copy, cheaper than a view for a few bytes), raw frame
+        return Frame(body[0], (body[1] << 8) | body[2], body[3], body[4:-1], raw)
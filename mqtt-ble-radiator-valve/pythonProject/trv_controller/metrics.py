@@ -0,0 +1,216 @@
+"""
+Minimal Prometheus instrumentation, served as text on `/metrics` by `MetricsServer`.
+
+The instrumented code only increments counters and observes histograms (a few attribute updates and a bisect);
+the values that are already counted elsewhere (e.g. the advertisements counters of `AdvertisementIngestor`)
+are read at scrape time by callback metrics, so they cost nothing on the hot paths.
+"""
+import asyncio
+import bisect
+import logging
+import time
+from typing import Callable, Iterable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, suited for the BLE round-trips (tens of ms) up to the connections (seconds)
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        yield f"{name}{labels} {self.value}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # the failed steps are not observed, they would blur the latency of the successful ones
+        if exc_type is None:
+            self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        """
+        Context manager observing the time spent in its block (if it does not raise)
+        """
+        return _Timer(self)
+
+    def samples(self, name: str, labelnames: tuple[str, ...], values: tuple) -> Iterable[str]:
+        labels = _format_labels(labelnames, values)
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            bucket_labels = _format_labels(labelnames, values, f'le="{bound}"')
+            yield f"{name}_bucket{bucket_labels} {cumulative}"
+        bucket_labels = _format_labels(labelnames, values, 'le="+Inf"')
+        yield f"{name}_bucket{bucket_labels} {self.count}"
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class MetricFamily:
+    """
+    A named metric, with one child metric per label values (`labels`).
+    The children are created once and can be kept by the instrumented code.
+    """
+
+    def __init__(self, name: str, kind: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 factory: Callable = None):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._factory = factory or (Counter if kind == "counter" else Histogram)
+        self._children: dict[tuple, Counter | Histogram] = dict()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self._children.items():
+            if isinstance(child, Histogram):
+                yield from child.samples(self.name, self.labelnames, values)
+            else:
+                yield from child.samples(self.name, _format_labels(self.labelnames, values))
+
+
+class CallbackMetric:
+    """
+    A metric whose samples are collected at scrape time: `collect` returns (label values, value) pairs
+    """
+
+    def __init__(self, name: str, kind: str, documentation: str, labelnames: tuple[str, ...],
+                 collect: Callable[[], Iterable[tuple[tuple, float]]]):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, value in self.collect():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {float(value)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.log = logging.getLogger("metrics")
+        self._metrics: dict[str, MetricFamily | CallbackMetric] = dict()
+
+    def register(self, *metrics: MetricFamily | CallbackMetric):
+        for metric in metrics:
+            self._metrics[metric.name] = metric
+
+    def add_callback(self, name: str, kind: str, documentation: str,
+                     collect: Callable[[], Iterable[tuple[tuple, float]]], labelnames: tuple[str, ...] = ()):
+        self.register(CallbackMetric(name, kind, documentation, labelnames, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                self.log.exception(f"Error while collecting {metric.name}: ")
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry on `http://<host>:<port>/metrics`
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str = "0.0.0.0", port: int = 9101):
+        self.log = logging.getLogger("metrics")
+        self.registry = registry
+        self.host = host
+        self.port = port
+
+    @classmethod
+    def from_config(cls, registry: MetricsRegistry, config: dict):
+        return cls(registry, host=config.get("host", "0.0.0.0"), port=config.get("port", 9101))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # the headers are not used, but they are read before answering
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", CONTENT_TYPE, self.registry.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not Found\n"
+
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_task(self, exited: asyncio.Event):
+        """
+        This task serves the metrics until exit
+        """
+        try:
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError:
+            self.log.exception(f"Cannot serve the metrics on {self.host}:{self.port}: ")
+            return
+
+        self.log.info(f"Serving the metrics on http://{self.host}:{self.port}/metrics")
+        async with server:
+            await exited.wait()
@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Callable
+
+from aiomqtt import Client
+
+from trv_controller.valve_registry import ValveConfig
+
+
+class CoalescingPublisher:
+    """
+    Publishes the valves attributes and availability on MQTT from a single task.
+
+    The producers only mark a valve as dirty, and the dirty valves are flushed every `flush_interval` seconds:
+    the attributes are published when an RSSI moved by at least `rssi_threshold` dB (or another attribute
+    changed) since the last publication, and the availability when it differs from the last published one.
+    Everything is published again after `reset` (e.g. on MQTT reconnection).
+    """
+
+    def __init__(self,
+                 attributes_of: Callable[[ValveConfig], tuple[dict[str, float], dict]],
+                 flush_interval: float = 5.0,
+                 rssi_threshold: float = 2.0):
+        self.log = logging.getLogger("publisher")
+        self.attributes_of = attributes_of
+        self.flush_interval = flush_interval
+        self.rssi_threshold = rssi_threshold
+
+        self._dirty_attributes: set[ValveConfig] = set()
+        self._dirty_availability: dict[ValveConfig, bool] = dict()
+
+        # last published values, key is the valve name
+        self._published_rssi: dict[str, dict[str, float]] = dict()
+        self._published_attributes: dict[str, dict] = dict()
+        self._published_availability: dict[str, bool] = dict()
+
+        # metrics
+        self.published = 0
+        self.suppressed = 0
+
+    @classmethod
+    def from_config(cls, attributes_of: Callable[[ValveConfig], tuple[dict[str, float], dict]], config: dict):
+        return cls(attributes_of,
+                   flush_interval=config.get("attributes_flush_interval", 5.0),
+                   rssi_threshold=config.get("rssi_threshold", 2.0))
+
+    def mark_attributes_dirty(self, valve: ValveConfig):
+        self._dirty_attributes.add(valve)
+
+    def set_availability(self, valve: ValveConfig, online: bool):
+        if self._published_availability.get(valve.name) == online:
+            self._dirty_availability.pop(valve, None)
+            self.suppressed += 1
+            return
+        self._dirty_availability[valve] = online
+
+    def forget(self, valve: ValveConfig):
+        """
+        Discards the pending and the published values of a valve (e.g. removed from the config)
+        """
+        self._dirty_attributes.discard(valve)
+        self._dirty_availability.pop(valve, None)
+        self._published_rssi.pop(valve.name, None)
+        self._published_attributes.pop(valve.name, None)
+        self._published_availability.pop(valve.name, None)
+
+    def reset(self):
+        """
+        Forgets the published values, so that the next changes are published whatever their size
+        """
+        self._published_rssi.clear()
+        self._published_attributes.clear()
+        self._published_availability.clear()
+
+    def _rssi_changed(self, valve: ValveConfig, rssi_map: dict[str, float]) -> bool:
+        published = self._published_rssi.get(valve.name)
+        if published is None or published.keys() != rssi_map.keys():
+            return True
+        return any(abs(rssi - published[hostname]) >= self.rssi_threshold for hostname, rssi in rssi_map.items())
+
+    async def flush(self, client: Client):
+        dirty_availability, self._dirty_availability = self._dirty_availability, dict()
+        for valve, online in dirty_availability.items():
+            await client.publish(valve.availability_topic, "online" if online else "offline", retain=True)
+            self._published_availability[valve.name] = online
+            self.published += 1
+
+        dirty_attributes, self._dirty_attributes = self._dirty_attributes, set()
+        for valve in dirty_attributes:
+            rssi_map, attributes = self.attributes_of(valve)
+            if not self._rssi_changed(valve, rssi_map) and self._published_attributes.get(valve.name) == attributes:
+                self.suppressed += 1
+                continue
+
+            payload = {f"{hostname} RSSI": f"{int(rssi)} dBm" for hostname, rssi in rssi_map.items()}
+            payload.update(attributes)
+            await client.publish(valve.attributes_topic, json.dumps(payload))
+
+            self._published_rssi[valve.name] = dict(rssi_map)
+            self._published_attributes[valve.name] = dict(attributes)
+            self.published += 1
+
+        if dirty_availability or dirty_attributes:
+            self.log.debug("Flushed %d availability and %d attributes updates - published: %d, suppressed: %d",
+                           len(dirty_availability), len(dirty_attributes), self.published, self.suppressed)
+
+    async def publish_task(self, exited: asyncio.Event, get_client: Callable[[], Client | None]):
+        """
+        This task periodically publishes the dirty valves
+        """
+        while not exited.is_set():
+            try:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(exited.wait(), self.flush_interval)
+
+                client = get_client()
+                if client is not None:
+                    await self.flush(client)
+            except Exception as ex:
+                self.log.exception("Error in publish_task: ")
+
+    def as_attributes(self) -> dict:
+        return {
+            "published_messages": self.published,
+            "suppressed_messages": self.suppressed,
+        }
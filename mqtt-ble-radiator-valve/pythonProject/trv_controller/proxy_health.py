@@ -0,0 +1,97 @@
+import time
+
+
+class ProxyHealth:
+    """
+    Health model of an ESPHome bluetooth proxy, with a circuit breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and the proxy is skipped for `cooldown`
+    seconds. Then the circuit is half-open: a single probe command is let through, and its outcome closes the
+    circuit again or reopens it for another cool-down period.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, hostname: str, failure_threshold: int = 3, cooldown: float = 60.0, alpha: float = 0.2):
+        self.hostname = hostname
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+
+        self.api_connected = False
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+        self.success_rate = 1.0  # EWMA of the command outcomes
+        self.connect_latency: float | None = None  # EWMA of the BLE connection time, seconds
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, hostname: str, config: dict):
+        return cls(hostname,
+                   failure_threshold=config.get("failure_threshold", 3),
+                   cooldown=config.get("cooldown", 60.0))
+
+    def _cooldown_elapsed(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.cooldown
+
+    def is_available(self) -> bool:
+        """
+        True if a command can be sent through the proxy now (it does not change the circuit state)
+        """
+        if not self.api_connected:
+            return False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return self._cooldown_elapsed()
+        return not self.probe_in_flight
+
+    def on_attempt(self):
+        """
+        To be called when a command is sent through the proxy: an expired open circuit becomes half-open,
+        and the command is its probe.
+        """
+        if self.state == self.OPEN and self._cooldown_elapsed():
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = True
+
+    def on_attempt_cancelled(self):
+        self.probe_in_flight = False
+
+    def record_success(self, connect_latency: float | None = None):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.success_rate = (1 - self.alpha) * self.success_rate + self.alpha
+        if connect_latency is not None:
+            self.connect_latency = connect_latency if self.connect_latency is None else \
+                (1 - self.alpha) * self.connect_latency + self.alpha * connect_latency
+
+        self.probe_in_flight = False
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.success_rate = (1 - self.alpha) * self.success_rate
+
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def as_attributes(self) -> dict:
+        return {
+            "api_connected": self.api_connected,
+            "circuit": self.state,
+            "success_rate": round(self.success_rate, 3),
+            "connect_latency_s": round(self.connect_latency, 3) if self.connect_latency is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+        }
@@ -1,18 +1,73 @@
 import asyncio
 import logging
+import random
+import time
 from binascii import hexlify
 import re
 
 import aioesphomeapi
-from aioesphomeapi import BluetoothLEAdvertisement
+from aioesphomeapi import APIConnectionError, BluetoothLEAdvertisement
+from aioesphomeapi.core import BluetoothConnectionDroppedError, BluetoothGATTAPIError, TimeoutAPIError
+
+from trv_controller.flight_recorder import FrameRing
+from trv_controller.frame_codec import Frame, FrameDecoder, FrameTemplate, encode_frame
+from trv_controller.metrics import Histogram, MetricFamily
 
 WRITE_CHARACTERISTIC_UUID = "0000ffe9-0000-1000-8000-00805f9b34fb"
 logging.getLogger("aioesphomeapi").setLevel(logging.WARNING)
 
+# metrics of the BLE transactions, shared by all the valves (registered by the manager)
+PHASE_SECONDS = MetricFamily("trv_valve_phase_seconds", "histogram",
+                             "Duration of the successful phases of the valve BLE transactions", ("phase",))
+RETRIES = MetricFamily("trv_valve_retries_total", "counter",
+                       "Valve operation attempts that failed and were retried", ("operation",))
+CHECKSUM_ERRORS = MetricFamily("trv_valve_checksum_errors_total", "counter",
+                               "Frames received from the valves with a wrong checksum")
+BAD_DATA = MetricFamily("trv_valve_bad_data_total", "counter",
+                        "Error frames received from the valves (\"Bad Data Received\")")
+WRITES_SKIPPED = MetricFamily("trv_valve_writes_skipped_total", "counter",
+                              "Valve commands that skipped the writes, the valve already having the setpoint")
 
-class RadiatorValve:
 
-    def __init__(self, mac_address: str, cli: aioesphomeapi.APIClient, on_temperature=35, off_temperature=7):
+def _observe_response_time(future: asyncio.Future, histogram: Histogram):
+    """
+    Observes the time from now to the (successful) response of a request
+    """
+    started = time.perf_counter()
+
+    def observe(done: asyncio.Future):
+        if not done.cancelled() and done.exception() is None:
+            histogram.observe(time.perf_counter() - started)
+
+    future.add_done_callback(observe)
+
+
+class RadiatorValve:
+    SYNC_PACKET_FUNCTION_CODE = 0x01
+    TEMPERATURE_FUNCTION_CODE = 0x0C
+
+    _SYNC_FRAME = FrameTemplate(SYNC_PACKET_FUNCTION_CODE)
+    _READ_TEMPERATURE_FRAME = FrameTemplate(TEMPERATURE_FUNCTION_CODE)
+
+    # the API errors caused by the valve: out of range or busy (connection timeout), dropped GATT connection, GATT error
+    _VALVE_ERRORS = (TimeoutAPIError, BluetoothConnectionDroppedError, BluetoothGATTAPIError)
+
+    _CONNECT_SECONDS = PHASE_SECONDS.labels("connect")
+    _START_NOTIFY_SECONDS = PHASE_SECONDS.labels("start_notify")
+    _PACKET_SYNC_SECONDS = PHASE_SECONDS.labels("packet_sync")
+    _READ_SECONDS = PHASE_SECONDS.labels("read")
+    _MODE_WRITE_SECONDS = PHASE_SECONDS.labels("mode_write")
+    _SETPOINT_WRITE_SECONDS = PHASE_SECONDS.labels("setpoint_write")
+    _READBACK_SECONDS = PHASE_SECONDS.labels("readback")
+    _DISCONNECT_SECONDS = PHASE_SECONDS.labels("disconnect")
+    _SET_STATE_RETRIES = RETRIES.labels("set_state")
+    _READ_RETRIES = RETRIES.labels("read_temperature")
+    _CHECKSUM_ERRORS = CHECKSUM_ERRORS.labels()
+    _BAD_DATA = BAD_DATA.labels()
+    _WRITES_SKIPPED = WRITES_SKIPPED.labels()
+
+    def __init__(self, mac_address: str, cli: aioesphomeapi.APIClient, on_temperature=35, off_temperature=7,
+                 keep_connected=False):
         self.cli = cli
         self.mac_address_int = RadiatorValve.mac_to_int(mac_address)
         self.mac_str = mac_address
@@ -21,105 +76,299 @@ class RadiatorValve:
         self.off_temperature = off_temperature
         self.on_temperature = on_temperature
 
+        # when True the GATT connection (and the notify subscription) is left open after a command,
+        # such that the next command can skip the connect + packet number sync (see `ValveSessionPool`)
+        self.keep_connected = keep_connected
+        self.connected = False
+        self.lock = asyncio.Lock()
+        self._connection_state_remove = None
+        self._notify_remove = None
+
         self.current_packet_number = 0
         self.current_comfort_temp_dec = 0
-        self.current_resp = []
-        self.received_response_event = asyncio.Event()
-        self.got_response_for_current_temp = False
         self.got_packet_number = False
         self.read_mode = 0
-        self.attempt_delay = 6
-        self.expected_length = 0
+        self.decoder = FrameDecoder()
+
+        # pacing: the response timeout follows the smoothed response time of the valve (seconds), and the
+        # retries are delayed by an exponential backoff with jitter, starting from twice the response time
+        self.response_time: float | None = None
+        self.default_response_timeout = 10.0
+        self.min_response_timeout = 1.0
+        self.retry_base_delay = 0.5
+        self.retry_max_delay = 6.0
+
+        # the last error of the running transaction that the proxy is responsible for: an API request failed on the
+        # proxy connection (the budget exhaustion, the timeouts, the dropped GATT connections and the GATT errors are
+        # the valve's, see `_VALVE_ERRORS`)
+        self.proxy_error: Exception | None = None
+
+        # end of the time budget of the running command (event loop time), see `set_state`
+        self._deadline: float | None = None
+
+        # the setpoint frames only depend on the packet number
+        self._setpoint_frames = {
+            True: FrameTemplate(self.TEMPERATURE_FUNCTION_CODE, self._setpoint_payload(on_temperature)),
+            False: FrameTemplate(self.TEMPERATURE_FUNCTION_CODE, self._setpoint_payload(off_temperature)),
+        }
+
+        # the BLE traffic of the valve is recorded here when set (see `FlightRecorder`)
+        self.recorder: FrameRing | None = None
+
+        # requests waiting for the valve response, key is the packet number of the request
+        self._pending_responses: dict[int, asyncio.Future] = dict()
+
+        # packet number sync: the last packet number accepted by the valve (kept across connections, it is
+        # used as the starting guess of the next sync), the packet number carried by the last received frame
+        # (also the rejected ones), and the number of round-trips spent by the last sync
+        self.last_valve_packet_number: int | None = None
+        self.reported_packet_number: int | None = None
+        self.sync_round_trips = 0
+        self.sync_max_guided_attempts = 2
+        self.sync_max_probes = 255
+        self.sync_probe_timeout = 2
 
         self._reset()
 
     def _on_ble_state(self, connected: bool, mtu: int, error: int) -> None:
-        # print(connected)
-        pass
+        if not connected and self.connected:
+            if self.recorder is not None:
+                self.recorder.record(FrameRing.CONNECTION_LOST, self.mac_address_int, error)
+            self.log.info(f"[{self.mac_str}] BLE connection lost (error: {error})")
+            self.connected = False
+            self.got_packet_number = False
+            self._fail_pending_responses(ConnectionError("BLE connection lost", self.mac_str))
 
     def _reset(self):
-        self.current_packet_number = 0
-        self.current_comfort_temp_dec = 0
-        self.current_resp = []
-        self.received_response_event = asyncio.Event()
-        self.got_response_for_current_temp = False
-        self.got_packet_number = False
-        self.read_mode = 0
-        self.attempt_delay = 6
-        self.expected_length = 0
+        """
+        Resets the state of the current transaction.
+        The packet number is kept while the BLE connection is open, since the valve keeps counting from it.
+        """
+        if not self.connected:
+            self.current_packet_number = 0
+            self.got_packet_number = False
+            self.read_mode = 0
 
-    async def _receive_event_wait(self, timeout=10):
-        await self.received_response_event.wait()
-        out = self.received_response_event.is_set()
-        self.received_response_event.clear()
-        return out
+        self.current_comfort_temp_dec = 0
+        self.proxy_error = None
+        self._fail_pending_responses(ConnectionAbortedError("Transaction reset", self.mac_str))
+
+    def _fail_pending_responses(self, exc: Exception):
+        for future in self._pending_responses.values():
+            if not future.done():
+                future.set_exception(exc)
+                # the exception may never be retrieved if nobody is waiting for the response anymore
+                future.exception()
+        self._pending_responses.clear()
+
+    def _timeout(self, timeout: float) -> float:
+        """
+        Returns `timeout` capped by the time left in the command budget, raises `TimeoutError` if there is none
+        """
+        if self._deadline is None:
+            return timeout
+        remaining = self._deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise TimeoutError("Command time budget exhausted", self.mac_str)
+        return min(timeout, remaining)
+
+    def response_timeout(self) -> float:
+        if self.response_time is None:
+            return self.default_response_timeout
+        return min(max(4 * self.response_time, self.min_response_timeout), self.default_response_timeout)
+
+    def _record_response_time(self, response_time: float):
+        self.response_time = response_time if self.response_time is None else \
+            0.8 * self.response_time + 0.2 * response_time
+
+    def retry_delay(self, failed_attempts: int) -> float:
+        """
+        Exponential backoff with jitter, the base delay being twice the response time of the valve
+        """
+        base_delay = max(self.retry_base_delay, 2 * (self.response_time or 0.0))
+        delay = min(base_delay * 2 ** (failed_attempts - 1), self.retry_max_delay)
+        return random.uniform(delay / 2, delay)
+
+    async def _retry_pause(self, failed_attempts: int):
+        delay = self.retry_delay(failed_attempts)
+        if self._deadline is not None:
+            delay = min(delay, max(self._deadline - asyncio.get_running_loop().time(), 0.0))
+        await asyncio.sleep(delay)
+
+    def _budget_exhausted(self) -> bool:
+        return self._deadline is not None and asyncio.get_running_loop().time() >= self._deadline
+
+    def _expire_response(self, packet_number: int, future: asyncio.Future):
+        if self._pending_responses.get(packet_number) is future:
+            del self._pending_responses[packet_number]
+        if not future.done():
+            if self.recorder is not None:
+                self.recorder.record(FrameRing.TIMEOUT, self.mac_address_int, packet_number)
+            future.set_exception(TimeoutError(f"No response to packet {packet_number}", self.mac_str))
+
+    async def _send_request(self,
+                            function_byte: int,
+                            payload: bytes = b"",
+                            response_timeout: float | None = None,
+                            template: FrameTemplate = None) -> asyncio.Future:
+        """
+        Writes a request frame and returns the future of its response, without waiting for it.
+        The future is resolved by `on_bluetooth_gatt_notify` with the response frame, or it fails with a
+        `TimeoutError` when the response does not arrive within `response_timeout` seconds from now (by default
+        the adaptive `response_timeout()`, always capped by the command budget).
+        Multiple requests can be in flight at the same time, each of them is matched by its packet number.
+        """
+        response_timeout = self._timeout(response_timeout if response_timeout is not None
+                                         else self.response_timeout())
+
+        self.current_packet_number = self._next_packet_number(self.current_packet_number)
+        self.reported_packet_number = None
+        packet_number = self.current_packet_number
+
+        if template is not None:
+            to_send = template.encode(packet_number)
+        else:
+            to_send = encode_frame(function_byte, packet_number, payload)
+
+        if self.recorder is not None:
+            self.recorder.record(FrameRing.SENT, self.mac_address_int, packet_number, function_byte, to_send)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Sending pkt number %d - %s", packet_number, hexlify(to_send))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_responses[packet_number] = future
+        deadline_handle = loop.call_later(response_timeout, self._expire_response, packet_number, future)
+        sent_at = loop.time()
+
+        def on_response(done: asyncio.Future):
+            deadline_handle.cancel()
+            if not done.cancelled() and done.exception() is None:
+                self._record_response_time(loop.time() - sent_at)
+
+        future.add_done_callback(on_response)
+
+        try:
+            await self.cli.bluetooth_gatt_write(address=self.mac_address_int,
+                                                handle=46,
+                                                data=to_send,
+                                                response=True,
+                                                timeout=self._timeout(10))
+        except BaseException:
+            self._pending_responses.pop(packet_number, None)
+            future.cancel()
+            raise
+
+        return future
 
     async def _ble_send_and_wait_response(self,
                                           function_byte: int,
-                                          payload: bytearray = None,
-                                          response_timeout: int = 10):
-        if payload is None:
-            payload = bytearray()
-
-        to_send = [
-            0xAA, 0xAA,  # start sequence
-            0x00  # placeholder for size
-        ]
+                                          payload: bytes = b"",
+                                          response_timeout: float | None = None,
+                                          template: FrameTemplate = None) -> Frame | None:
+        """
+        Sends a request and waits for its response frame, returns None if the response is not received in time
+        """
+        future = await self._send_request(function_byte, payload, response_timeout, template)
+        try:
+            return await future
+        except TimeoutError:
+            self.log.warning(f"[{self.mac_str}] Response timeout (function: {function_byte:#04x})")
+            return None
 
-        to_send.extend([function_byte, 0x00, 0x00])
-
-        self.current_packet_number += 1
-
-        to_send.append(self.current_packet_number)
-        to_send.extend(payload)  # FIXME: 0xAA Bytestuffing required here
-        to_send[2] = len(to_send)
-
-        checksum = self.calculate_checksum(to_send)
-        to_send.append(checksum)
-
-        self.log.debug(f"Sending pkt number {self.current_packet_number} - {hexlify(bytes(to_send))}")
+    @staticmethod
+    def _is_response_ok(response: Frame, function_byte: int) -> bool:
+        return response.function == function_byte and response.group == 0x0000
 
-        await self.cli.bluetooth_gatt_write(address=self.mac_address_int,
-                                            handle=46,
-                                            data=bytes(to_send),
-                                            response=True,
-                                            timeout=10)
+    @staticmethod
+    def _setpoint_payload(setpoint: int) -> bytes:
+        low = (setpoint * 10 % 256) & 0xff
+        high = int(setpoint * 10 / 256) & 0xff
+        return bytes([low, high, low, high, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
 
-        ret = await self._receive_event_wait(response_timeout)
-        return ret
+    @staticmethod
+    def _next_packet_number(packet_number: int) -> int:
+        # the packet number is a single byte, 0x00 is never used
+        return packet_number % 255 + 1
+
+    async def _send_sync_packet(self) -> bool:
+        self.sync_round_trips += 1
+        response = await self._ble_send_and_wait_response(self.SYNC_PACKET_FUNCTION_CODE,
+                                                          response_timeout=min(self.sync_probe_timeout,
+                                                                               self.response_timeout()),
+                                                          template=self._SYNC_FRAME)
+        if response is None or not self._is_response_ok(response, self.SYNC_PACKET_FUNCTION_CODE) \
+                or not response.payload:
+            return False
+
+        self.read_mode = response.payload[-1]
+        self.current_packet_number = response.packet_number
+        self.got_packet_number = True
+        return True
 
     async def _sync_packet_number(self):
-        SYNC_PACKET_FUNCTION_CODE = 0x01
-        _try = 0
-        while _try < 255:
-            _try += 1
-            self.log.info(f"[{self.mac_str}] Trying to get pkt number {_try}/10")
-            ret = await self._ble_send_and_wait_response(SYNC_PACKET_FUNCTION_CODE)
-            if ret:
-                if self.got_packet_number:
-                    self.log.info(f"[{self.mac_str}] Got Packet Number = {self.current_packet_number}")
-                    return
-                else:
-                    self.log.debug(f"[{self.mac_str}] Packet Number Mismatch - increasing and retrying")
-
-            await asyncio.sleep(0.1)
+        """
+        Finds the packet number expected by the valve.
+
+        The first guess is the packet number following the last one accepted by the valve. When the valve rejects
+        a sync frame but reports its own packet number in the response, the next guess jumps right after it.
+        Only when these guesses fail the packet numbers are probed one by one (at most `sync_max_probes` times).
+        """
+        self.sync_round_trips = 0
+        sent_packet_number = None
+
+        if self.last_valve_packet_number is not None:
+            self.current_packet_number = self.last_valve_packet_number
+
+        for _ in range(self.sync_max_guided_attempts):
+            if await self._send_sync_packet():
+                return self._on_packet_number_synced()
+
+            sent_packet_number = self.current_packet_number
+            reported = self.reported_packet_number
+            if reported is None or reported == sent_packet_number:
+                break
+
+            self.log.debug("[%s] Packet Number Mismatch - valve reported %d", self.mac_str, reported)
+            self.current_packet_number = reported
+
+        if sent_packet_number is not None:
+            self.current_packet_number = sent_packet_number
+
+        # a packet number reported by a rejection is tried once, e.g. when the response to a guess has been lost
+        tried_reports = set()
+        for _try in range(self.sync_max_probes):
+            self.log.debug("[%s] Probing pkt number %d/%d", self.mac_str, _try + 1, self.sync_max_probes)
+            if await self._send_sync_packet():
+                return self._on_packet_number_synced()
+
+            reported = self.reported_packet_number
+            if reported is not None and reported != self.current_packet_number and reported not in tried_reports:
+                tried_reports.add(reported)
+                self.current_packet_number = reported
 
         raise TimeoutError("Error while trying to sync packet number / max tries exceeded", self.mac_str)
 
+    def _on_packet_number_synced(self):
+        self.last_valve_packet_number = self.current_packet_number
+        self.log.info(f"[{self.mac_str}] Got Packet Number = {self.current_packet_number} "
+                      f"({self.sync_round_trips} round-trips)")
+
     async def _read_current_temperature(self):
-        READ_TEMPERATURE_FUNCTION_CODE = 0x0C
         self.log.info(f"[{self.mac_str}] Trying to read current temperature")
-        ret = await self._ble_send_and_wait_response(READ_TEMPERATURE_FUNCTION_CODE)
-        if ret:
-            if self.got_response_for_current_temp:
-                self.log.info(f"[{self.mac_str}] Current mode = {self.read_mode} -"
-                              f" Current comfort temp = {self.current_comfort_temp_dec / 10} °C")
-            else:
-                raise RuntimeError("Bad packet sequencing (received a response to the wrong packet", self.mac_str)
-        else:
+        response = await self._ble_send_and_wait_response(self.TEMPERATURE_FUNCTION_CODE,
+                                                          template=self._READ_TEMPERATURE_FRAME)
+        if response is None:
             raise RuntimeError("Error while trying to read current temperature", self.mac_str)
 
-    async def _write_comfort_mode(self):
+        if not self._is_response_ok(response, self.TEMPERATURE_FUNCTION_CODE) or len(response.payload) < 2:
+            raise RuntimeError("Bad packet sequencing (received a response to the wrong packet", self.mac_str)
+
+        self.current_comfort_temp_dec = (response.payload[1] << 8) + response.payload[0]
+        self.log.info(f"[{self.mac_str}] Current mode = {self.read_mode} -"
+                      f" Current comfort temp = {self.current_comfort_temp_dec / 10} °C")
+
+    async def _write_comfort_mode(self) -> asyncio.Future:
         COMFORT_MODE = 0x01
         SET_KEY_LOCK = 0x01
 
@@ -136,82 +385,151 @@ class RadiatorValve:
                0x00,
                0x00,
                self.read_mode]
-        await self._ble_send_and_wait_response(function_byte=0x01, payload=bytearray(msg))
-
-    async def _write_open_closed(self, desired_state):
-        WRITE_TEMPERATURE_FUNCTION_CODE = 0x0C
-
-        def get_high_low_temperature_bytes(setpoint: int):
-            low = (setpoint * 10 % 256) & 0xff
-            high = int(setpoint * 10 / 256) & 0xff
-            return low, high
+        return await self._send_request(function_byte=0x01, payload=bytes(msg))
 
-        if desired_state:
-            written_temperature = self.on_temperature
-        else:
-            written_temperature = self.off_temperature
+    def _setpoint(self, desired_state) -> int:
+        return self.on_temperature if desired_state else self.off_temperature
 
-        setpoint_bytes = get_high_low_temperature_bytes(written_temperature)
+    def has_setpoint(self, desired_state) -> bool:
+        """
+        True if the last read comfort temperature is the setpoint of `desired_state`
+        """
+        return int(self.current_comfort_temp_dec) == int(self._setpoint(desired_state) * 10)
 
-        # set comfort temperature
-        msg = bytearray([
-            setpoint_bytes[0],
-            setpoint_bytes[1],
-            setpoint_bytes[0],
-            setpoint_bytes[1],
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    async def _write_open_closed(self, desired_state):
+        written_temperature = self._setpoint(desired_state)
 
-        await self._ble_send_and_wait_response(function_byte=WRITE_TEMPERATURE_FUNCTION_CODE,
-                                               payload=msg)
+        # the comfort mode and the setpoint frames are independent: both are in flight before waiting the responses
+        comfort_mode_response = await self._write_comfort_mode()
+        _observe_response_time(comfort_mode_response, self._MODE_WRITE_SECONDS)
+        setpoint_response = await self._send_request(function_byte=self.TEMPERATURE_FUNCTION_CODE,
+                                                     template=self._setpoint_frames[bool(desired_state)])
+        _observe_response_time(setpoint_response, self._SETPOINT_WRITE_SECONDS)
+        await asyncio.gather(comfort_mode_response, setpoint_response)
 
         # Read temperature verification
-        await self._read_current_temperature()
+        with self._READBACK_SECONDS.time():
+            await self._read_current_temperature()
         assert int(self.current_comfort_temp_dec) == int(written_temperature * 10), \
             f"[{self.mac_str}] Readback of written temperature KO (Read {self.current_comfort_temp_dec}  / Expected {written_temperature * 10})"
         self.log.info(f"[{self.mac_str}] Readback of written temperature OK ({written_temperature} °C)")
 
-    async def _init_ble_connection(self) -> tuple:
-        await self.cli.bluetooth_device_connect(self.mac_address_int,
-                                                self._on_ble_state,
-                                                timeout=10,
-                                                disconnect_timeout=10,
-                                                address_type=0
-                                                )
-
-        callback_remove1, callback_remove2 = \
-            await self.cli.bluetooth_gatt_start_notify(self.mac_address_int,
-                                                       handle=48,
-                                                       on_bluetooth_gatt_notify=
-                                                       lambda size, array: self.on_bluetooth_gatt_notify(
-                                                           size,
-                                                           array))
+    async def _init_ble_connection(self):
+        connect_timeout = self._timeout(10)
+        try:
+            with self._CONNECT_SECONDS.time():
+                self._connection_state_remove = \
+                    await self.cli.bluetooth_device_connect(self.mac_address_int,
+                                                            self._on_ble_state,
+                                                            timeout=connect_timeout,
+                                                            disconnect_timeout=10,
+                                                            address_type=0
+                                                            )
+        except Exception as ex:
+            self._record_error(ex)
+            raise
+        self.connected = True
+        self.decoder.reset()
+
+        notify_timeout = self._timeout(10)
+        try:
+            with self._START_NOTIFY_SECONDS.time():
+                self._notify_remove, _ = \
+                    await self.cli.bluetooth_gatt_start_notify(self.mac_address_int,
+                                                               handle=48,
+                                                               on_bluetooth_gatt_notify=
+                                                               lambda size, array: self.on_bluetooth_gatt_notify(
+                                                                   size,
+                                                                   array),
+                                                               timeout=notify_timeout)
+        except Exception as ex:
+            self._record_error(ex)
+            raise
+
+        with self._PACKET_SYNC_SECONDS.time():
+            await self._sync_packet_number()
+
+    async def connect(self, deadline: float | None = None):
+        """
+        Opens the GATT connection, subscribes the notifications and syncs the packet number, before `deadline`
+        (event loop time) if given.
+        It does nothing if the connection is already open.
+        """
+        self._deadline = deadline
+        self.proxy_error = None
+        try:
+            await self._connect()
+        finally:
+            self._deadline = None
+
+    async def disconnect(self):
+        """
+        Closes the GATT connection (best effort, errors are only logged)
+        """
+        if not self.connected:
+            return
 
-        await self._sync_packet_number()
+        with self._DISCONNECT_SECONDS.time():
+            await self._disconnect()
 
-        return callback_remove1, callback_remove2
+    async def _disconnect(self):
+        self.connected = False
+        self.got_packet_number = False
+        self._fail_pending_responses(ConnectionError("BLE connection closed", self.mac_str))
+
+        try:
+            if self._notify_remove is not None:
+                await self._notify_remove()
+        except Exception:
+            self.log.debug("[%s] Error while stopping notify", self.mac_str, exc_info=True)
+
+        try:
+            await self.cli.bluetooth_device_disconnect(self.mac_address_int)
+        except Exception:
+            self.log.debug("[%s] Error while disconnecting", self.mac_str, exc_info=True)
+
+        if self._connection_state_remove is not None:
+            self._connection_state_remove()
+
+        self._notify_remove = None
+        self._connection_state_remove = None
+
+    async def set_state(self, desired_state, deadline: float | None = None):
+        """
+        Applies the state, retrying up to `max_tries` times, returns True on success.
+        With a `deadline` (event loop time) every step is bounded by the time left, and the command fails
+        when the budget is exhausted.
+        """
+        async with self.lock:
+            self._deadline = deadline
+            try:
+                return await self._set_state(desired_state)
+            finally:
+                self._deadline = None
 
-    async def set_state(self, desired_state):
+    async def _set_state(self, desired_state):
         try_number = 0
         self._reset()
 
-        while try_number < self.max_tries:
+        while try_number < self.max_tries and not self._budget_exhausted():
 
             self.log.info(f"[{self.mac_str}] set_state [Try {try_number}/{self.max_tries}]")
             try_number += 1
             try:
-                callback_remove1, callback_remove2 = await self._init_ble_connection()
-                await asyncio.sleep(0.1)
-                await self._read_current_temperature()
-                await asyncio.sleep(0.1)
-                await self._write_comfort_mode()
-                await asyncio.sleep(0.1)
-
-                await self._write_open_closed(desired_state)
-                await asyncio.sleep(0.1)
+                # each step starts as soon as the response to the previous one is received
+                await self._connect()
+                with self._READ_SECONDS.time():
+                    await self._read_current_temperature()
+
+                # the valve may already be in the desired state (e.g. a command resent by HA)
+                if self.has_setpoint(desired_state):
+                    self._WRITES_SKIPPED.inc()
+                    self.log.info(f"[{self.mac_str}] Comfort temperature already set, skipping the writes")
+                else:
+                    await self._write_open_closed(desired_state)
 
-                await self.cli.bluetooth_device_disconnect(self.mac_address_int)
-                await callback_remove1()
-                await asyncio.sleep(0.1)
+                if not self.keep_connected:
+                    await self.disconnect()
 
                 self.log.info(f"[{self.mac_str}] Operation Complete! :)")
 
@@ -219,96 +537,105 @@ class RadiatorValve:
 
             except Exception as e:
                 self.log.exception(f"Exception in set_state (attempt: {try_number}/{self.max_tries})")
-                await asyncio.sleep(self.attempt_delay)
+                self._record_error(e)
+                await self.disconnect()
+                if try_number < self.max_tries and not self._budget_exhausted():
+                    self._SET_STATE_RETRIES.inc()
+                    await self._retry_pause(try_number)
                 continue
 
         return False
 
-    async def read_current_temperature(self) -> float | None:
+    def _record_error(self, ex: Exception):
+        if isinstance(ex, APIConnectionError) and not isinstance(ex, self._VALVE_ERRORS):
+            self.proxy_error = ex
+
+    async def _connect(self):
+        if self.connected and self.got_packet_number:
+            return
+        if self.connected:
+            await self.disconnect()
+        await self._init_ble_connection()
+
+    async def read_current_temperature(self, deadline: float | None = None) -> float | None:
+        async with self.lock:
+            self._deadline = deadline
+            try:
+                return await self._read_current_temperature_with_retries()
+            finally:
+                self._deadline = None
+
+    async def _read_current_temperature_with_retries(self) -> float | None:
         try_number = 0
         self._reset()
 
-        while try_number < self.max_tries:
+        while try_number < self.max_tries and not self._budget_exhausted():
             try:
                 try_number += 1
-                callback_remove1, callback_remove2 = await self._init_ble_connection()
-                await asyncio.sleep(0.1)
-                await self._read_current_temperature()
-                await self.cli.bluetooth_device_disconnect(self.mac_address_int)
-                await callback_remove1()
+                await self._connect()
+                with self._READ_SECONDS.time():
+                    await self._read_current_temperature()
+
+                if not self.keep_connected:
+                    await self.disconnect()
 
                 return self.current_comfort_temp_dec / 10.0
             except Exception as e:
                 self.log.exception(f"Exception in read_current_temperature (attempt: {try_number}/{self.max_tries})")
-                await asyncio.sleep(self.attempt_delay)
+                self._record_error(e)
+                await self.disconnect()
+                if try_number < self.max_tries and not self._budget_exhausted():
+                    self._READ_RETRIES.inc()
+                    await self._retry_pause(try_number)
 
         return None
 
     def on_bluetooth_gatt_notify(self, size_array, value):
-
-        self.log.debug(f"Received BLE packet: {hexlify(value)}")
-
-        response_length = len(value)
-
-        if self.current_resp == [] and response_length < 3:
-            self.log.error("Bad packet received (unexpected length)")
-            return
-
-        if len(self.current_resp) == 0:
-            if value[0] == 0xAA and value[1] == 0xAA:
-                self.current_resp.extend(value)
-                self.expected_length = value[2]
-                # val_cut = value[3:]
-                # if 0x55 in val_cut:
-                #     self.log.debug("Not parsing packet")
-                #     self.current_resp = []
-                #     return
-        else:
-            self.current_resp.extend(value)
-
-        # self.received_response_event.set()
-        if len(self.current_resp) < self.expected_length:
-            return
-
-        received_checksum = self.current_resp[response_length - 1]
-        expected_checksum = self.calculate_checksum(self.current_resp[0:response_length - 1])
-        self.log.debug(f"Checksum Received: {received_checksum}/Expected: {expected_checksum} --- "
-                       f"Pkt. Number Received: {self.current_resp[6]}/Expected: {self.current_packet_number}")
-
-        final = self.current_resp[0:3]
-        final.extend([i for i in self.current_resp[3:] if i != 0x55])
-
-        current_resp = final
-        if expected_checksum != received_checksum:
+        # the frames are only formatted when the debug logs are enabled, the recorder stores them raw
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(FrameRing.RECEIVED, self.mac_address_int, data=value)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Received BLE packet: %s", hexlify(value))
+
+        checksum_errors = self.decoder.checksum_errors
+        frames = self.decoder.feed(value)
+        if self.decoder.checksum_errors != checksum_errors:
+            self._CHECKSUM_ERRORS.inc(self.decoder.checksum_errors - checksum_errors)
+            if recorder is not None:
+                recorder.record(FrameRing.CHECKSUM_ERROR, self.mac_address_int,
+                                self.decoder.checksum_errors - checksum_errors)
             self.log.error(f"[{self.mac_str}] Bad Checksum")
 
-        if current_resp[3] != 255 and current_resp[4] != 255:
-            # se è un pacchetto di risposta a un comando 0x01, 0x00, 0x00 (first group)
-            if current_resp[3] == 0x01 and current_resp[4] == 0x00 and current_resp[5] == 0x00:
-                self.read_mode = current_resp[response_length - 2]
-                self.current_packet_number = current_resp[6]
-                self.got_packet_number = True
-
-            if len(current_resp) >= 9 and current_resp[6] == self.current_packet_number and \
-                    current_resp[3] == 0x0C and current_resp[4] == 0x00 and current_resp[5] == 0x00:
-                current_comfort_temp = (current_resp[8] << 8) + current_resp[7]
-                self.current_comfort_temp_dec = current_comfort_temp
-                self.got_response_for_current_temp = True
-        else:
-            self.log.error(f"[{self.mac_str}] Bad Data Received")
+        for frame in frames:
+            self.log.debug("[%s] Received %s - Expected pkt. number: %d", self.mac_str, frame,
+                           self.current_packet_number)
+            self.reported_packet_number = frame.packet_number
+            if recorder is not None:
+                recorder.record(FrameRing.ERROR_FRAME if frame.is_error else FrameRing.FRAME, self.mac_address_int,
+                                frame.packet_number, frame.function, frame.payload)
+
+            if frame.is_error:
+                self._BAD_DATA.inc()
+                self.log.error(f"[{self.mac_str}] Bad Data Received")
+            else:
+                self.last_valve_packet_number = frame.packet_number
 
-        self.received_response_event.set()
+            self._resolve_response(frame)
 
-        self.current_resp = []
+    def _resolve_response(self, response: Frame):
+        future = self._pending_responses.pop(response.packet_number, None)
 
-    @staticmethod
-    def calculate_checksum(msg):
-        msg_to_analyze = msg[3:]
-        msg_to_analyze = [i for i in msg_to_analyze if i != 0x55]
-        # print(msg_to_analyze)
-        checksum = (sum(msg_to_analyze) & 0xFF)
-        # print(checksum)
-        return checksum
+        if future is None and response.is_error and self._pending_responses:
+            # a rejection carries the packet number of the valve instead of the one of the request: the valve
+            # answers in order, it belongs to the oldest pending request
+            future = self._pending_responses.pop(next(iter(self._pending_responses)))
+
+        if future is None:
+            # e.g. the late response to a request that timed out
+            self.log.debug("[%s] Dropped %s, no pending request", self.mac_str, response)
+        elif not future.done():
+            future.set_result(response)
 
     @staticmethod
     def mac_to_int(mac):
@@ -0,0 +1,209 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import aioesphomeapi
+
+from trv_controller.flight_recorder import FlightRecorder
+from trv_controller.radiator_valve import RadiatorValve
+
+
+class ValveSessionPool:
+    """
+    A pool of the open BLE sessions, keyed by (proxy hostname, valve MAC).
+
+    A pooled `RadiatorValve` keeps its GATT connection, its notify subscription and its synced packet number
+    between commands, so a burst of commands for the same valve pays the connection setup only once.
+    Sessions that are not used for `idle_timeout` seconds are closed, and when more than `max_sessions`
+    sessions are open the least recently used (idle) ones are closed first.
+    """
+
+    def __init__(self, idle_timeout: float = 30.0, max_sessions: int = 8):
+        self.log = logging.getLogger("session-pool")
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+
+        # LRU order: the most recently used session is the last one
+        self._sessions: OrderedDict[tuple[str, int], RadiatorValve] = OrderedDict()
+        self._last_used: dict[tuple[str, int], float] = dict()
+
+        # sessions being closed by proxy hostname: their connection slot is still used until the proxy confirms
+        self._disconnecting: dict[str, int] = dict()
+
+        # the sessions being closed: a valve accepts a single connection, a new one must wait for the disconnection
+        self._closing: set[RadiatorValve] = set()
+
+        # the last packet number accepted by each valve (key is the MAC as int), the starting guess of the
+        # packet number sync of its next session, whatever the proxy
+        self._last_packet_numbers: dict[int, int] = dict()
+
+        # called with the proxy hostname when a session is closed (i.e. a proxy connection slot is freed)
+        self.on_session_closed: Callable[[str], None] | None = None
+
+        # records the BLE traffic of the sessions when set
+        self.recorder: FlightRecorder | None = None
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(idle_timeout=config.get("idle_timeout", 30.0),
+                   max_sessions=config.get("max_sessions", 8))
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def get(self, proxy_hostname: str, cli: aioesphomeapi.APIClient, mac_address: str) -> RadiatorValve:
+        """
+        Returns the pooled `RadiatorValve` for the given proxy/valve pair, creating it if needed.
+        """
+        key = (proxy_hostname, RadiatorValve.mac_to_int(mac_address))
+
+        for closing_valve in [valve for valve in self._closing if valve.mac_address_int == key[1]]:
+            async with closing_valve.lock:
+                pass
+
+        valve = self._sessions.get(key)
+        if valve is not None and valve.cli is not cli:
+            # the proxy API client has been replaced, the old GATT session cannot be reused
+            await self._close(key)
+            valve = None
+
+        if valve is None:
+            valve = RadiatorValve(mac_address, cli, keep_connected=True)
+            valve.last_valve_packet_number = self._last_packet_numbers.get(key[1])
+            if self.recorder is not None:
+                valve.recorder = self.recorder.valve_ring(key[1])
+            self._sessions[key] = valve
+
+        self.touch(proxy_hostname, valve)
+
+        await self._evict_over_capacity()
+        return valve
+
+    def touch(self, proxy_hostname: str, valve: RadiatorValve):
+        key = (proxy_hostname, valve.mac_address_int)
+        if key in self._sessions:
+            self._sessions.move_to_end(key)
+            self._last_used[key] = time.monotonic()
+
+    def is_connected(self, proxy_hostname: str, mac_address: str) -> bool:
+        valve = self._sessions.get((proxy_hostname, RadiatorValve.mac_to_int(mac_address)))
+        return valve is not None and valve.connected
+
+    def connected_count(self, proxy_hostname: str) -> int:
+        return (sum(1 for key, valve in self._sessions.items() if key[0] == proxy_hostname and valve.connected) +
+                self._disconnecting.get(proxy_hostname, 0))
+
+    def has_idle_connection(self, proxy_hostname: str) -> bool:
+        return any(key[0] == proxy_hostname and self._sessions[key].connected for key in self._idle_keys())
+
+    async def close_idle_connection(self, proxy_hostname: str) -> bool:
+        """
+        Closes the least recently used idle connected session of a proxy, returns False if there is none
+        """
+        for key in self._idle_keys():
+            if key[0] == proxy_hostname and self._sessions[key].connected:
+                await self._close(key)
+                return True
+        return False
+
+    async def _close(self, key: tuple[str, int]):
+        valve = self._sessions.pop(key, None)
+        self._last_used.pop(key, None)
+        if valve is None:
+            return
+
+        self.log.debug("[Proxy %s] [%s] Closing BLE session", key[0], valve.mac_str)
+
+        # a valve still referenced by a running command closes its connection at the end of it
+        valve.keep_connected = False
+        self._disconnecting[key[0]] = self._disconnecting.get(key[0], 0) + 1
+        self._closing.add(valve)
+        try:
+            async with valve.lock:
+                await valve.disconnect()
+        finally:
+            self._disconnecting[key[0]] -= 1
+            self._closing.discard(valve)
+            self._remember_packet_number(valve)
+
+        if self.on_session_closed is not None:
+            self.on_session_closed(key[0])
+
+    def _remember_packet_number(self, valve: RadiatorValve):
+        if valve.last_valve_packet_number is not None:
+            self._last_packet_numbers[valve.mac_address_int] = valve.last_valve_packet_number
+
+    def packet_numbers(self) -> dict[int, int]:
+        """
+        Returns the last packet number accepted by each valve (key is the MAC as int), the sessions still open or
+        being closed included
+        """
+        packet_numbers = dict(self._last_packet_numbers)
+        for valve in [*self._closing, *self._sessions.values()]:
+            if valve.last_valve_packet_number is not None:
+                packet_numbers[valve.mac_address_int] = valve.last_valve_packet_number
+        return packet_numbers
+
+    def seed_packet_numbers(self, packet_numbers: dict[int, int]):
+        """
+        Sets the starting guess of the packet number sync of the next sessions (e.g. restored from a snapshot)
+        """
+        self._last_packet_numbers.update(packet_numbers)
+
+    def _idle_keys(self):
+        return [key for key, valve in self._sessions.items() if not valve.lock.locked()]
+
+    async def _evict_over_capacity(self):
+        for key in self._idle_keys()[:max(0, len(self._sessions) - self.max_sessions)]:
+            await self._close(key)
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        for key in self._idle_keys():
+            if now - self._last_used.get(key, now) >= self.idle_timeout:
+                await self._close(key)
+
+    def drop_proxy(self, proxy_hostname: str):
+        """
+        Forgets all the sessions opened through a proxy (e.g. because the proxy API connection is lost).
+        """
+        for key in [key for key in self._sessions if key[0] == proxy_hostname]:
+            valve = self._sessions.pop(key)
+            self._last_used.pop(key, None)
+            valve.keep_connected = False
+            valve.connected = False
+            valve.got_packet_number = False
+            self._remember_packet_number(valve)
+
+        if self.on_session_closed is not None:
+            self.on_session_closed(proxy_hostname)
+
+    async def close_valve(self, mac_address: str):
+        """
+        Closes the sessions of a valve, through all the proxies (e.g. the valve is handled by another instance)
+        """
+        mac_address_int = RadiatorValve.mac_to_int(mac_address)
+        for key in [key for key in self._sessions if key[1] == mac_address_int]:
+            await self._close(key)
+
+    async def close_all(self):
+        for key in list(self._sessions):
+            await self._close(key)
+
+    async def eviction_task(self, exited: asyncio.Event):
+        """
+        This task periodically closes the idle sessions, and all of them on exit
+        """
+        while not exited.is_set():
+            try:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(exited.wait(), max(self.idle_timeout / 2, 1.0))
+
+                await self.evict_idle()
+            except Exception as ex:
+                self.log.exception("Error in eviction_task: ")
+
+        await self.close_all()
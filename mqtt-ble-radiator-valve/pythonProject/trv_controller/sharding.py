@@ -0,0 +1,196 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from typing import Callable
+
+from aiomqtt import Client, Will
+
+
+def _score(instance_id: str, valve_name: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{instance_id}/{valve_name}".encode(), digest_size=8).digest(), "big")
+
+
+class InstanceLease:
+    """
+    The lease record of a controller instance, as published on its retained topic
+    """
+    __slots__ = ("instance_id", "expires", "valves")
+
+    def __init__(self, instance_id: str, expires: float, valves: frozenset[str]):
+        self.instance_id = instance_id
+        self.expires = expires  # wall clock
+        self.valves = valves
+
+
+class ShardCoordinator:
+    """
+    Splits the configured valves between the controller instances sharing the MQTT broker.
+
+    Each instance holds a lease: its retained record on `<prefix>/instances/<instance_id>`, listing the valves it owns.
+    The record is renewed every `heartbeat_interval` seconds and expires `lease_ttl` seconds after the last renewal
+    (wall clock). It is deleted by the instance on exit, and by the broker (last will) when the instance is
+    disconnected without notice. An instance that could not renew its lease drops all its valves one heartbeat
+    before the lease expires, i.e. before another instance can claim them.
+
+    The valves are assigned to the live instances by rendezvous hashing: all the instances agree on the owners
+    without coordinator, and only the valves of a dead or new instance move. An instance claims a valve assigned
+    to it once no other live record lists it, i.e. after the previous owner released it or died, so that a valve
+    is never handled by two instances. The claims start `settle_delay` seconds after the MQTT connection, once the
+    retained records of the other instances have been received.
+
+    `on_change` is called when the owned valves change.
+    """
+
+    def __init__(self,
+                 instance_id: str,
+                 topic_prefix: str,
+                 on_change: Callable[[], None],
+                 lease_ttl: float = 30.0,
+                 heartbeat_interval: float = 10.0,
+                 settle_delay: float = 2.0):
+        self.log = logging.getLogger("sharding")
+        self.instance_id = instance_id
+        self.on_change = on_change
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.settle_delay = settle_delay
+
+        self.topic = f"{topic_prefix}/instances/{instance_id}"
+        self.topic_filter = f"{topic_prefix}/instances/+"
+
+        # the names of all the configured valves, and the ones owned by this instance
+        self.valve_names: tuple[str, ...] = ()
+        self.owned: frozenset[str] = frozenset()
+
+        # leases of the other instances, key is the instance id
+        self._leases: dict[str, InstanceLease] = dict()
+
+        # time of the last lease renewal and the time from which the valves can be claimed (monotonic clock)
+        self._renewed_at: float | None = None
+        self._claims_from: float | None = None
+        self._wakeup = asyncio.Event()
+
+        # metrics
+        self.handovers = 0
+
+    @classmethod
+    def from_config(cls, topic_prefix: str, on_change: Callable[[], None], config: dict):
+        return cls(config.get("instance_id") or f"{socket.gethostname()}-{os.getpid()}", topic_prefix, on_change,
+                   lease_ttl=config.get("lease_ttl", 30.0),
+                   heartbeat_interval=config.get("heartbeat_interval", 10.0),
+                   settle_delay=config.get("settle_delay", 2.0))
+
+    @property
+    def will(self) -> Will:
+        """
+        The MQTT last will of the instance: deletes its lease record
+        """
+        return Will(self.topic, b"", retain=True)
+
+    def live_instances(self) -> list[str]:
+        now = time.time()
+        return [self.instance_id] + [instance_id for instance_id, lease in self._leases.items() if lease.expires > now]
+
+    def set_valves(self, valve_names: list[str]):
+        self.valve_names = tuple(valve_names)
+        self.evaluate()
+
+    def on_connected(self):
+        """
+        Called once subscribed to the lease records, on each MQTT (re)connection
+        """
+        self._claims_from = time.monotonic() + self.settle_delay
+        self._wakeup.set()
+
+    def on_lease(self, instance_id: str, payload: bytes):
+        """
+        Records the lease of another instance, received on its retained topic (empty when released)
+        """
+        if instance_id == self.instance_id:
+            return
+
+        if not payload:
+            if self._leases.pop(instance_id, None) is not None:
+                self.log.info(f"[Instance {instance_id}] Lease released")
+        else:
+            try:
+                record = json.loads(payload)
+                lease = InstanceLease(instance_id, float(record["expires"]), frozenset(record["valves"]))
+            except Exception as ex:
+                self.log.warning(f"[Instance {instance_id}] Invalid lease record: {ex!r}")
+                return
+            if instance_id not in self._leases:
+                self.log.info(f"[Instance {instance_id}] Lease acquired, {len(lease.valves)} valves")
+            self._leases[instance_id] = lease
+
+        self.evaluate()
+
+    def evaluate(self):
+        """
+        Claims the valves assigned to this instance that are free, and releases the ones assigned to another one
+        """
+        now = time.monotonic()
+        if self._renewed_at is None or now - self._renewed_at >= self.lease_ttl - self.heartbeat_interval:
+            # the lease is about to expire for the other instances
+            owned = frozenset()
+        else:
+            live = self.live_instances()
+            held = {valve_name for instance_id in live[1:] for valve_name in self._leases[instance_id].valves}
+            can_claim = self._claims_from is not None and now >= self._claims_from
+            owned = frozenset(
+                valve_name for valve_name in self.valve_names
+                if max(live, key=lambda instance_id: _score(instance_id, valve_name)) == self.instance_id
+                and (valve_name in self.owned or (can_claim and valve_name not in held)))
+
+        if owned != self.owned:
+            self.log.info(f"Owning {len(owned)} valves (+{len(owned - self.owned)} -{len(self.owned - owned)}), "
+                          f"{len(self.live_instances())} live instances")
+            self.handovers += len(owned ^ self.owned)
+            self.owned = owned
+            # the other instances are told right away
+            self._wakeup.set()
+            self.on_change()
+
+    async def _renew(self, client: Client):
+        expires = time.time() + self.lease_ttl
+        renewed_at = time.monotonic()
+        await client.publish(self.topic, json.dumps({"expires": round(expires, 3), "valves": sorted(self.owned)}),
+                             qos=1, retain=True)
+        self._renewed_at = renewed_at
+
+    async def heartbeat_task(self, exited: asyncio.Event, get_client: Callable[[], Client | None]):
+        """
+        This task renews the lease of the instance, and expires the leases of the other ones.
+        The lease is released on exit.
+        """
+        try:
+            while not exited.is_set():
+                try:
+                    self._wakeup.clear()
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        # woken up by a change, and when the claims can start
+                        timeout = self.heartbeat_interval
+                        if self._claims_from is not None and self._claims_from > time.monotonic():
+                            timeout = min(timeout, self._claims_from - time.monotonic())
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+                    client = get_client()
+                    if client is not None and self._claims_from is not None:
+                        try:
+                            await asyncio.wait_for(self._renew(client), self.heartbeat_interval)
+                        except Exception as ex:
+                            self.log.warning(f"Cannot renew the lease: {ex!r}")
+                    # the valves are dropped when the lease was not renewed in time
+                    self.evaluate()
+                except Exception as ex:
+                    self.log.exception("Error in heartbeat_task: ")
+        finally:
+            client = get_client()
+            if client is not None:
+                with contextlib.suppress(Exception):
+                    await client.publish(self.topic, b"", qos=1, retain=True)
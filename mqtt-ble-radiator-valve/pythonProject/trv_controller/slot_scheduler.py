@@ -0,0 +1,186 @@
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+
+from trv_controller.session_pool import ValveSessionPool
+
+
+class _SlotRequest:
+    __slots__ = ("priority", "sequence", "mac_address", "proxies", "future")
+
+    def __init__(self, priority: int, sequence: int, mac_address: str, proxies: list[str], future: asyncio.Future):
+        self.priority = priority
+        self.sequence = sequence
+        self.mac_address = mac_address
+        self.proxies = proxies
+        self.future = future
+
+    def __lt__(self, other: "_SlotRequest"):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class ConnectionSlotScheduler:
+    """
+    Schedules the valve transactions on the limited BLE connection slots of the ESPHome proxies.
+
+    A slot is used by each open BLE connection (the pooled sessions included) and is reserved by each running
+    transaction until the session of its valve is connected, the connection then using the slot. A transaction
+    can run on any of its candidate proxies: it gets the first one (in the given order) with a free slot, else it
+    waits. Waiting transactions are served by priority (the lowest value first, `INTERACTIVE` before `BACKGROUND`),
+    then in arrival order, whatever proxy frees a slot.
+    Idle pooled sessions are closed to make room for waiting transactions.
+    """
+    INTERACTIVE = 0
+    BACKGROUND = 10
+
+    def __init__(self, session_pool: ValveSessionPool, default_slots: int = 3, slots: dict[str, int] = None):
+        self.log = logging.getLogger("slot-scheduler")
+        self.session_pool = session_pool
+        self.default_slots = default_slots
+
+        # configured limit of each proxy, and the limit reported by the proxy itself
+        self._configured_limits: dict[str, int] = dict(slots or {})
+        self._reported_limits: dict[str, int] = dict()
+
+        # the running transactions of each valve (by MAC address), key is the proxy hostname
+        self._reserved: dict[str, collections.Counter[str]] = dict()
+
+        self._waiting: list[_SlotRequest] = []
+        self._sequence = itertools.count()
+
+        # proxies on which an idle session is being closed to make room
+        self._closing: set[str] = set()
+
+        self.session_pool.on_session_closed = lambda _: self._grant_waiting()
+
+    def set_reported_limit(self, proxy_hostname: str, limit: int):
+        self._reported_limits[proxy_hostname] = limit
+        self._grant_waiting()
+
+    def set_configured_limit(self, proxy_hostname: str, limit: int | None):
+        """
+        Sets the configured limit of a proxy (None for the default one), e.g. when the config is reloaded
+        """
+        if limit is None:
+            self._configured_limits.pop(proxy_hostname, None)
+        else:
+            self._configured_limits[proxy_hostname] = limit
+        self._grant_waiting()
+
+    def limit(self, proxy_hostname: str) -> int:
+        configured = self._configured_limits.get(proxy_hostname, self.default_slots)
+        return min(configured, self._reported_limits.get(proxy_hostname, configured))
+
+    def free_slots(self, proxy_hostname: str) -> int:
+        # the valves of the running transactions that are connected already use a slot as open connections
+        reserved = self._reserved.get(proxy_hostname)
+        connecting = sum(1 for mac_address in reserved
+                         if not self.session_pool.is_connected(proxy_hostname, mac_address)) if reserved else 0
+        return self.limit(proxy_hostname) - self.session_pool.connected_count(proxy_hostname) - connecting
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def reserved(self, proxy_hostname: str) -> int:
+        return sum(self._reserved.get(proxy_hostname, {}).values())
+
+    def _reserve(self, proxy_hostname: str, mac_address: str) -> str:
+        self._reserved.setdefault(proxy_hostname, collections.Counter())[mac_address] += 1
+        return proxy_hostname
+
+    def _pick(self, mac_address: str, proxies: list[str]) -> str | None:
+        # a proxy already connected to the valve does not need a new connection slot
+        for proxy_hostname in proxies:
+            if self.session_pool.is_connected(proxy_hostname, mac_address):
+                return proxy_hostname
+
+        for proxy_hostname in proxies:
+            if self.free_slots(proxy_hostname) > 0:
+                return proxy_hostname
+
+        return None
+
+    def try_acquire(self, mac_address: str, proxies: list[str], priority: int = INTERACTIVE) -> str | None:
+        """
+        Reserves a slot without waiting, returns the proxy or None.
+        Transactions already waiting with the same or a higher priority are not overtaken.
+        """
+        if any(request.priority <= priority for request in self._waiting):
+            return None
+
+        proxy_hostname = self._pick(mac_address, proxies)
+        return self._reserve(proxy_hostname, mac_address) if proxy_hostname is not None else None
+
+    async def acquire(self, mac_address: str, proxies: list[str], priority: int = INTERACTIVE) -> str:
+        """
+        Reserves a slot on one of the `proxies` (tried in order), waiting for it if needed, returns the proxy.
+        The slot must be given back with `release`, with the same MAC address.
+        """
+        proxy_hostname = self.try_acquire(mac_address, proxies, priority)
+        if proxy_hostname is not None:
+            return proxy_hostname
+
+        request = _SlotRequest(priority, next(self._sequence), mac_address, proxies,
+                               asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiting, request)
+        self.log.debug("[%s] Waiting for a connection slot on %s (%d waiting)",
+                       mac_address, proxies, len(self._waiting))
+
+        self._make_room()
+
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                # the slot has been granted while the waiter was being cancelled
+                self.release(request.future.result(), mac_address)
+            else:
+                with contextlib.suppress(ValueError):
+                    self._waiting.remove(request)
+                heapq.heapify(self._waiting)
+            raise
+
+    def release(self, proxy_hostname: str, mac_address: str):
+        reserved = self._reserved[proxy_hostname]
+        reserved[mac_address] -= 1
+        if not reserved[mac_address]:
+            del reserved[mac_address]
+        self._grant_waiting()
+
+    def _grant_waiting(self):
+        still_waiting = []
+        while self._waiting:
+            request = heapq.heappop(self._waiting)
+            if request.future.done():
+                continue
+
+            proxy_hostname = self._pick(request.mac_address, request.proxies)
+            if proxy_hostname is None:
+                still_waiting.append(request)
+                continue
+
+            request.future.set_result(self._reserve(proxy_hostname, request.mac_address))
+
+        self._waiting = still_waiting
+        heapq.heapify(self._waiting)
+        self._make_room()
+
+    def _make_room(self):
+        """
+        Closes idle pooled sessions on the proxies that waiting transactions could use
+        """
+        proxies = {proxy_hostname for request in self._waiting for proxy_hostname in request.proxies}
+        for proxy_hostname in proxies - self._closing:
+            if self.session_pool.has_idle_connection(proxy_hostname):
+                self._closing.add(proxy_hostname)
+                task = asyncio.get_running_loop().create_task(
+                    self.session_pool.close_idle_connection(proxy_hostname))
+                task.add_done_callback(lambda _, hostname=proxy_hostname: self._on_room_made(hostname))
+
+    def _on_room_made(self, proxy_hostname: str):
+        self._closing.discard(proxy_hostname)
+        self._grant_waiting()
@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Callable
+
+
+class StateSnapshot:
+    """
+    Periodically saves what the manager learned about the valves to a JSON file, and loads it at startup
+    (warm start): the manager gets back the valves availability, RSSI, last state and packet numbers
+    without waiting for the advertisements and the commands.
+
+    The state is produced by `collect` every `interval` seconds and on exit. The file is replaced atomically
+    (written aside, then renamed), so a crash while saving leaves the previous snapshot. The timestamps are
+    saved on the wall clock, see `to_wall_clock` and `to_monotonic`.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str, collect: Callable[[], dict], interval: float = 60.0):
+        self.log = logging.getLogger("snapshot")
+        self.path = path
+        self.collect = collect
+        self.interval = interval
+
+        # metrics
+        self.saved = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, collect: Callable[[], dict], config: dict):
+        return cls(config.get("path", "./trv_state.json"), collect,
+                   interval=config.get("interval", 60.0))
+
+    @staticmethod
+    def to_wall_clock(monotonic: float) -> float:
+        return time.time() - (time.monotonic() - monotonic)
+
+    @staticmethod
+    def to_monotonic(wall_clock: float) -> float:
+        return time.monotonic() - (time.time() - wall_clock)
+
+    def load(self) -> dict | None:
+        """
+        Returns the saved state, or None if there is no usable snapshot
+        """
+        try:
+            with open(self.path, "r") as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            self.log.info(f"No snapshot in {self.path}, cold start")
+            return None
+        except Exception as ex:
+            self.log.error(f"Cannot read the snapshot {self.path}, cold start: {ex!r}")
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get("version") != self.VERSION:
+            self.log.warning(f"Unsupported snapshot version in {self.path}, cold start")
+            return None
+
+        self.log.info(f"Loaded the snapshot {self.path}, saved {time.time() - snapshot['saved_at']:.0f}s ago")
+        return snapshot["state"]
+
+    def _write(self, payload: bytes):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+    def _payload(self) -> bytes:
+        return json.dumps({"version": self.VERSION, "saved_at": time.time(), "state": self.collect()},
+                          separators=(",", ":")).encode()
+
+    def save(self):
+        """
+        Saves the current state, blocking the event loop (used on exit)
+        """
+        try:
+            self._write(self._payload())
+            self.saved += 1
+        except Exception as ex:
+            self.errors += 1
+            self.log.exception(f"Cannot save the snapshot {self.path}: ")
+
+    async def save_async(self):
+        """
+        Saves the current state, the file being written by a worker thread
+        """
+        # collected on the event loop, the state is not modified meanwhile
+        payload = self._payload()
+        try:
+            await asyncio.to_thread(self._write, payload)
+            self.saved += 1
+        except Exception as ex:
+            self.errors += 1
+            self.log.exception(f"Cannot save the snapshot {self.path}: ")
+
+    async def snapshot_task(self, exited: asyncio.Event):
+        """
+        This task periodically saves the state, and once more on exit (or cancellation)
+        """
+        try:
+            while not exited.is_set():
+                try:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(exited.wait(), self.interval)
+
+                    if not exited.is_set():
+                        await self.save_async()
+                except Exception as ex:
+                    self.log.exception("Error in snapshot_task: ")
+        finally:
+            self.save()
@@ -0,0 +1,73 @@
+import time
+
+
+class ValveState:
+    """
+    A valve state confirmed by a BLE transaction
+    """
+    __slots__ = ("is_on", "comfort_temp_dec", "mode", "confirmed_at")
+
+    def __init__(self, is_on: bool, comfort_temp_dec: int, mode: int, confirmed_at: float):
+        self.is_on = is_on
+        self.comfort_temp_dec = comfort_temp_dec  # tenths of °C
+        self.mode = mode
+        self.confirmed_at = confirmed_at  # monotonic clock
+
+
+class ValveStateCache:
+    """
+    The last confirmed state of each valve, trusted for `ttl` seconds.
+
+    A command asking for the state that the valve is known to be in is answered from the cache, without any
+    BLE transaction. The TTL bounds how long a change made on the valve itself (e.g. a manual knob turn) can
+    be missed; the state is forgotten as soon as a command fails.
+    """
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+
+        # key is the valve name
+        self._states: dict[str, ValveState] = dict()
+
+        # metrics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, valve_name: str) -> ValveState | None:
+        state = self._states.get(valve_name)
+        if state is not None and time.monotonic() - state.confirmed_at >= self.ttl:
+            del self._states[valve_name]
+            state = None
+        return state
+
+    def is_satisfied(self, valve_name: str, is_on: bool) -> bool:
+        """
+        True if the valve is known to be in the `is_on` state (counted as a cache hit or miss)
+        """
+        state = self.get(valve_name)
+        if state is not None and state.is_on == is_on:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def confirm(self, valve_name: str, is_on: bool, comfort_temp_dec: int, mode: int,
+                confirmed_at: float | None = None):
+        """
+        Records the state of the valve, confirmed now or at `confirmed_at` (monotonic clock, e.g. from a snapshot)
+        """
+        self._states[valve_name] = ValveState(is_on, comfort_temp_dec, mode,
+                                              time.monotonic() if confirmed_at is None else confirmed_at)
+
+    def invalidate(self, valve_name: str):
+        self._states.pop(valve_name, None)
+
+    def as_attributes(self, valve_name: str) -> dict:
+        state = self.get(valve_name)
+        if state is None:
+            return {}
+        return {
+            "confirmed_state": "open" if state.is_on else "closed",
+            "comfort_temperature": state.comfort_temp_dec / 10,
+            "mode": state.mode,
+        }
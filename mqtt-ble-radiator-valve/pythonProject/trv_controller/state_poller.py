@@ -0,0 +1,165 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Iterable
+
+from trv_controller.valve_registry import ValveConfig
+
+
+class StatePoller:
+    """
+    Background reconciliation of the valves state: the comfort setpoint of each valve is read about every `interval`
+    seconds (spread by ±`jitter` of it), such that the changes made on the valve itself (manual knob turn, reset)
+    are detected. The read and the handling of its result are done by `poll(valve, proxy_hostname)`, which returns
+    False if the read failed.
+
+    The reads make room for the interactive commands and spare the radio and the batteries:
+    - the first reads are spread over the interval, and a valve confirmed by a command is not read before
+      `interval` seconds (see `on_confirmed`),
+    - a read starts only when no command is waiting or running (`is_idle`), at most one read runs per proxy,
+      and each read goes through the best proxy of the valve (`proxies_of`) not already reading,
+    - each valve is read at most `daily_reads` times per 24 hours, and a failed read is retried after
+      `retry_delay` seconds.
+    """
+    DAY = 24 * 3600.0
+
+    def __init__(self,
+                 valves: Callable[[], Iterable[ValveConfig]],
+                 proxies_of: Callable[[ValveConfig], list[str]],
+                 poll: Callable[[ValveConfig, str], Awaitable[bool]],
+                 is_idle: Callable[[], bool],
+                 interval: float = 3600.0,
+                 jitter: float = 0.2,
+                 daily_reads: int = 24,
+                 retry_delay: float = 600.0,
+                 check_interval: float = 1.0):
+        self.log = logging.getLogger("state-poller")
+        self.valves = valves
+        self.proxies_of = proxies_of
+        self.poll = poll
+        self.is_idle = is_idle
+        self.interval = interval
+        self.jitter = jitter
+        self.daily_reads = daily_reads
+        self.retry_delay = retry_delay
+        self.check_interval = check_interval
+
+        # time of the next read of each valve (monotonic clock), key is valve name
+        self._due: dict[str, float] = dict()
+
+        # times of the reads of the last 24 hours (monotonic clock), key is valve name
+        self._reads: dict[str, collections.deque[float]] = dict()
+
+        # the valves being read, the proxies reading them, and the read tasks
+        self._polling: set[str] = set()
+        self._busy_proxies: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+        # metrics
+        self.polls = 0
+        self.failed_polls = 0
+        self.drifts = 0
+
+    @classmethod
+    def from_config(cls,
+                    valves: Callable[[], Iterable[ValveConfig]],
+                    proxies_of: Callable[[ValveConfig], list[str]],
+                    poll: Callable[[ValveConfig, str], Awaitable[bool]],
+                    is_idle: Callable[[], bool],
+                    config: dict):
+        return cls(valves, proxies_of, poll, is_idle,
+                   interval=config.get("interval", 3600.0),
+                   jitter=config.get("jitter", 0.2),
+                   daily_reads=config.get("daily_reads", 24),
+                   retry_delay=config.get("retry_delay", 600.0))
+
+    def _next_interval(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def on_confirmed(self, valve_name: str):
+        """
+        Called when the state of a valve was confirmed by a command: its next read is postponed
+        """
+        self._due[valve_name] = time.monotonic() + self._next_interval()
+
+    def check(self):
+        """
+        Starts the reads that are due, if the commands leave room for them
+        """
+        now = time.monotonic()
+        valves = {valve.name: valve for valve in self.valves()}
+        for valve_name in self._due.keys() - valves.keys():
+            # removed from the config or handed over
+            del self._due[valve_name]
+            self._reads.pop(valve_name, None)
+
+        due = []
+        for valve_name, valve in valves.items():
+            due_at = self._due.get(valve_name)
+            if due_at is None:
+                due_at = self._due[valve_name] = now + random.uniform(0, self.interval)
+            if due_at <= now and valve_name not in self._polling:
+                due.append((due_at, valve))
+        if not due or not self.is_idle():
+            return
+
+        for _, valve in sorted(due, key=lambda item: item[0]):
+            reads = self._reads.setdefault(valve.name, collections.deque())
+            while reads and now - reads[0] >= self.DAY:
+                reads.popleft()
+            if len(reads) >= self.daily_reads:
+                self.log.debug("[Valve %s] Daily read budget exhausted", valve.name)
+                self._due[valve.name] = reads[0] + self.DAY
+                continue
+
+            proxy_hostname = next((proxy_hostname for proxy_hostname in self.proxies_of(valve)
+                                   if proxy_hostname not in self._busy_proxies), None)
+            if proxy_hostname is None:
+                # no proxy, or all its proxies are reading: tried again on the next check
+                continue
+
+            reads.append(now)
+            self._polling.add(valve.name)
+            self._busy_proxies.add(proxy_hostname)
+            task = asyncio.get_running_loop().create_task(self._read(valve, proxy_hostname))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _read(self, valve: ValveConfig, proxy_hostname: str):
+        try:
+            done = await self.poll(valve, proxy_hostname)
+        except Exception as ex:
+            self.log.exception(f"[Valve {valve.name}] Error while reading the state: ")
+            done = False
+        finally:
+            self._polling.discard(valve.name)
+            self._busy_proxies.discard(proxy_hostname)
+
+        if done:
+            self.polls += 1
+        else:
+            self.failed_polls += 1
+        if valve.name in self._due:
+            self._due[valve.name] = time.monotonic() + (self._next_interval() if done else self.retry_delay)
+
+    async def poll_task(self, exited: asyncio.Event):
+        """
+        This task starts the reads when they are due, the running ones are cancelled on exit
+        """
+        try:
+            while not exited.is_set():
+                try:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(exited.wait(), self.check_interval)
+
+                    if not exited.is_set():
+                        self.check()
+                except Exception as ex:
+                    self.log.exception("Error in poll_task: ")
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
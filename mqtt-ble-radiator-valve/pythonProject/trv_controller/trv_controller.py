@@ -1,35 +1,96 @@
 import asyncio
-import contextlib
+import functools
 import json
 import logging
+import signal
 import time
 
 import aioesphomeapi
 import yaml
 from aioesphomeapi import ReconnectLogic, APIConnectionError
 
-from aioesphomeapi import BluetoothLERawAdvertisementsResponse
 from aiomqtt import Client
 
+from trv_controller.adv_ingest import AdvertisementIngestor, ValveSighting
+from trv_controller.availability import AvailabilityTracker
+from trv_controller.batch_planner import plan_batch
+from trv_controller import radiator_valve
+from trv_controller.command_intake import CommandIntake
+from trv_controller.command_queue import ValveCommandQueue
+from trv_controller.config_watcher import ConfigWatcher
+from trv_controller.flight_recorder import FlightRecorder
+from trv_controller.metrics import Counter, MetricsRegistry, MetricsServer
+from trv_controller.mqtt_publisher import CoalescingPublisher
+from trv_controller.proxy_health import ProxyHealth
 from trv_controller.radiator_valve import RadiatorValve
+from trv_controller.session_pool import ValveSessionPool
+from trv_controller.sharding import ShardCoordinator
+from trv_controller.slot_scheduler import ConnectionSlotScheduler
+from trv_controller.snapshot import StateSnapshot
+from trv_controller.state_cache import ValveStateCache
+from trv_controller.state_poller import StatePoller
+from trv_controller.valve_registry import ValveConfig, ValveGroup, ValveRegistry
+
+
+class _CountingClient(Client):
+    """
+    MQTT client counting the messages published by all the components
+    """
+
+    def __init__(self, *args, published: Counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._published = published
+
+    async def publish(self, *args, **kwargs):
+        await super().publish(*args, **kwargs)
+        self._published.inc()
 
 
 class RadiatorValveSwitchManager:
     DISCOVERY_PREFIX = "homeassistant"
     DEVICE_TOPIC_PREFIX = "ble_radiator_valve"
 
+    # the YAML config sections applied by `apply_config`, the other ones are read at startup only
+    RELOADABLE_SECTIONS = ("bluetooth_proxies", "radiator_valve_switches", "radiator_valve_groups")
+
     def _start_proxies_connection_manager(self):
         for proxy in self.config["bluetooth_proxies"]:
             if not proxy.get("enabled", True):
                 continue
 
-            self.connections_manager_task_group.create_task(self._proxy_connection_manager_task(proxy),
-                                                            name=f"connection-to-{proxy['hostname']}")
+            self._start_proxy_connection_manager(proxy)
+
+    def _start_proxy_connection_manager(self, proxy: dict):
+        self.proxy_tasks[proxy["hostname"]] = self.connections_manager_task_group.create_task(
+            self._proxy_connection_manager_task(proxy), name=f"connection-to-{proxy['hostname']}")
 
-    def __init__(self, config: dict):
+    async def _stop_proxy_connection_manager(self, hostname: str):
+        """
+        Cancels the connection manager task of a proxy, and waits for its API connection to be closed
+        """
+        task = self.proxy_tasks.pop(hostname, None)
+        if task is None:
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.proxy_api_clients.pop(hostname, None)
+        if hostname in self.proxy_health:
+            self._on_proxy_disconnected(hostname)
+
+    def __init__(self, config: dict, config_path: str | None = None):
         self.log = logging.getLogger("manager")
 
-        self.config = config
+        # with the `sharding` section in the YAML config the valves are split between the controller instances
+        # sharing the broker: `config` is the part of the YAML config (`full_config`) handled by this instance
+        self.shard: ShardCoordinator | None = \
+            ShardCoordinator.from_config(self.DEVICE_TOPIC_PREFIX, self._on_ownership_change,
+                                         config["sharding"] or {}) if "sharding" in config else None
+        if self.shard is not None:
+            self.shard.set_valves([valve["name"] for valve in config.get("radiator_valve_switches") or []])
+        self.full_config = config
+        self.config = self._owned_config(config)
+        self._apply_lock = asyncio.Lock()
+
         self.exited = asyncio.Event()
         self.mqtt_client: Client | None = None
         self.connections_manager_task_group = asyncio.TaskGroup()
@@ -39,87 +100,346 @@ class RadiatorValveSwitchManager:
         self.proxy_api_clients: dict[
             str, aioesphomeapi.APIClient] = dict()
 
-        # key is valve name
-        self.valve_last_seen: dict[str, float] = dict()
-
-        # first key is valve name, second key is proxy hostname, the value is the rssi
-        self.valves_rssi_map: dict[str, dict[str, int]] = dict()  # dict(valve_mac, dict(hostname, rssi))
-
-        # just a reference to the `radiator_valve_switches` entry of the YAML config
-        self.valves = self.config.get("radiator_valve_switches", [])
-
-    def _valve_state_topic(self, valve: dict):
-        return f"{self.DEVICE_TOPIC_PREFIX}/{valve['name']}/state"
+        # connection manager task of each enabled proxy, key is the proxy hostname
+        self.proxy_tasks: dict[str, asyncio.Task] = dict()
 
-    def _valve_command_topic(self, valve: dict):
-        return f"{self.DEVICE_TOPIC_PREFIX}/{valve['name']}/set"
+        # health and circuit breaker of each ESPHome proxy, key is the proxy hostname
+        self.proxy_health: dict[str, ProxyHealth] = {
+            proxy["hostname"]: ProxyHealth.from_config(proxy["hostname"], self.config.get("proxy_health") or {})
+            for proxy in self.config["bluetooth_proxies"]
+        }
 
-    def _valve_availability_topic(self, valve):
-        return f"{self.DEVICE_TOPIC_PREFIX}/{valve['name']}/online"
+        # key is valve name, the value is the time of the last advertisement (monotonic clock)
+        self.valve_last_seen: dict[str, float] = dict()
 
-    def _valve_attributes_topic(self, valve):
-        return f"{self.DEVICE_TOPIC_PREFIX}/{valve['name']}/attributes"
+        # key is valve name, the value is the last state published on the state topic (True if open)
+        self.valve_last_state: dict[str, bool] = dict()
 
-    async def _publish_discovery(self, client, valve):
+        # first key is valve name, second key is proxy hostname, the value is the rssi
+        self.valves_rssi_map: dict[str, dict[str, int]] = dict()  # dict(valve_name, dict(hostname, rssi))
+
+        # the `radiator_valve_switches` entry of the YAML config, compiled and indexed by name and MAC address,
+        # and the `radiator_valve_groups` entry
+        self.valves = ValveRegistry(self.config.get("radiator_valve_switches", []),
+                                    self.DEVICE_TOPIC_PREFIX, self.DISCOVERY_PREFIX,
+                                    availability_timeout=self.config["mqtt"].get("availability_timeout", 60),
+                                    groups_config=self.config.get("radiator_valve_groups") or [])
+
+        # the valves advertisements of all the proxies are ingested in batches
+        self.ingestor = AdvertisementIngestor.from_config(self.valves.by_mac, self._on_advertisement_batch,
+                                                          self.config.get("advertisements") or {})
+
+        # first key is valve name, second key is proxy hostname, the value is the smoothed command success rate
+        self.valves_proxy_success: dict[str, dict[str, float]] = dict()
+
+        # the BLE sessions are kept open between commands, see `ble_sessions` in the YAML config
+        self.session_pool = ValveSessionPool.from_config(self.config.get("ble_sessions") or {})
+
+        # the BLE traffic of the valves and their advertisements are recorded for the post-mortem analysis of the
+        # failed commands (when the `flight_recorder` section is in the YAML config)
+        self.flight_recorder: FlightRecorder | None = \
+            FlightRecorder.from_config(self.config["flight_recorder"] or {}) \
+            if "flight_recorder" in self.config else None
+        self.session_pool.recorder = self.flight_recorder
+        self.ingestor.recorder = self.flight_recorder
+
+        # the transactions are scheduled on the BLE connection slots of the proxies
+        self.slot_scheduler = ConnectionSlotScheduler(
+            self.session_pool,
+            default_slots=(self.config.get("commands") or {}).get("connection_slots", 3),
+            slots={proxy["hostname"]: proxy["connection_slots"]
+                   for proxy in self.config["bluetooth_proxies"] if "connection_slots" in proxy})
+
+        # the commands are admitted by the bounded intake, which feeds the per-valve command queues (key is valve name)
+        self.intake = CommandIntake.from_config(lambda valve: functools.partial(self._execute_valve_command, valve),
+                                                self.pending_commands_task_group.create_task,
+                                                self._on_command_shed,
+                                                lambda: len(self.valves),
+                                                self.config.get("command_intake") or {})
+        self.command_queues: dict[str, ValveCommandQueue] = self.intake.queues
+
+        # the valves attributes and availability are published by a single coalescing task
+        self.publisher = CoalescingPublisher.from_config(self._valve_attributes, self.config["mqtt"])
+
+        # the valves online/offline transitions are detected from the advertisements deadlines
+        self.availability = AvailabilityTracker(self.publisher.set_availability)
+
+        # when set, a second proxy is tried if the best one does not connect to the valve within this time (seconds)
+        self.hedge_delay: float | None = (self.config.get("commands") or {}).get("hedge_delay")
+
+        # time budget of a valve command (seconds), all the proxies and retries included
+        self.command_budget: float = (self.config.get("commands") or {}).get("budget", 60)
+
+        # a group command spreads its valves on the proxies heard within this margin of the best one (dB)
+        self.batch_rssi_margin: float = (self.config.get("commands") or {}).get("batch_rssi_margin", 15)
+
+        # the last confirmed state of each valve, the commands asking for it are answered without BLE transaction
+        self.state_cache = ValveStateCache(ttl=(self.config.get("commands") or {}).get("state_cache_ttl", 300))
+
+        # the valves setpoint is read in the background, between the commands, to detect and revert the changes
+        # made on the valves themselves (when the `state_polling` section is in the YAML config)
+        self.poller: StatePoller | None = \
+            StatePoller.from_config(lambda: self.valves, self._poll_proxies, self._poll_valve,
+                                    lambda: not self.intake.waiting and not self.intake.running,
+                                    self.config["state_polling"] or {}) \
+            if "state_polling" in self.config else None
+
+        # the discovery messages are published by a background task, see `_start_discovery_burst`
+        self.discovery_qos: int = self.config["mqtt"].get("discovery_qos", 0)
+        self.discovery_retain: bool = self.config["mqtt"].get("discovery_retain", False)
+        self.discovery_window = 8  # publications awaiting their acknowledgement (aiomqtt warns above 10)
+        self._discovery_task: asyncio.Task | None = None
+
+        # the config file is watched when known, its changes are applied by `apply_config`
+        self.config_watcher: ConfigWatcher | None = \
+            ConfigWatcher.from_config(config_path, config, self.apply_config) if config_path else None
+
+        # what the manager learned is saved periodically and restored at startup (when the `snapshot` section
+        # is in the YAML config)
+        self.snapshot: StateSnapshot | None = \
+            StateSnapshot.from_config(self._snapshot_state, self.config["snapshot"] or {}) \
+            if "snapshot" in self.config else None
+
+        # the snapshot entries of the valves not restored yet, key is valve name
+        self._snapshot_entries: dict[str, dict] = dict()
+
+        # metrics, served on `/metrics` when the `metrics` section is in the YAML config
+        self.mqtt_messages_received = Counter()
+        self.mqtt_messages_published = Counter()
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+
+    def _register_metrics(self):
+        self.metrics.register(radiator_valve.PHASE_SECONDS, radiator_valve.RETRIES,
+                              radiator_valve.CHECKSUM_ERRORS, radiator_valve.BAD_DATA,
+                              radiator_valve.WRITES_SKIPPED)
+
+        add = self.metrics.add_callback
+        add("trv_proxy_api_connected", "gauge", "1 if the ESPHome API connection to the proxy is up",
+            lambda: (((hostname,), health.api_connected) for hostname, health in self.proxy_health.items()),
+            ("proxy",))
+        add("trv_proxy_circuit_open", "gauge", "1 if the circuit breaker of the proxy is not closed",
+            lambda: (((hostname,), health.state != ProxyHealth.CLOSED)
+                     for hostname, health in self.proxy_health.items()),
+            ("proxy",))
+        add("trv_proxy_ble_connections", "gauge", "Open BLE connections through the proxy (pooled sessions)",
+            lambda: (((hostname,), self.session_pool.connected_count(hostname)) for hostname in self.proxy_health),
+            ("proxy",))
+        add("trv_proxy_reserved_slots", "gauge", "Connection slots of the proxy reserved by running transactions",
+            lambda: (((hostname,), self.slot_scheduler.reserved(hostname)) for hostname in self.proxy_health),
+            ("proxy",))
+        add("trv_slot_waiters", "gauge", "Transactions waiting for a proxy connection slot",
+            lambda: (((), self.slot_scheduler.waiting),))
+        add("trv_mqtt_connected", "gauge", "1 if the MQTT broker connection is up",
+            lambda: (((), self.mqtt_client is not None),))
+        add("trv_mqtt_messages_received_total", "counter", "MQTT messages received",
+            lambda: (((), self.mqtt_messages_received.value),))
+        add("trv_mqtt_messages_published_total", "counter", "MQTT messages published",
+            lambda: (((), self.mqtt_messages_published.value),))
+        add("trv_mqtt_messages_suppressed_total", "counter", "Valve attributes and availability messages skipped "
+            "because unchanged", lambda: (((), self.publisher.suppressed),))
+        add("trv_command_workers", "gauge", "Running tasks of `pending_commands_task_group` (one per busy valve)",
+            lambda: (((), sum(queue.running for queue in self.command_queues.values())),))
+        add("trv_pending_commands", "gauge", "Valve commands running or waiting in the per-valve queues",
+            lambda: (((), sum(queue.depth for queue in self.command_queues.values())),))
+        add("trv_intake_waiting_commands", "gauge", "Valve commands waiting in the intake",
+            lambda: (((), self.intake.waiting),))
+        add("trv_intake_shed_commands_total", "counter", "Valve commands shed by the intake",
+            lambda: (((reason,), self.intake.shed[reason])
+                     for reason in ("superseded", "stale", "removed", "handover")),
+            ("reason",))
+        add("trv_state_cache_hits_total", "counter", "Valve commands answered from the confirmed state cache",
+            lambda: (((), self.state_cache.hits),))
+        add("trv_state_cache_misses_total", "counter", "Valve commands that needed a BLE transaction",
+            lambda: (((), self.state_cache.misses),))
+        add("trv_state_polls_total", "counter", "Background reads of the valves state",
+            lambda: (((), self.poller.polls if self.poller else 0),))
+        add("trv_state_polls_failed_total", "counter", "Background reads of the valves state that failed",
+            lambda: (((), self.poller.failed_polls if self.poller else 0),))
+        add("trv_state_drifts_total", "counter", "Valves found by a background read in another state than the "
+            "desired one", lambda: (((), self.poller.drifts if self.poller else 0),))
+        add("trv_advertisements_received_total", "counter", "BLE advertisements received from the proxies",
+            lambda: (((), self.ingestor.received),))
+        add("trv_advertisements_accepted_total", "counter", "Valve advertisements buffered for ingestion",
+            lambda: (((), self.ingestor.accepted),))
+        add("trv_advertisements_dropped_total", "counter", "Valve advertisements dropped, the buffer being full",
+            lambda: (((), self.ingestor.dropped),))
+        add("trv_config_reloads_total", "counter", "Config file changes applied without restart",
+            lambda: (((), self.config_watcher.reloads if self.config_watcher else 0),))
+        add("trv_snapshots_saved_total", "counter", "State snapshots saved",
+            lambda: (((), self.snapshot.saved if self.snapshot else 0),))
+        add("trv_shard_owned_valves", "gauge", "Valves owned by this controller instance (sharding)",
+            lambda: (((), len(self.shard.owned) if self.shard else len(self.valves)),))
+        add("trv_shard_live_instances", "gauge", "Controller instances holding a lease (sharding)",
+            lambda: (((), len(self.shard.live_instances()) if self.shard else 1),))
+        add("trv_shard_handovers_total", "counter", "Valves claimed or released by this controller instance",
+            lambda: (((), self.shard.handovers if self.shard else 0),))
+        add("trv_flight_recorder_dumps_total", "counter", "Flight recorder dumps written",
+            lambda: (((), self.flight_recorder.dumps if self.flight_recorder else 0),))
+        add("trv_valves_online", "gauge", "Valves advertising within their availability timeout",
+            lambda: (((), self.availability.as_attributes()["online_valves"]),))
+
+    def _request_flight_recorder_dump(self, target: str | None = None, failure: bool = False):
+        if self.flight_recorder is not None:
+            asyncio.get_running_loop().create_task(self._dump_flight_recorder(target, failure))
+
+    async def _dump_flight_recorder(self, target: str | None, failure: bool):
+        """
+        Dumps the records of a valve or a proxy (all of them if `target` is None) to a file, see `FlightRecorder`.
+        The path of the file is published on the `flight_recorder/last_dump` topic.
+        """
+        try:
+            path, records = await self.flight_recorder.dump_to_file(
+                {mac_address: valve.name for mac_address, valve in self.valves.by_mac.items()}, target, failure)
+            if self.mqtt_client:
+                await self.mqtt_client.publish(f"{self.DEVICE_TOPIC_PREFIX}/flight_recorder/last_dump",
+                                               json.dumps({"path": path, "target": target, "records": records}))
+        except Exception as ex:
+            self.log.exception("Cannot dump the flight recorder: ")
+
+    def _proxy_health_topic(self, hostname: str):
+        return f"{self.DEVICE_TOPIC_PREFIX}/proxies/{hostname}/attributes"
+
+    async def _publish_discovery(self, client, valve: ValveConfig):
         """
         This function publishes the MQTT discovery data on the HA MQTT discovery topic.
         (`<discovery_prefix>/<component>/[<node_id>/]<object_id>/config`)
+        The payload is precomputed by `ValveConfig`.
+        """
+        self.log.debug("Publishing discovery data for %s", valve.device_id)
+        await client.publish(topic=valve.discovery_topic, payload=valve.discovery_payload,
+                             qos=self.discovery_qos, retain=self.discovery_retain)
+        if self.poller is not None:
+            await client.publish(topic=valve.comfort_temperature_discovery_topic,
+                                 payload=valve.comfort_temperature_discovery_payload,
+                                 qos=self.discovery_qos, retain=self.discovery_retain)
+
+    def _start_discovery_burst(self, client):
+        """
+        Publishes the discovery data of all the valves from a background task, such that the commands received
+        meanwhile are not delayed. A burst still running is replaced by the new one.
+        """
+        if self._discovery_task is not None:
+            self._discovery_task.cancel()
+        self._discovery_task = asyncio.get_running_loop().create_task(self._publish_discovery_burst(client))
 
-            Refer to:
-                - https://www.home-assistant.io/integrations/mqtt/#mqtt-discovery
-                - https://www.home-assistant.io/integrations/valve.mqtt/
-
-        """
-        device_id = f"radiator_valve_{valve['name']}"
-        self.log.info(f"Publishing discovery data for {device_id}")
-
-        payload = {
-            "unique_id": f"{device_id}",
-            "object_id": f"{device_id}",
-            "state_topic": self._valve_state_topic(valve),
-            "command_topic": self._valve_command_topic(valve),
-            "availability": [{"topic": self._valve_availability_topic(valve)}],
-            "json_attributes_topic": self._valve_attributes_topic(valve),
-            "device": {
-                "identifiers": [valve['mac_address']],
-                "name": f"Radiator Valve {valve['name']}",
-            }
-        }
+    async def _publish_discovery_burst(self, client):
+        started = time.monotonic()
+        window = asyncio.Semaphore(self.discovery_window)
 
-        await client.publish(topic=f"{self.DISCOVERY_PREFIX}/valve/{device_id}/config", payload=json.dumps(payload))
+        async def publish(valve: ValveConfig):
+            async with window:
+                await self._publish_discovery(client, valve)
+
+        try:
+            # the publications are pipelined: with QoS > 0 the acknowledgements are awaited concurrently
+            await asyncio.gather(*(publish(valve) for valve in self.valves))
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            self.log.exception("Error while publishing the discovery data: ")
+        else:
+            self.log.info(f"Published the discovery data of {len(self.valves)} valves "
+                          f"in {time.monotonic() - started:.2f}s")
 
     async def run(self):
+        # warm start, before anything is received
+        self.restore_snapshot()
+
         async with self.connections_manager_task_group as connection_tasks:
             async with self.pending_commands_task_group:
 
                 # start the connection manager for the multiple ESP home connections
                 self._start_proxies_connection_manager()
 
-                # start the task that periodically publishes the valves online status
-                connection_tasks.create_task(self._valve_availability_monitoring_task())
+                # start the task that turns offline the valves that are not advertising anymore
+                connection_tasks.create_task(self.availability.expiry_task(self.exited))
+
+                # start the task that publishes the valves attributes and availability
+                connection_tasks.create_task(self.publisher.publish_task(self.exited, lambda: self.mqtt_client))
+
+                # start the task that forwards the commands waiting in the intake
+                connection_tasks.create_task(self.intake.dispatch_task(self.exited))
+
+                # start the task that ingests the valves advertisements
+                connection_tasks.create_task(self.ingestor.ingest_task(self.exited))
+
+                # start the task that closes the idle BLE sessions
+                connection_tasks.create_task(self.session_pool.eviction_task(self.exited))
+
+                # start the task that applies the changes of the config file
+                if self.config_watcher is not None:
+                    connection_tasks.create_task(self.config_watcher.watch_task(self.exited))
+
+                # start the task that renews the lease of this instance
+                if self.shard is not None:
+                    connection_tasks.create_task(self.shard.heartbeat_task(self.exited, lambda: self.mqtt_client))
+
+                # start the task that reads the valves state in the background
+                if self.poller is not None:
+                    connection_tasks.create_task(self.poller.poll_task(self.exited))
+
+                # start the task that saves the state snapshots
+                if self.snapshot is not None:
+                    connection_tasks.create_task(self.snapshot.snapshot_task(self.exited))
+
+                # the flight recorder is dumped on SIGUSR1
+                if self.flight_recorder is not None and hasattr(signal, "SIGUSR1"):
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self._request_flight_recorder_dump)
+
+                # start the metrics HTTP endpoint
+                if "metrics" in self.config:
+                    metrics_server = MetricsServer.from_config(self.metrics, self.config["metrics"] or {})
+                    connection_tasks.create_task(metrics_server.serve_task(self.exited))
 
                 while not self.exited.is_set():  # Main MQTT loop
                     try:
                         # broker connection
                         self.mqtt_client = None
 
-                        async with Client(self.config["mqtt"]["host"],
-                                          self.config["mqtt"].get("port", 1883),
-                                          username=self.config["mqtt"].get('username'),
-                                          password=self.config["mqtt"].get('password'),
-                                          ) as client:
+                        async with _CountingClient(self.config["mqtt"]["host"],
+                                                   self.config["mqtt"].get("port", 1883),
+                                                   username=self.config["mqtt"].get('username'),
+                                                   password=self.config["mqtt"].get('password'),
+                                                   identifier=self.shard.instance_id if self.shard else None,
+                                                   will=self.shard.will if self.shard else None,
+                                                   published=self.mqtt_messages_published,
+                                                   ) as client:
                             self.log.info("MQTT Connected")
                             self.mqtt_client = client
 
-                            # publish the discovery message such that home-assistant will create the valve entity,
-                            # for each registered valve
+                            # the broker may have lost the previous publications, publish everything again
+                            self.publisher.reset()
                             for valve in self.valves:
-                                await self._publish_discovery(client, valve)
+                                self._publish_online_state(valve)
+                                self.publisher.mark_attributes_dirty(valve)
+                            await self.publisher.flush(client)
 
-                            await client.subscribe(f"{self.DEVICE_TOPIC_PREFIX}/+/set")
+                            # the state topic is not retained, publish the known states (e.g. restored at startup)
+                            for valve in self.valves:
+                                if valve.name in self.valve_last_state:
+                                    await self._update_ha_valve_state(valve, self.valve_last_state[valve.name])
+
+                            # publish the discovery message such that home-assistant will create the valve entity,
+                            # for each registered valve
+                            self._start_discovery_burst(client)
+
+                            if self.shard is None:
+                                await client.subscribe(f"{self.DEVICE_TOPIC_PREFIX}/+/set")
+                            else:
+                                # only the commands of the owned valves, the other instances handle the others
+                                for valve in self.valves:
+                                    await client.subscribe(valve.command_topic)
+                                await client.subscribe(self.shard.topic_filter)
+                                self.shard.on_connected()
+                            if self.valves.groups or self.shard is not None:
+                                await client.subscribe(f"{self.DEVICE_TOPIC_PREFIX}/group/+/set")
                             await client.subscribe(f"{self.DISCOVERY_PREFIX}/status")
+                            if self.flight_recorder is not None:
+                                await client.subscribe(f"{self.DEVICE_TOPIC_PREFIX}/flight_recorder/dump")
 
                             async for message in client.messages:
+                                self.mqtt_messages_received.inc()
 
                                 # mqtt valve set command received
                                 if message.topic.matches(f"{self.DEVICE_TOPIC_PREFIX}/+/set"):
@@ -127,102 +447,575 @@ class RadiatorValveSwitchManager:
                                     turn_on = message.payload.decode().lower() in ["true", "1", "on", "open"]
                                     await self._handle_command(device_name, turn_on)
 
-                                # homeassistant is just born, resend the initial discovery message (like a retained)
+                                # mqtt group set command received
+                                elif message.topic.matches(f"{self.DEVICE_TOPIC_PREFIX}/group/+/set"):
+                                    group_name = str(message.topic).split("/")[2]
+                                    turn_on = message.payload.decode().lower() in ["true", "1", "on", "open"]
+                                    self._handle_group_command(group_name, turn_on)
+
+                                # lease record of a controller instance
+                                elif self.shard is not None and message.topic.matches(self.shard.topic_filter):
+                                    self.shard.on_lease(str(message.topic).split("/")[-1], message.payload)
+
+                                # flight recorder dump request, the payload names a valve or a proxy (empty for all)
+                                elif message.topic.matches(f"{self.DEVICE_TOPIC_PREFIX}/flight_recorder/dump"):
+                                    self._request_flight_recorder_dump(message.payload.decode().strip() or None)
+
+                                # homeassistant is just born, resend the initial discovery message (unless retained)
                                 elif message.topic.matches(f"{self.DISCOVERY_PREFIX}/status"):
-                                    for valve in self.valves:
-                                        await self._publish_discovery(client, valve)
+                                    if message.payload == b"online" and not self.discovery_retain:
+                                        self._start_discovery_burst(client)
                     except Exception as ex:
                         self.log.exception("Exception in MQTT loop, restarting in 10s: ")
                         await asyncio.sleep(10)
 
+    def _owned_config(self, config: dict) -> dict:
+        """
+        Returns the part of the config handled by this instance: all of it, or with sharding the owned valves,
+        the proxies they use and the groups restricted to them (the whole config being validated).
+        """
+        if self.shard is None:
+            return config
+
+        ValveRegistry(config.get("radiator_valve_switches") or [], self.DEVICE_TOPIC_PREFIX, self.DISCOVERY_PREFIX,
+                      groups_config=config.get("radiator_valve_groups") or [])
+
+        valves = [valve for valve in config.get("radiator_valve_switches") or [] if valve["name"] in self.shard.owned]
+        used_proxies = {hostname for valve in valves for hostname in valve.get("bluetooth_proxies", ())}
+        groups = [{**group, "valves": [name for name in group["valves"] if name in self.shard.owned]}
+                  for group in config.get("radiator_valve_groups") or []]
+        return {
+            **config,
+            "bluetooth_proxies": [proxy for proxy in config["bluetooth_proxies"] if proxy["hostname"] in used_proxies],
+            "radiator_valve_switches": valves,
+            "radiator_valve_groups": [group for group in groups if group["valves"]],
+        }
+
+    def _on_ownership_change(self):
+        asyncio.get_running_loop().create_task(self._apply_ownership())
+
+    async def _apply_ownership(self):
+        """
+        Takes over the valves claimed by this instance, and hands over the released ones (see `ShardCoordinator`)
+        """
+        try:
+            async with self._apply_lock:
+                await self._apply_config(self._owned_config(self.full_config), handover=True)
+        except Exception as ex:
+            self.log.exception("Error while applying the valves ownership: ")
+
+    async def apply_config(self, config: dict):
+        """
+        Applies a new YAML config without restarting (see `ConfigWatcher`): only the connection manager tasks of
+        the added, removed or modified proxies are started or stopped, and the valves are added, updated or removed
+        in place. The other proxy connections, BLE sessions and valve states are kept.
+        A ValueError is raised, and nothing is changed, if the valves or the groups are invalid.
+        """
+        async with self._apply_lock:
+            owned_config = self._owned_config(config)
+            self.full_config = config
+            await self._apply_config(owned_config, handover=False)
+        if self.shard is not None:
+            self.shard.set_valves([valve["name"] for valve in config.get("radiator_valve_switches") or []])
+
+    async def _apply_config(self, config: dict, handover: bool):
+        """
+        Applies the part of the config handled by this instance, see `apply_config`.
+        With `handover` the changes come from the sharding: the valves and proxies are not removed from the config
+        but moved to another instance, which keeps publishing their retained topics.
+        """
+        previous_proxies = {proxy["hostname"]: proxy for proxy in self.config["bluetooth_proxies"]}
+        proxies = {proxy["hostname"]: proxy for proxy in config["bluetooth_proxies"]}
+        added, removed, updated = self.valves.update(config.get("radiator_valve_switches") or [],
+                                                     config.get("radiator_valve_groups") or [])
+
+        ignored = sorted(section for section in config.keys() | self.config.keys()
+                         if section not in self.RELOADABLE_SECTIONS and config.get(section) != self.config.get(section))
+        if ignored and not handover:
+            self.log.warning(f"Config sections {ignored} changed, they are applied on restart only")
+        self.config = {**self.config, **{section: config.get(section) for section in self.RELOADABLE_SECTIONS}}
+
+        for hostname, proxy in previous_proxies.items():
+            if proxies.get(hostname) != proxy:
+                await self._stop_proxy_connection_manager(hostname)
+            if hostname not in proxies:
+                self.log.info(f"[Proxy {hostname}] {'Not used anymore' if handover else 'Removed from the config'}")
+                self._forget_proxy(hostname, handover)
+
+        for hostname, proxy in proxies.items():
+            if previous_proxies.get(hostname) == proxy:
+                continue
+            self.log.info(f"[Proxy {hostname}] " + ("Used" if handover else
+                                                    "Modified in the config" if hostname in previous_proxies else
+                                                    "Added to the config"))
+            if hostname not in self.proxy_health:
+                self.proxy_health[hostname] = ProxyHealth.from_config(hostname, self.config.get("proxy_health") or {})
+            self.slot_scheduler.set_configured_limit(hostname, proxy.get("connection_slots"))
+            if proxy.get("enabled", True):
+                self._start_proxy_connection_manager(proxy)
+
+        for valve in removed:
+            self.log.info(f"[Valve {valve.name}] {'Handed over' if handover else 'Removed from the config'}")
+            self._forget_valve(valve, handover)
+
+        for valve in updated:
+            self.log.info(f"[Valve {valve.name}] Modified in the config")
+            self.intake.update_valve(valve)
+            self.publisher.mark_attributes_dirty(valve)
+
+        for valve in added:
+            self.log.info(f"[Valve {valve.name}] {'Taken over' if handover else 'Added to the config'}")
+            self._restore_valve(valve)
+            self._publish_online_state(valve)
+            self.publisher.mark_attributes_dirty(valve)
+            if self.mqtt_client:
+                asyncio.get_running_loop().create_task(self._publish_discovery(self.mqtt_client, valve))
+                if valve.name in self.valve_last_state:
+                    asyncio.get_running_loop().create_task(
+                        self._update_ha_valve_state(valve, self.valve_last_state[valve.name]))
+
+        if self.shard is not None:
+            # the valves of the config handled by the other instances are not new devices
+            self.ingestor.other_valves = {RadiatorValve.mac_to_int(valve["mac_address"])
+                                          for valve in self.full_config.get("radiator_valve_switches") or []
+                                          if valve["name"] not in self.valves.by_name}
+
+        if self.mqtt_client:
+            try:
+                if self.shard is not None:
+                    for valve in removed:
+                        if valve.name not in self.valves.by_name:
+                            await self.mqtt_client.unsubscribe(valve.command_topic)
+                    for valve in added:
+                        await self.mqtt_client.subscribe(valve.command_topic)
+                if self.valves.groups:
+                    await self.mqtt_client.subscribe(f"{self.DEVICE_TOPIC_PREFIX}/group/+/set")
+            except Exception as ex:
+                # subscribed again on reconnection
+                self.log.exception("Cannot update the command subscriptions: ")
+
+    def _forget_proxy(self, hostname: str, handover: bool = False):
+        """
+        Drops the state of a proxy removed from the config, and its retained health topic (unless handed over)
+        """
+        del self.proxy_health[hostname]
+        self.slot_scheduler.set_configured_limit(hostname, None)
+        if self.flight_recorder is not None:
+            self.flight_recorder.forget_proxy(hostname)
+        for rssi_map in self.valves_rssi_map.values():
+            rssi_map.pop(hostname, None)
+        for success_map in self.valves_proxy_success.values():
+            success_map.pop(hostname, None)
+
+        if self.mqtt_client and not handover:
+            asyncio.get_running_loop().create_task(
+                self.mqtt_client.publish(self._proxy_health_topic(hostname), b"", retain=True))
+
+    def _forget_valve(self, valve: ValveConfig, handover: bool = False):
+        """
+        Drops the state of a valve removed from the config, and its retained topics (unless handed over).
+        Its BLE sessions are closed, the valve accepting a single connection.
+        """
+        self.intake.remove_valve(valve.name, "handover" if handover else "removed")
+        self.availability.forget(valve)
+        self.publisher.forget(valve)
+        self.state_cache.invalidate(valve.name)
+        self.valve_last_seen.pop(valve.name, None)
+        self.valves_rssi_map.pop(valve.name, None)
+        self.valves_proxy_success.pop(valve.name, None)
+        self.valve_last_state.pop(valve.name, None)
+        if self.flight_recorder is not None:
+            self.flight_recorder.forget_valve(valve.mac_int)
+        asyncio.get_running_loop().create_task(self.session_pool.close_valve(valve.mac_address))
+
+        if self.mqtt_client and not handover:
+            # an empty discovery message deletes the HA entity
+            topics = [valve.discovery_topic, valve.availability_topic]
+            if self.poller is not None:
+                topics += [valve.comfort_temperature_discovery_topic, valve.comfort_temperature_topic]
+            for topic in topics:
+                asyncio.get_running_loop().create_task(self.mqtt_client.publish(topic, b"", retain=True))
+
     async def _handle_command(self, device_name: str, turn_on: bool):
-        found_valve = next(
-            (switch for switch in self.config["radiator_valve_switches"] if switch["name"] == device_name),
-            None)
+        found_valve = self.valves.by_name.get(device_name)
 
         if found_valve is None:
             self.log.warning(f"Received command for unknown valve: {device_name}")
             return
 
-        async def execute_command_for_valve_task(valve: dict, turn_on: bool):
-            for proxy_hostname in valve['bluetooth_proxies']:
-                if proxy_hostname not in self.proxy_api_clients:
-                    self.log.error(
-                        f"[Valve {valve['name']} - Missing proxy with hostname: {proxy_hostname} in `bluetooth_proxies` definition.")
-                    continue
+        self._submit_command(found_valve, turn_on)
 
-                mac = valve['mac_address']
+    def _submit_command(self, valve: ValveConfig, turn_on: bool, proxy_hostname: str | None = None) -> asyncio.Future:
+        """
+        Queues a valve command, returns the future of its outcome (see `CommandIntake.submit`)
+        """
+        # the commands of each valve are serialised by its queue, which runs them in the
+        # `pending_commands_task_group` and collapses the pending ones to the latest desired state
+        future = self.intake.submit(valve, turn_on, proxy_hostname)
+        self.publisher.mark_attributes_dirty(valve)
+        return future
+
+    def _on_command_shed(self, valve: ValveConfig, turn_on: bool, reason: str):
+        self.publisher.mark_attributes_dirty(valve)
+        if not self.mqtt_client:
+            return
+        payload = json.dumps({"state": "open" if turn_on else "closed", "status": "shed", "reason": reason})
+        asyncio.get_running_loop().create_task(self.mqtt_client.publish(valve.command_status_topic, payload))
 
-                self.log.info(
-                    f"[Valve {valve['name']}] [Proxy {proxy_hostname}] Trying turning {'on' if turn_on else 'off'}")
-                cli = self.proxy_api_clients[proxy_hostname]
+    def _handle_group_command(self, group_name: str, turn_on: bool):
+        group = self.valves.groups.get(group_name)
 
-                ble_valve = RadiatorValve(mac, cli)
-                if await ble_valve.set_state(turn_on):
-                    self.log.info(f"[Valve {valve['name']}] [Proxy {proxy_hostname}] Done.")
+        if group is None and self.shard is not None:
+            # no owned valve in the group, or an unknown group reported by the other instances
+            return
+        if group is None:
+            self.log.warning(f"Received command for unknown group: {group_name}")
+            return
 
-                    # write the new state on the state-topic
-                    await self._update_ha_valve_state(valve, turn_on)
-                    return True
+        self.pending_commands_task_group.create_task(self._execute_group_command(group, turn_on))
+
+    async def _execute_group_command(self, group: ValveGroup, turn_on: bool) -> dict:
+        """
+        Runs the commands of the group valves as a single batch, spread on the proxies by `plan_batch`,
+        and publishes the aggregate result on the group result topic (the valve states are published as usual).
+        """
+        started = time.monotonic()
+
+        # the valves answered from the state cache do not use any connection slot
+        batch = [valve for valve in group.valves
+                 if (state := self.state_cache.get(valve.name)) is None or state.is_on != turn_on]
+        plan = plan_batch({valve.name: self._batch_candidates(valve) for valve in batch},
+                          {hostname: self.slot_scheduler.limit(hostname) for hostname in self.proxy_api_clients})
+        self.log.info(f"[Group {group.name}] Turning {'on' if turn_on else 'off'} {len(group.valves)} valves, "
+                      f"plan: {plan}")
+
+        futures = [self._submit_command(valve, turn_on, plan.get(valve.name)) for valve in group.valves]
+        outcomes = await asyncio.gather(*futures)
+
+        results = {"done": [], "failed": [], "shed": []}
+        for valve, outcome in zip(group.valves, outcomes):
+            results["shed" if outcome is None else "done" if outcome else "failed"].append(valve.name)
+
+        result = {
+            "state": "open" if turn_on else "closed",
+            "result": "done" if len(results["done"]) == len(group.valves) else
+                      "failed" if not results["done"] else "partial",
+            **results,
+            "duration": round(time.monotonic() - started, 1),
+        }
+        self.log.info(f"[Group {group.name}] {result}")
+
+        if self.mqtt_client:
+            await self.mqtt_client.publish(group.result_topic, json.dumps(result))
+        return result
+
+    def _batch_candidates(self, valve: ValveConfig) -> list[str]:
+        """
+        Returns the ranked proxies of the valve that heard it within `batch_rssi_margin` of the best RSSI
+        (all the ranked ones if no proxy heard it), or only the proxy holding a BLE session to the valve
+        """
+        ranked_proxies = self._rank_proxies(valve)
+        if ranked_proxies and self.session_pool.is_connected(ranked_proxies[0], valve.mac_address):
+            # a valve accepts a single connection
+            return ranked_proxies[:1]
+
+        rssi_map = self.valves_rssi_map.get(valve.name, {})
+        heard = [hostname for hostname in ranked_proxies if hostname in rssi_map]
+        if not heard:
+            return ranked_proxies
+
+        best_rssi = max(rssi_map[hostname] for hostname in heard)
+        return [hostname for hostname in heard if rssi_map[hostname] >= best_rssi - self.batch_rssi_margin]
+
+    async def _execute_valve_command(self, valve: ValveConfig, turn_on: bool, planned_proxy: str | None = None,
+                                     priority: int = ConnectionSlotScheduler.INTERACTIVE) -> bool:
+        """
+        Iterates the registered bluetooth proxies of the valve, and tries to send the command.
+        The `planned_proxy` (see `plan_batch`) is tried first if given.
+        A command asking for the confirmed state of the valve (see `ValveStateCache`) is answered without connecting.
+        """
+        if self.state_cache.is_satisfied(valve.name, turn_on):
+            self.log.info(f"[Valve {valve.name}] Already {'on' if turn_on else 'off'}, state confirmed recently")
+            await self._update_ha_valve_state(valve, turn_on)
+            return True
+
+        for proxy_hostname in valve.bluetooth_proxies:
+            if proxy_hostname not in self.proxy_api_clients:
+                self.log.error(
+                    f"[Valve {valve.name} - Missing proxy with hostname: {proxy_hostname} in `bluetooth_proxies` definition.")
+
+        # the proxies are sorted by RSSI and recent success at dispatch time
+        ranked_proxies = self._rank_proxies(valve)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.command_budget
+
+        if planned_proxy in ranked_proxies:
+            ranked_proxies.remove(planned_proxy)
+            ranked_proxies.insert(0, planned_proxy)
+
+        while ranked_proxies and loop.time() < deadline:
+            proxy_hostname, ble_valve, connect_latency = await self._connect_valve(valve, ranked_proxies, priority,
+                                                                                  deadline)
+            if ble_valve is None:
+                continue
+
+            self.log.info(
+                f"[Valve {valve.name}] [Proxy {proxy_hostname}] Trying turning {'on' if turn_on else 'off'}")
+
+            try:
+                done = await ble_valve.set_state(turn_on, deadline=deadline)
+            finally:
+                self.session_pool.touch(proxy_hostname, ble_valve)
+                self.slot_scheduler.release(proxy_hostname, valve.mac_address)
+            self._record_proxy_outcome(valve, proxy_hostname, done, connect_latency,
+                                       proxy_fault=ble_valve.proxy_error is not None)
+
+            if done:
+                self.log.info(f"[Valve {valve.name}] [Proxy {proxy_hostname}] Done.")
+                self.state_cache.confirm(valve.name, turn_on, ble_valve.current_comfort_temp_dec, ble_valve.read_mode)
+                self.publisher.mark_attributes_dirty(valve)
+                if self.poller is not None:
+                    # the setpoint was read back by the command
+                    self.poller.on_confirmed(valve.name)
+                    await self._publish_comfort_temperature(valve, ble_valve.current_comfort_temp_dec)
+
+                # write the new state on the state-topic
+                await self._update_ha_valve_state(valve, turn_on)
+                return True
 
-            self.log.error(f"Error while trying to turn on/off valve {device_name}")
             # mission failed, let's try next proxy
 
-        # launch a task that iterates all the registered bluetooth proxies for the valve
-        # and tries to send the command
-        self.pending_commands_task_group.create_task(execute_command_for_valve_task(found_valve, turn_on))
+        # the valve may be in any state after a failed command
+        self.state_cache.invalidate(valve.name)
+        self.publisher.mark_attributes_dirty(valve)
 
-    async def _proxy_connection_manager_task(self, proxy: dict):
+        self.log.error(f"Error while trying to turn on/off valve {valve.name}")
+        if self.flight_recorder is not None and self.flight_recorder.dump_on_failure:
+            self._request_flight_recorder_dump(valve.name, failure=True)
+        return False
+
+    def _poll_proxies(self, valve: ValveConfig) -> list[str]:
         """
-        This task handles the while True: connect/reconnect logic for each configured BLE proxy
+        Returns the available proxies of a valve, ranked by `_rank_proxies`: the background reads do not try the
+        unavailable ones as a last resort
         """
-        hostname = proxy["hostname"]
+        if not any(hostname in self.proxy_api_clients and self.proxy_health[hostname].is_available()
+                   for hostname in valve.bluetooth_proxies):
+            return []
+        return self._rank_proxies(valve)
 
-        cli = aioesphomeapi.APIClient(proxy["hostname"],
-                                      proxy.get("port", 6053),
-                                      keepalive=30.0 / 4.5,  # consider the device connection dead after 30s
-                                      password=proxy.get("password", ""),
-                                      noise_psk=proxy.get("noise_psk", None))
+    async def _poll_valve(self, valve: ValveConfig, proxy_hostname: str) -> bool:
+        """
+        Reads the comfort setpoint of the valve through the proxy (see `StatePoller`) and publishes it.
+        When the setpoint is neither the open nor the closed one, or not the one of the state last published
+        to HA, the valve drifted: the published state is written back to the valve by a regular command.
+        Returns False if the read failed.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.command_budget
 
-        def _on_ble_adv(adv: BluetoothLERawAdvertisementsResponse):
-            """
-            This is the bluetooth beacons advertising callback.
-            It receives all listened beacons,
-            """
-            # We are only interested in "vanne" valves adv
-            if "vanne" not in adv.name.lower():
-                return
+        proxy_hostname, ble_valve, connect_latency = await self._connect_valve(
+            valve, [proxy_hostname], ConnectionSlotScheduler.BACKGROUND, deadline)
+        if ble_valve is None:
+            return False
 
-            mac = RadiatorValve.int_to_mac(adv.address)
+        try:
+            comfort_temperature = await ble_valve.read_current_temperature(deadline)
+        finally:
+            self.session_pool.touch(proxy_hostname, ble_valve)
+            self.slot_scheduler.release(proxy_hostname, valve.mac_address)
+        self._record_proxy_outcome(valve, proxy_hostname, comfort_temperature is not None, connect_latency,
+                                   proxy_fault=ble_valve.proxy_error is not None)
+        if comfort_temperature is None:
+            self.log.warning(f"[Valve {valve.name}] [Proxy {proxy_hostname}] Cannot read the state")
+            return False
+
+        await self._publish_comfort_temperature(valve, ble_valve.current_comfort_temp_dec)
+        if self.intake.is_pending(valve.name) or valve.name not in self.valves.by_name:
+            # a command was received meanwhile (its outcome is published), or the valve was removed
+            return True
+
+        is_on = True if ble_valve.has_setpoint(True) else False if ble_valve.has_setpoint(False) else None
+        if is_on is None:
+            self.state_cache.invalidate(valve.name)
+        else:
+            self.state_cache.confirm(valve.name, is_on, ble_valve.current_comfort_temp_dec, ble_valve.read_mode)
+        self.publisher.mark_attributes_dirty(valve)
+
+        desired_state = self.valve_last_state.get(valve.name)
+        if desired_state is None:
+            if is_on is not None:
+                # first state known since the startup
+                await self._update_ha_valve_state(valve, is_on)
+        elif is_on != desired_state:
+            self.poller.drifts += 1
+            self.log.warning(f"[Valve {valve.name}] Comfort temperature set to {comfort_temperature} °C on the valve, "
+                             f"turning it {'on' if desired_state else 'off'} again")
+            self._submit_command(valve, desired_state)
+        return True
+
+    def _rank_proxies(self, valve: ValveConfig) -> list[str]:
+        """
+        Returns the available proxies of a valve (API connected and circuit not open), the most promising first:
+        proxies with an open BLE session to the valve, then by smoothed RSSI plus a bonus for the recent successes.
+        Proxies that never heard the valve come last, in configuration order.
+        When no proxy is available, all the known proxies are returned as a last resort.
+        """
+        rssi_map = self.valves_rssi_map.get(valve.name, {})
+        success_map = self.valves_proxy_success.get(valve.name, {})
+
+        def score(proxy_hostname: str):
+            return (self.session_pool.is_connected(proxy_hostname, valve.mac_address),
+                    proxy_hostname in rssi_map,
+                    rssi_map.get(proxy_hostname, -127) + 20 * success_map.get(proxy_hostname, 0.5))
+
+        proxies = [proxy_hostname for proxy_hostname in valve.bluetooth_proxies
+                   if proxy_hostname in self.proxy_api_clients]
+        available_proxies = [proxy_hostname for proxy_hostname in proxies
+                             if self.proxy_health[proxy_hostname].is_available()]
+        if available_proxies:
+            proxies = available_proxies
+        elif proxies:
+            self.log.warning(f"[Valve {valve.name}] No healthy proxy available, trying all the known ones")
+
+        return sorted(proxies, key=score, reverse=True)
+
+    def _record_proxy_outcome(self, valve: ValveConfig, proxy_hostname: str, success: bool,
+                              connect_latency: float | None = None, proxy_fault: bool = True):
+        """
+        Records the outcome of a valve transaction through the proxy. A failure only counts for the circuit breaker
+        of the proxy when the proxy is responsible for it (`proxy_fault`, see `RadiatorValve.proxy_error`): a valve
+        out of range or with a dead battery must not block the other valves of the proxy.
+        """
+        success_map = self.valves_proxy_success.setdefault(valve.name, dict())
+        success_map[proxy_hostname] = 0.7 * success_map.get(proxy_hostname, 0.5) + 0.3 * float(success)
 
-            valve = next((valve for valve in self.valves if valve["mac_address"].lower() == mac.lower()), None)
-            if valve is None:
-                self.log.warning(f"[MAC Address: {mac}] Received a callback from a brand-new valve, "
-                                 f"please add on `config.yaml`")
-                return
+        health = self.proxy_health.get(proxy_hostname)
+        if health is None:
+            # removed from the config during the command
+            return
+        previous_state = health.state
+        if success:
+            health.record_success(connect_latency)
+        elif proxy_fault:
+            health.record_failure()
+        else:
+            # the proxy did its part, a probe of a half-open circuit is let through again
+            health.on_attempt_cancelled()
+
+        if health.state != previous_state:
+            self.log.warning(f"[Proxy {proxy_hostname}] Circuit {previous_state} -> {health.state}")
+
+        asyncio.get_running_loop().create_task(self._publish_proxy_health(proxy_hostname))
+
+    async def _connect_valve(self, valve: ValveConfig, ranked_proxies: list[str], priority: int,
+                             deadline: float | None = None) \
+            -> tuple[str | None, RadiatorValve | None, float | None]:
+        """
+        Connects the valve through the best proxy of `ranked_proxies` with a free connection slot, waiting for
+        a slot if needed (the used proxies are removed from the list).
+        The slot must be granted and the connection completed before `deadline` (event loop time) if given.
+        It returns the proxy, the connected valve session and the connection time (None if it was already open);
+        the connection slot of the returned proxy must be released by the caller.
+        In hedged mode (`hedge_delay`) the next proxy is tried too if the first one does not connect in time and
+        has a free slot: the first proxy that connects is used, and the other attempt is cancelled.
+        """
+        attempts: dict[asyncio.Task, tuple[str, RadiatorValve]] = dict()
+
+        async def connect(ble_valve: RadiatorValve) -> float | None:
+            async with ble_valve.lock:
+                if ble_valve.connected:
+                    return None
+                started = time.monotonic()
+                await ble_valve.connect(deadline)
+                return time.monotonic() - started
+
+        async def start_attempt(proxy_hostname: str):
+            ranked_proxies.remove(proxy_hostname)
+            health = self.proxy_health.get(proxy_hostname)
+            if health is not None:
+                health.on_attempt()
+            ble_valve = await self.session_pool.get(proxy_hostname,
+                                                    self.proxy_api_clients[proxy_hostname],
+                                                    valve.mac_address)
+            task = asyncio.get_running_loop().create_task(connect(ble_valve))
+            attempts[task] = (proxy_hostname, ble_valve)
 
-            should_resend_valve_state = not self._valve_is_online(mac)
-            self.valve_last_seen[mac] = time.time()
+        try:
+            async with asyncio.timeout_at(deadline):
+                proxy_hostname = await self.slot_scheduler.acquire(valve.mac_address, ranked_proxies, priority)
+        except TimeoutError:
+            # the budget ran out while the proxies were busy with other valves: they are not responsible
+            self.log.warning(f"[Valve {valve.name}] No free connection slot before the end of the command budget")
+            return None, None, None
+        await start_attempt(proxy_hostname)
+        max_attempts = 2 if self.hedge_delay is not None else 1
+        winner = None
 
-            # the valve is just reachable again
-            if should_resend_valve_state:
-                asyncio.get_running_loop().create_task(self._publish_online_state(valve))
+        try:
+            while attempts and winner is None:
+                can_hedge = len(attempts) + len(ranked_proxies) > 1 and len(attempts) < max_attempts
+                done, _ = await asyncio.wait(attempts,
+                                             timeout=self.hedge_delay if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_proxy = self.slot_scheduler.try_acquire(valve.mac_address, ranked_proxies, priority)
+                    if hedge_proxy is None:
+                        # no free slot for a second attempt, keep waiting for the first one
+                        max_attempts = len(attempts)
+                        continue
+
+                    self.log.info(f"[Valve {valve.name}] [Proxy {attempts[next(iter(attempts))][0]}] "
+                                  f"Not connected after {self.hedge_delay}s, trying also {hedge_proxy}")
+                    await start_attempt(hedge_proxy)
+                    continue
 
-            self.log.debug(f"[Proxy {hostname}] Listened beacon for {valve['name']} - Rssi: {adv.rssi} dBm")
+                for task in done:
+                    proxy_hostname, ble_valve = attempts.pop(task)
+                    if task.exception() is None:
+                        if winner is None:
+                            winner = (proxy_hostname, ble_valve, task.result())
+                            continue
+
+                        # connected as well, but later than the winner
+                        async with ble_valve.lock:
+                            await ble_valve.disconnect()
+                    else:
+                        self.log.warning(f"[Valve {valve.name}] [Proxy {proxy_hostname}] "
+                                         f"Connection failed: {task.exception()!r}")
+                        self._record_proxy_outcome(valve, proxy_hostname, False,
+                                                   proxy_fault=ble_valve.proxy_error is not None)
+                    self.slot_scheduler.release(proxy_hostname, valve.mac_address)
+        finally:
+            # cancel the attempts that lost the race
+            for task, (proxy_hostname, ble_valve) in attempts.items():
+                health = self.proxy_health.get(proxy_hostname)
+                if health is not None:
+                    # removed from the config during the connection otherwise
+                    health.on_attempt_cancelled()
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                async with ble_valve.lock:
+                    await ble_valve.disconnect()
+                self.slot_scheduler.release(proxy_hostname, valve.mac_address)
+
+        return winner if winner is not None else (None, None, None)
 
-            self.valves_rssi_map.setdefault(valve['name'], dict())
-            self.valves_rssi_map[valve['name']].setdefault(hostname, adv.rssi)
+    async def _proxy_connection_manager_task(self, proxy: dict):
+        """
+        This task handles the while True: connect/reconnect logic for each configured BLE proxy
+        """
+        hostname = proxy["hostname"]
 
-            # Smooth the RSSI value using an average filter, and publish the attributes data
-            self.valves_rssi_map[valve['name']][hostname] = 0.97 * self.valves_rssi_map[valve['name']][
-                hostname] + 0.03 * adv.rssi
-            asyncio.get_running_loop().create_task(self._publish_attributes(valve))
+        cli = aioesphomeapi.APIClient(proxy["hostname"],
+                                      proxy.get("port", 6053),
+                                      keepalive=30.0 / 4.5,  # consider the device connection dead after 30s
+                                      password=proxy.get("password", ""),
+                                      noise_psk=proxy.get("noise_psk", None))
 
         async def _on_connect() -> None:
             try:
-                self.log.info(f"[Proxy {hostname}] ESPHome client connected")
-                cli.subscribe_bluetooth_le_advertisements(_on_ble_adv)
-                self.proxy_api_clients[hostname] = cli
+                self._on_proxy_connected(hostname, cli)
             except APIConnectionError as err:
                 self.log.warning(f"[Proxy {hostname}] ESPHome client connection error")
                 await cli.disconnect()
@@ -230,10 +1023,12 @@ class RadiatorValveSwitchManager:
         async def _on_disconnect(expected_disconnect) -> None:
             """Run disconnect stuff on API disconnect."""
             self.log.info(f"[Proxy {hostname}] Disconnected - Expected: '{expected_disconnect}'")
+            self._on_proxy_disconnected(hostname)
 
         async def _on_connect_error(err: Exception) -> None:
             """Run disconnect stuff on API disconnect."""
             self.log.exception(f"[Proxy {hostname}] - Connection Error: ")
+            self.proxy_health[hostname].api_connected = False
 
         try:
             reconnect_logic = ReconnectLogic(
@@ -246,59 +1041,183 @@ class RadiatorValveSwitchManager:
             )
 
             await reconnect_logic.start()
-            await self.exited.wait()
-            await cli.disconnect()
-
-            del self.proxy_api_clients[hostname]
+            try:
+                await self.exited.wait()
+            finally:
+                # the task is cancelled when the proxy is removed from the config (see `apply_config`)
+                await reconnect_logic.stop()
+                await cli.disconnect()
+                self.proxy_api_clients.pop(hostname, None)
 
         except Exception as e:
             self.log.exception(f"[Proxy {hostname}]  Exception in _proxy_connection_manager: ")
 
-    async def _update_ha_valve_state(self, valve: dict, is_on: bool):
-        if not self.mqtt_client:
+    def _on_proxy_connected(self, hostname: str, cli: aioesphomeapi.APIClient):
+        """
+        Subscribes the advertisements and the connection slots of a (re)connected proxy, and makes it usable
+        """
+        self.log.info(f"[Proxy {hostname}] ESPHome client connected")
+        cli.subscribe_bluetooth_le_raw_advertisements(functools.partial(self.ingestor.on_raw_advertisements, hostname))
+        cli.subscribe_bluetooth_connections_free(
+            lambda free, limit, *_: self.slot_scheduler.set_reported_limit(hostname, limit))
+        self.proxy_api_clients[hostname] = cli
+        self.proxy_health[hostname].api_connected = True
+        asyncio.get_running_loop().create_task(self._publish_proxy_health(hostname))
+
+    def _on_proxy_disconnected(self, hostname: str):
+        self.session_pool.drop_proxy(hostname)
+        if hostname not in self.proxy_health:
+            # removed from the config
             return
-        await self.mqtt_client.publish(self._valve_state_topic(valve), "open" if is_on else "closed")
+        self.proxy_health[hostname].api_connected = False
+        asyncio.get_running_loop().create_task(self._publish_proxy_health(hostname))
 
-    async def _valve_availability_monitoring_task(self):
-        while True:
-            try:
-                with contextlib.suppress(asyncio.TimeoutError):
-                    await asyncio.wait_for(self.exited.wait(), 30)
+    def _on_advertisement_batch(self, sightings: list[ValveSighting]):
+        """
+        Updates the last seen time and the smoothed RSSI of the valves heard during an ingestion batch.
+        The RSSI average filter gives a 3% weight to each advertisement, whatever the batch they are received in.
+        """
+        for sighting in sightings:
+            valve = sighting.valve
+            self.valve_last_seen[valve.name] = max(sighting.last_seen, self.valve_last_seen.get(valve.name, 0.0))
 
-                if self.exited.is_set():
-                    return
+            # publishes the availability if the valve is just reachable again
+            self.availability.seen(valve, sighting.last_seen)
 
-                for valve in self.valves:
-                    await self._publish_online_state(valve)
-            except Exception as ex:
-                self.log.exception("Error in _valve_availability_monitoring_task: ")
+            rssi_map = self.valves_rssi_map.setdefault(valve.name, dict())
+            for hostname, rssi_sum in sighting.rssi_sums.items():
+                count = sighting.rssi_counts[hostname]
+                rssi = rssi_sum / count
+                weight = 0.97 ** count
+                rssi_map[hostname] = weight * rssi_map.get(hostname, rssi) + (1 - weight) * rssi
+
+            # the attributes data are published by the publisher task
+            self.publisher.mark_attributes_dirty(valve)
+
+        self.log.debug("Ingested the advertisements of %d valves", len(sightings))
 
-    async def _publish_online_state(self, valve: dict):
+    async def _update_ha_valve_state(self, valve: ValveConfig, is_on: bool):
+        self.valve_last_state[valve.name] = is_on
         if not self.mqtt_client:
             return
-        mac = valve["mac_address"].lower()
-        await self.mqtt_client.publish(self._valve_availability_topic(valve),
-                                       "online" if self._valve_is_online(mac) else "offline",
-                                       retain=True)
-
-    def _valve_is_online(self, mac: str) -> bool:
-        return (mac in self.valve_last_seen and
-                time.time() - self.valve_last_seen[mac] < 60)
+        await self.mqtt_client.publish(valve.state_topic, "open" if is_on else "closed")
 
-    async def _publish_attributes(self, valve: dict):
+    async def _publish_comfort_temperature(self, valve: ValveConfig, comfort_temp_dec: int):
         if not self.mqtt_client:
             return
+        await self.mqtt_client.publish(valve.comfort_temperature_topic, f"{comfort_temp_dec / 10:.1f}", retain=True)
 
+    def _publish_online_state(self, valve: ValveConfig):
+        # published by the publisher task, only if changed
+        self.publisher.set_availability(valve, self._valve_is_online(valve))
+
+    def _valve_is_online(self, valve: ValveConfig) -> bool:
+        return self.availability.is_online(valve)
+
+    def _valve_attributes(self, valve: ValveConfig) -> tuple[dict[str, float], dict]:
+        """
+        Returns the smoothed RSSI of the valve by proxy hostname, and its other attributes (see `CoalescingPublisher`)
+        """
         attributes_map = dict()
-        for key, value in self.valves_rssi_map[valve['name']].items():
-            attributes_map[f"{key} RSSI"] = str(int(value)) + " dBm"
+        if valve.name in self.command_queues:
+            attributes_map.update(self.command_queues[valve.name].as_attributes())
+        attributes_map.update(self.state_cache.as_attributes(valve.name))
+
+        return self.valves_rssi_map.get(valve.name, {}), attributes_map
+
+    def _snapshot_state(self) -> dict:
+        """
+        Returns the state saved by `StateSnapshot`: what was learned about each valve, along with its MAC address
+        (a valve renamed or replaced in the config is not restored)
+        """
+        packet_numbers = self.session_pool.packet_numbers()
+        valves = dict()
+        for valve in self.valves:
+            entry = {"mac_address": valve.mac_address}
+            if valve.name in self.valve_last_seen:
+                entry["last_seen"] = round(StateSnapshot.to_wall_clock(self.valve_last_seen[valve.name]), 3)
+            if valve.name in self.valves_rssi_map:
+                entry["rssi"] = {hostname: round(rssi, 1)
+                                 for hostname, rssi in self.valves_rssi_map[valve.name].items()}
+            if valve.name in self.valves_proxy_success:
+                entry["proxy_success"] = {hostname: round(success, 3)
+                                          for hostname, success in self.valves_proxy_success[valve.name].items()}
+            if valve.name in self.valve_last_state:
+                entry["last_state"] = self.valve_last_state[valve.name]
+            if (state := self.state_cache.get(valve.name)) is not None:
+                entry["confirmed_state"] = [state.is_on, state.comfort_temp_dec, state.mode,
+                                            round(StateSnapshot.to_wall_clock(state.confirmed_at), 3)]
+            if valve.mac_int in packet_numbers:
+                entry["packet_number"] = packet_numbers[valve.mac_int]
+            valves[valve.name] = entry
+        return {"valves": valves}
+
+    def restore_snapshot(self):
+        """
+        Restores the state saved by `StateSnapshot` (warm start): the valves availability, RSSI and states are
+        published as soon as MQTT is connected, and the packet numbers seed the first sync of each valve.
+        A valve heard for the last time before its availability timeout stays offline.
+        The valves added later (config reload, sharding) are restored when added.
+        """
+        if self.snapshot is None:
+            return
+        started = time.monotonic()
+        state = self.snapshot.load()
+        if state is None:
+            return
+
+        self._snapshot_entries = dict(state.get("valves", {}))
+        restored = sum(self._restore_valve(valve) for valve in self.valves)
+        self.log.info(f"Restored the state of {restored} valves in {(time.monotonic() - started) * 1000:.1f}ms")
+
+    def _restore_valve(self, valve: ValveConfig) -> bool:
+        """
+        Restores the snapshot entry of a valve (once), unless it was saved for another MAC address
+        """
+        entry = self._snapshot_entries.pop(valve.name, None)
+        if entry is None or entry.get("mac_address") != valve.mac_address:
+            return False
 
-        await self.mqtt_client.publish(self._valve_attributes_topic(valve), json.dumps(attributes_map))
+        name = valve.name
+        try:
+            if "last_seen" in entry:
+                last_seen = StateSnapshot.to_monotonic(entry["last_seen"])
+                self.valve_last_seen[name] = last_seen
+                if last_seen + valve.availability_timeout > time.monotonic():
+                    self.availability.seen(valve, last_seen)
+            if "rssi" in entry:
+                self.valves_rssi_map[name] = {hostname: rssi for hostname, rssi in entry["rssi"].items()
+                                              if hostname in self.proxy_health}
+            if "proxy_success" in entry:
+                self.valves_proxy_success[name] = {hostname: success
+                                                   for hostname, success in entry["proxy_success"].items()
+                                                   if hostname in self.proxy_health}
+            if "last_state" in entry:
+                self.valve_last_state[name] = entry["last_state"]
+            if "confirmed_state" in entry:
+                is_on, comfort_temp_dec, mode, confirmed_at = entry["confirmed_state"]
+                self.state_cache.confirm(name, is_on, comfort_temp_dec, mode, StateSnapshot.to_monotonic(confirmed_at))
+            if "packet_number" in entry:
+                self.session_pool.seed_packet_numbers({valve.mac_int: entry["packet_number"]})
+        except Exception as ex:
+            self.log.exception(f"[Valve {name}] Cannot restore the snapshot entry: ")
+            return False
+
+        self.publisher.mark_attributes_dirty(valve)
+        return True
+
+    async def _publish_proxy_health(self, hostname: str):
+        if not self.mqtt_client or hostname not in self.proxy_health:
+            return
+
+        await self.mqtt_client.publish(self._proxy_health_topic(hostname),
+                                       json.dumps(self.proxy_health[hostname].as_attributes()),
+                                       retain=True)
 
 
 async def run(config_path):
     with open(config_path, "r") as file:
         config = yaml.safe_load(file)
 
-    manager = RadiatorValveSwitchManager(config)
+    manager = RadiatorValveSwitchManager(config, config_path)
     await manager.run()
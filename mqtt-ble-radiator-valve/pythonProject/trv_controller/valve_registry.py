@@ -0,0 +1,158 @@
+import json
+
+from trv_controller.radiator_valve import RadiatorValve
+
+
+class ValveConfig:
+    """
+    A `radiator_valve_switches` entry of the YAML config, compiled at startup:
+    the MAC address is parsed once and the MQTT topics and the discovery payload are precomputed.
+    """
+    __slots__ = ("name", "mac_address", "mac_int", "bluetooth_proxies", "availability_timeout",
+                 "state_topic", "command_topic", "command_status_topic", "availability_topic", "attributes_topic",
+                 "comfort_temperature_topic", "device_id", "discovery_topic", "discovery_payload",
+                 "comfort_temperature_discovery_topic", "comfort_temperature_discovery_payload")
+
+    def __init__(self, config: dict, topic_prefix: str, discovery_prefix: str, availability_timeout: float = 60.0):
+        self.name: str = config["name"]
+        self.mac_address: str = config["mac_address"]
+        self.mac_int: int = RadiatorValve.mac_to_int(self.mac_address)
+        self.bluetooth_proxies: tuple[str, ...] = tuple(config.get("bluetooth_proxies", ()))
+
+        # seconds without advertisements after which the valve is offline
+        self.availability_timeout: float = config.get("availability_timeout", availability_timeout)
+
+        self.state_topic = f"{topic_prefix}/{self.name}/state"
+        self.command_topic = f"{topic_prefix}/{self.name}/set"
+        self.command_status_topic = f"{topic_prefix}/{self.name}/command_status"
+        self.availability_topic = f"{topic_prefix}/{self.name}/online"
+        self.attributes_topic = f"{topic_prefix}/{self.name}/attributes"
+        self.comfort_temperature_topic = f"{topic_prefix}/{self.name}/comfort_temperature"
+
+        # Refer to:
+        #     - https://www.home-assistant.io/integrations/mqtt/#mqtt-discovery
+        #     - https://www.home-assistant.io/integrations/valve.mqtt/
+        self.device_id = f"radiator_valve_{self.name}"
+        self.discovery_topic = f"{discovery_prefix}/valve/{self.device_id}/config"
+        self.discovery_payload: bytes = json.dumps({
+            "unique_id": f"{self.device_id}",
+            "object_id": f"{self.device_id}",
+            "state_topic": self.state_topic,
+            "command_topic": self.command_topic,
+            "availability": [{"topic": self.availability_topic}],
+            "json_attributes_topic": self.attributes_topic,
+            "device": {
+                "identifiers": [self.mac_address],
+                "name": f"Radiator Valve {self.name}",
+            }
+        }).encode()
+
+        # the comfort setpoint read on the valve (see `StatePoller`), as a sensor of the same device
+        #     - https://www.home-assistant.io/integrations/sensor.mqtt/
+        self.comfort_temperature_discovery_topic = \
+            f"{discovery_prefix}/sensor/{self.device_id}_comfort_temperature/config"
+        self.comfort_temperature_discovery_payload: bytes = json.dumps({
+            "unique_id": f"{self.device_id}_comfort_temperature",
+            "object_id": f"{self.device_id}_comfort_temperature",
+            "name": "Comfort temperature",
+            "state_topic": self.comfort_temperature_topic,
+            "availability": [{"topic": self.availability_topic}],
+            "device_class": "temperature",
+            "unit_of_measurement": "°C",
+            "device": {
+                "identifiers": [self.mac_address],
+            }
+        }).encode()
+
+    def __repr__(self):
+        return f"ValveConfig(name={self.name!r}, mac_address={self.mac_address!r})"
+
+
+class ValveGroup:
+    """
+    A `radiator_valve_groups` entry of the YAML config: valves switched together by a single command
+    """
+    __slots__ = ("name", "valves", "command_topic", "result_topic")
+
+    def __init__(self, config: dict, valves_by_name: dict[str, ValveConfig], topic_prefix: str):
+        self.name: str = config["name"]
+
+        unknown = [valve_name for valve_name in config["valves"] if valve_name not in valves_by_name]
+        if unknown:
+            raise ValueError(f"Unknown valves in the `radiator_valve_groups` entry {self.name}", unknown)
+        self.valves: tuple[ValveConfig, ...] = tuple(valves_by_name[valve_name] for valve_name in config["valves"])
+
+        self.command_topic = f"{topic_prefix}/group/{self.name}/set"
+        self.result_topic = f"{topic_prefix}/group/{self.name}/result"
+
+    def __repr__(self):
+        return f"ValveGroup(name={self.name!r}, valves={[valve.name for valve in self.valves]!r})"
+
+
+class ValveRegistry:
+    """
+    The configured valves, indexed by name and by integer MAC address (as reported in the BLE advertisements),
+    and the valve groups indexed by name
+    """
+
+    def __init__(self, valves_config: list[dict], topic_prefix: str, discovery_prefix: str,
+                 availability_timeout: float = 60.0, groups_config: list[dict] = ()):
+        self.topic_prefix = topic_prefix
+        self.discovery_prefix = discovery_prefix
+        self.availability_timeout = availability_timeout
+
+        self.valves: tuple[ValveConfig, ...] = tuple(ValveConfig(valve, topic_prefix, discovery_prefix,
+                                                                 availability_timeout)
+                                                     for valve in valves_config)
+        self.by_name: dict[str, ValveConfig] = {valve.name: valve for valve in self.valves}
+        self.by_mac: dict[int, ValveConfig] = {valve.mac_int: valve for valve in self.valves}
+
+        if len(self.by_name) != len(self.valves) or len(self.by_mac) != len(self.valves):
+            raise ValueError("Duplicated valve name or MAC address in `radiator_valve_switches`")
+
+        self.groups: dict[str, ValveGroup] = {group.name: group for group in
+                                              (ValveGroup(group, self.by_name, topic_prefix)
+                                               for group in groups_config)}
+        if len(self.groups) != len(groups_config):
+            raise ValueError("Duplicated group name in `radiator_valve_groups`")
+
+    def update(self, valves_config: list[dict], groups_config: list[dict] = ()) \
+            -> tuple[list[ValveConfig], list[ValveConfig], list[ValveConfig]]:
+        """
+        Applies a new `radiator_valve_switches` and `radiator_valve_groups` config in place, and returns the added,
+        the removed and the updated valves. The unchanged valves keep their `ValveConfig`, a valve whose MAC address
+        changed is removed and added back. A ValueError is raised, and nothing is changed, if the config is invalid.
+        """
+        current = ValveRegistry(valves_config, self.topic_prefix, self.discovery_prefix, self.availability_timeout,
+                                groups_config)
+
+        added, updated = [], []
+        valves = []
+        for valve in current.valves:
+            previous = self.by_name.get(valve.name)
+            if previous is None or previous.mac_int != valve.mac_int:
+                added.append(valve)
+            elif (previous.bluetooth_proxies, previous.availability_timeout) != \
+                    (valve.bluetooth_proxies, valve.availability_timeout):
+                updated.append(valve)
+            else:
+                valve = previous
+            valves.append(valve)
+        removed = [valve for valve in self.valves
+                   if valve.name not in current.by_name or current.by_name[valve.name].mac_int != valve.mac_int]
+
+        self.valves = tuple(valves)
+        self.by_name = {valve.name: valve for valve in self.valves}
+        # updated in place, the dict is shared with the advertisements ingestor
+        self.by_mac.clear()
+        self.by_mac.update((valve.mac_int, valve) for valve in self.valves)
+        self.groups = {group.name: group for group in
+                       (ValveGroup(group, self.by_name, self.topic_prefix) for group in groups_config)}
+
+        return added, removed, updated
+
+    def __iter__(self):
+        return iter(self.valves)
+
+    def __len__(self):
+        return len(self.valves)